@@ -1,16 +1,58 @@
 import os
+import io
+import sys
 import asyncio
 from hypha_rpc import connect_to_server
-import aiofiles
 import logging
 import argparse
 import posixpath
 from typing import Optional
 import stat as stat_module
 import mimetypes
+import uuid
+import time
+import struct
+import ctypes
+import ctypes.util
+import inspect
+import contextvars
+import contextlib
+import errno
+import tarfile
+import multiprocessing
+import sqlite3
+import hashlib
+import bisect
+import math
+import functools
+import random
+import array
+import threading
+import shutil
+import zipfile
+import zlib
+import lzma
+import pickle
+import socket
+from collections import OrderedDict, deque
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:  # Server-side thumbnails are unavailable without Pillow
+    Image = None
+
+try:
+    import zstandard
+except ImportError:  # zstd transfer compression is unavailable without zstandard
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:  # LocalServer then passes values without serializing them
+    msgpack = None
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('AsyncFileService')
 
 # Define alternative path separators for different OS
@@ -53,18 +95,264 @@ def safe_join(directory: str, *pathnames: str) -> Optional[str]:
 
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='Async File Service with configurable root directory')
     parser.add_argument('--root', '-r', 
                        type=str,
                        default=os.path.abspath("./"),
                        help='Root directory for the file service (default: current directory)')
-    return parser.parse_args()
+    parser.add_argument('--metadata-cache-size',
+                       type=int,
+                       default=10000,
+                       help='Maximum number of cached stat results and listing entries, 0 to disable (default: 10000)')
+    parser.add_argument('--content-cache-size',
+                       type=int,
+                       default=64 * 1024 * 1024,
+                       help='Bytes of file contents cached in memory for readFile, 0 to disable (default: 67108864)')
+    parser.add_argument('--content-cache-max-file',
+                       type=int,
+                       default=1024 * 1024,
+                       help='Largest file kept in the content cache in bytes (default: 1048576)')
+    parser.add_argument('--max-decompressed-size',
+                       type=int,
+                       default=256 * 1024 * 1024,
+                       help='Largest compressed writeFile payload once decompressed, in bytes (default: 268435456)')
+    parser.add_argument('--copy-workers',
+                       type=int,
+                       default=8,
+                       help='Number of threads copying, moving and removing files for copyTree/moveTree/moveMany/removeTree (default: 8)')
+    parser.add_argument('--thumbnail-cache-dir',
+                       type=str,
+                       default=os.path.expanduser("~/.cache/async-file-service/thumbnails"),
+                       help='Directory for cached thumbnails (default: ~/.cache/async-file-service/thumbnails)')
+    parser.add_argument('--thumbnail-cache-size',
+                       type=int,
+                       default=256 * 1024 * 1024,
+                       help='Bytes of cached thumbnails kept, least recently used ones are deleted beyond (default: 268435456)')
+    parser.add_argument('--thumbnail-cache-max-age',
+                       type=float,
+                       default=30 * 24 * 3600,
+                       help='Seconds an unused cached thumbnail is kept (default: 2592000, 30 days)')
+    parser.add_argument('--thumbnail-workers',
+                       type=int,
+                       default=os.cpu_count() or 1,
+                       help='Number of processes generating thumbnails (default: number of CPUs)')
+    parser.add_argument('--hash-workers',
+                       type=int,
+                       default=os.cpu_count() or 1,
+                       help='Number of threads hashing files (default: number of CPUs)')
+    parser.add_argument('--scan-workers',
+                       type=int,
+                       default=8,
+                       help='Number of threads scanning directories for dirSize (default: 8)')
+    parser.add_argument('--interactive-workers',
+                       type=int,
+                       default=16,
+                       help='Threads running interactive blocking calls such as stat and readdir (default: 16)')
+    parser.add_argument('--bulk-workers',
+                       type=int,
+                       default=4,
+                       help='Threads running bulk blocking calls such as large reads and writes (default: 4)')
+    parser.add_argument('--max-queue',
+                       type=int,
+                       default=1000,
+                       help='Blocking calls that may wait per executor lane before new ones are rejected as busy (default: 1000)')
+    parser.add_argument('--client-concurrency',
+                       type=int,
+                       default=16,
+                       help='Blocking calls one client may have running or queued on a lane at once (default: 16)')
+    parser.add_argument('--max-handles',
+                       type=int,
+                       default=1024,
+                       help='File handles that may be open at once across all clients (default: 1024)')
+    parser.add_argument('--max-handles-per-client',
+                       type=int,
+                       default=256,
+                       help='File handles one client may have open at once (default: 256)')
+    parser.add_argument('--max-upload-sessions',
+                       type=int,
+                       default=64,
+                       help='Resumable uploads that may be in progress at once; each holds a file '
+                            'handle counted toward --max-handles (default: 64)')
+    parser.add_argument('--handle-idle-timeout',
+                       type=float,
+                       default=600,
+                       help='Close file handles unused for this many seconds; 0 disables (default: 600)')
+    parser.add_argument('--readahead-max',
+                       type=int,
+                       default=1024 * 1024,
+                       help='Largest read-ahead window of a sequentially read file handle in bytes; 0 disables (default: 1048576)')
+    parser.add_argument('--log-level',
+                       type=str.upper,
+                       choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                       default='INFO',
+                       help='Logging level (default: INFO)')
+    parser.add_argument('--slow-op-threshold',
+                       type=float,
+                       default=1.0,
+                       help='Log service calls taking longer than this many seconds; 0 disables (default: 1.0)')
+    parser.add_argument('--trace-sample-rate',
+                       type=float,
+                       default=0.0,
+                       help='Fraction of service calls recorded as traces, from 0 to 1 (default: 0)')
+    parser.add_argument('--index-db',
+                       type=str,
+                       default=None,
+                       help='SQLite file of the search index (default: ~/.cache/async-file-service/index-<root hash>.sqlite3)')
+    parser.add_argument('--max-inotify-watches',
+                       type=int,
+                       default=None,
+                       help='inotify watches the service may use, split between the metadata cache, '
+                            'the search index and watch subscriptions (default: from fs.inotify.max_user_watches)')
+    parser.add_argument('--no-index',
+                       action='store_true',
+                       help='Disable the search index and its background crawl')
+    parser.add_argument('--workers',
+                       type=int,
+                       default=1,
+                       help='Worker processes serving the root, with calls spread across them by path (default: 1)')
+    parser.add_argument('--worker-fd',
+                       type=int,
+                       default=None,
+                       help=argparse.SUPPRESS)  # Set on the worker processes started by --workers
+    parser.add_argument('--no-sweep',
+                       action='store_true',
+                       help=argparse.SUPPRESS)  # Set on worker processes, the front process sweeps instead
+    return parser.parse_args(argv)
+
+# Default number of entries returned per readdirpage call
+LISTING_PAGE_SIZE = 1000
+# Largest page a paged listing or search returns, whatever limit is asked for
+LISTING_PAGE_MAX = 10000
+# Maximum number of directory snapshots kept alive for paginated listings
+LISTING_SNAPSHOT_LIMIT = 64
+# Shares of the inotify watch budget, so that no user of inotify can starve the others;
+# the rest is left to other processes of the same user
+INOTIFY_WATCH_SHARES = {"metadata": 0.25, "index": 0.5, "notifier": 0.125}
+# Default chunk size for streaming file reads
+READ_CHUNK_SIZE = 1024 * 1024
+# Default number of streamed chunks delivered to a callback but not yet acknowledged
+READ_MAX_IN_FLIGHT = 4
+# Default number of operations of a concurrent batch call running at once
+BATCH_MAX_CONCURRENCY = 16
+# Maximum number of bytes copied per copy_file_range/sendfile/read call
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# errnos meaning a kernel-side copy method is unsupported for a pair of files
+COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+# Minimum number of seconds between two progress reports of a tree copy/move
+PROGRESS_INTERVAL = 0.5
+# Number of files unlinked per copy pool job of a tree removal
+REMOVE_BATCH_SIZE = 256
+# Maximum number of generated archive chunks waiting for the client to pull them
+ARCHIVE_QUEUE_SIZE = 4
+# Seconds an archive stream waits for the client to pull a chunk before giving up,
+# as a generator that is abandoned instead of closed never tells its producer
+ARCHIVE_STALL_TIMEOUT = 300
+# How often a producer waiting on a full archive queue checks whether the stream is gone
+ARCHIVE_POLL_INTERVAL = 0.5
+# Mime types already compressed, stored as-is in zip archives
+ARCHIVE_STORED_MIME_TYPES = {
+    "image/jpeg", "image/png", "image/gif", "image/webp", "image/avif", "image/heic",
+    "audio/mpeg", "audio/mp4", "audio/ogg", "audio/aac", "audio/flac", "audio/webm",
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-bzip2",
+    "application/x-xz", "application/x-7z-compressed", "application/x-rar-compressed",
+    "application/vnd.rar", "application/zstd", "application/java-archive",
+}
+ARCHIVE_STORED_MIME_PREFIXES = ("video/",)
+# Default edge length in pixels of generated thumbnails
+THUMBNAIL_SIZE = 48
+# Minimum seconds between two prunes of the thumbnail cache
+THUMBNAIL_PRUNE_INTERVAL = 600
+# Digest algorithms supported by hash/findDuplicates
+HASH_ALGORITHMS = ("md5", "sha1", "sha256", "blake2b")
+# Bytes fed to the digest per update
+HASH_BLOCK_SIZE = 1024 * 1024
+# Maximum number of digests kept in the hash cache
+HASH_CACHE_SIZE = 100000
+# Seconds an upload session may stay idle before it is aborted
+UPLOAD_SESSION_TTL = 24 * 3600
+# Seconds between two checks for idle upload sessions
+UPLOAD_EXPIRY_INTERVAL = 60
+# Directory under the root that upload and delta temporary files are built in
+UPLOAD_DIRECTORY = ".async-file-service-uploads"
+# Directory under the root that trashed trees are renamed into before being purged
+TRASH_DIRECTORY = ".async-file-service-trash"
+# Maximum number of directory subtotals kept by the dirSize cache
+DIRSIZE_CACHE_SIZE = 200000
+# Maximum number of unfinished dirSize computations kept for continuation
+DIRSIZE_CONTINUATION_LIMIT = 64
+# Seconds without new events before a watch subscription's batch is delivered
+WATCH_DEBOUNCE = 0.1
+# Maximum seconds a change event waits for its batch to be delivered
+WATCH_MAX_DELAY = 1.0
+# Maximum number of changed paths queued per watch subscription before it must resync
+WATCH_QUEUE_LIMIT = 1000
+# Seconds between two scans of a watched directory when inotify is unavailable
+WATCH_POLL_INTERVAL = 1.0
+# Stat fields of columnar listings: field -> (array typecode, client array type, getter)
+LISTING_COLUMNS = {
+    "size": ("d", "float64", lambda st: st.st_size),
+    "mtime": ("d", "float64", lambda st: st.st_mtime_ns / 1e6),
+    "atime": ("d", "float64", lambda st: st.st_atime_ns / 1e6),
+    "ctime": ("d", "float64", lambda st: st.st_ctime_ns / 1e6),
+    "mode": ("I", "uint32", lambda st: st.st_mode),
+    "nlink": ("I", "uint32", lambda st: st.st_nlink),
+    "uid": ("I", "uint32", lambda st: st.st_uid),
+    "gid": ("I", "uint32", lambda st: st.st_gid),
+    "ino": ("Q", "uint64", lambda st: st.st_ino),
+    "mime": ("H", "uint16", None),
+}
+# Fields of a columnar listing when the caller does not choose
+LISTING_DEFAULT_COLUMNS = ("size", "mtime", "mode", "mime")
+
+# Upper bounds in seconds of the latency histogram buckets of service calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Maximum number of sampled call traces kept for getTraces
+TRACE_BUFFER_SIZE = 256
+# Maximum length of the argument summary recorded in traces and slow-call logs
+TRACE_ARGS_LENGTH = 200
+
+# Id under which the service is registered
+SERVICE_ID = "async-file-service"
+# Reads and writes of at most this many bytes run on the interactive executor lane
+INTERACTIVE_IO_LIMIT = 1024 * 1024
+# Niceness added to bulk executor threads, so interactive work gets the CPU and disk first
+BULK_THREAD_NICENESS = 10
+# Bounds of the block size of delta writes, which defaults to about the square root of the file size
+DELTA_MIN_BLOCK_SIZE = 1024
+DELTA_MAX_BLOCK_SIZE = 1024 * 1024
+# Transfer compression codecs, in order of preference, with their default levels
+TRANSFER_CODEC_LEVELS = {"zstd": 3, "zlib": 6, "lzma": 1}
+# Fastest level of each codec, used to probe whether a payload is worth compressing
+COMPRESSION_PROBE_LEVELS = {"zstd": 1, "zlib": 1, "lzma": 0}
+# Payloads smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = 1024
+# Bytes at the start of a payload compressed by the probe
+COMPRESSION_PROBE_SIZE = 64 * 1024
+# A payload is compressed only if its probe shrinks to less than this fraction
+COMPRESSION_MAX_RATIO = 0.9
+# Smallest read-ahead window of a file handle, used from its second sequential read
+READAHEAD_MIN_WINDOW = 64 * 1024
+# Seconds before a crashed worker process is restarted, doubled per crash up to WORKER_RESTART_MAX_DELAY
+WORKER_RESTART_DELAY = 0.5
+WORKER_RESTART_MAX_DELAY = 30
+# Seconds a worker process may take to start serving
+WORKER_START_TIMEOUT = 60
+# Argument (position, name) of the ids handed out by one worker, by operation; worker mode prefixes them with the worker
+WORKER_TOKEN_ARGUMENTS = {
+    "putChunk": (0, "sessionId"), "getUploadStatus": (0, "sessionId"), "commitUpload": (0, "sessionId"),
+    "abortUpload": (0, "sessionId"), "unwatch": (0, "watchId"), "dirSize": (2, "continuation"),
+}
+# Result field holding such an id, by operation
+WORKER_RESULT_TOKENS = {"beginUpload": "sessionId", "watch": "watchId", "dirSize": "continuation"}
+# Operations served by the only worker keeping the search index
+WORKER_INDEX_OPERATIONS = {"search", "getIndexStatus"}
 
-# Get arguments
-args = parse_args()
-DEFAULT_WORKDIR = os.path.abspath(args.root)
-logger.info(f"Using root directory: {DEFAULT_WORKDIR}")
+# Client (hypha-rpc ``context["from"]``) on whose behalf the current call runs
+CURRENT_CLIENT = contextvars.ContextVar("current_client", default=None)
+# ``[path, ancestors]`` changes made by the current call, collected in worker processes so
+# the front process can have the other workers drop those paths from their caches
+CHANGED_PATHS = contextvars.ContextVar("changed_paths", default=None)
 
 def js_flag_to_python_mode(flag):
     """Convert Node.js file flags to Python file modes"""
@@ -84,6 +372,12 @@ def js_flag_to_python_mode(flag):
     }
     return flag_map.get(flag, 'r')  # default to read mode if unknown
 
+def page_limit(limit, maximum=LISTING_PAGE_MAX):
+    """Validate the ``limit`` of a paged call, clamped to ``maximum``."""
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+        raise ValueError(f"Page limit must be a positive integer, got {limit!r}")
+    return min(limit, maximum)
+
 def js_encoding_to_python(encoding):
     """Convert Node.js encodings to Python encodings"""
     if not encoding or encoding == 'utf8' or encoding == 'utf-8':
@@ -92,430 +386,4276 @@ def js_encoding_to_python(encoding):
         return None  # Use binary mode in Python
     return encoding
 
-async def main():
-    logger.info("Starting AsyncFileService")
-    
-    # Ensure root directory exists
-    try:
-        os.makedirs(DEFAULT_WORKDIR, exist_ok=True)
-        logger.info(f"Root directory ensured at: {DEFAULT_WORKDIR}")
-    except Exception as e:
-        logger.error(f"Failed to create root directory {DEFAULT_WORKDIR}: {str(e)}")
-        return
-    
-    server = await connect_to_server(
-        {"name": "anonymous client", "server_url": "https://hypha.aicell.io"}
-    )
-    logger.info(f"Connected to server: {server.config.workspace}")
+def pread_into(fd, buffer, offset, length, position):
+    """Read into ``buffer[offset:offset + length]`` from ``position`` without moving the file offset."""
+    view = memoryview(buffer)[offset:offset + length]
+    total = 0
+    while total < len(view):
+        n = os.preadv(fd, [view[total:]], position + total)
+        if n == 0:
+            break
+        total += n
+    return total
 
-    workdir = DEFAULT_WORKDIR
-    logger.debug(f"Working directory set to: {workdir}")
+def pwrite_from(fd, buffer, offset, length, position):
+    """Write ``buffer[offset:offset + length]`` at ``position`` without moving the file offset."""
+    view = memoryview(buffer)[offset:offset + length]
+    total = 0
+    while total < len(view):
+        total += os.pwrite(fd, view[total:], position + total)
+    return total
 
-    def create_async_file(file):
-        return {
-            "_rintf": True,
-            "stat": lambda: file_stat(file),
-            "close": lambda: file_close(file),
-            "truncate": lambda length: file_truncate(file, length),
-            "sync": lambda: file_sync(file),
-            "write": lambda buffer, offset, length, position: file_write(file, buffer, offset, length, position),
-            "read": lambda buffer, offset, length, position: file_read(file, buffer, offset, length, position),
-            "datasync": lambda: file_datasync(file),
-            "chown": lambda uid, gid: file_chown(file, uid, gid),
-            "chmod": lambda mode: file_chmod(file, mode),
-            "utimes": lambda atime, mtime: file_utimes(file, atime, mtime),
-        }
+def read_file(path, mode, encoding=None):
+    """Read a whole file, as bytes if ``encoding`` is ``None``."""
+    if encoding is None:
+        with open(path, f"{mode}b") as f:
+            return f.read()
+    with open(path, mode, encoding=encoding) as f:
+        return f.read()
 
-    def convert_stat_to_dict(stats):
-        mtime = int(stats.st_mtime)
-        return {
-            "_rintf": True,
-            "st_mode": stats.st_mode,
-            "st_ino": stats.st_ino,
-            "st_dev": stats.st_dev,
-            "st_nlink": stats.st_nlink,
-            "st_uid": stats.st_uid,
-            "st_gid": stats.st_gid,
-            "st_size": stats.st_size,
-            "st_atime": stats.st_atime,
-            "st_mtime": stats.st_mtime,
-            "st_ctime": stats.st_ctime,
-            "mtime": mtime * 1000,
-            "size": stats.st_size,
-            "isDirectory": stat_module.S_ISDIR(stats.st_mode),
-            "isFile": stat_module.S_ISREG(stats.st_mode),
-        }
+def write_file(path, mode, data, encoding=None):
+    """Write ``data`` to a file, as bytes if ``encoding`` is ``None``."""
+    if encoding is None:
+        with open(path, f"{mode}b") as f:
+            f.write(data)
+    else:
+        with open(path, mode, encoding=encoding) as f:
+            f.write(data)
 
-    def resolve_path(p):
-        """Safely resolve a path relative to the workdir.
-        
-        This function ensures that:
-        1. All paths are safely joined using safe_join
-        2. Paths cannot escape the workdir
-        3. Root paths (/) are mapped to workdir
-        4. Special prefixes like /async-file-service/ are handled
-        
-        Args:
-            p: The path to resolve
-            
-        Returns:
-            str: The safely resolved absolute path
-            
-        Raises:
-            Exception: If the path is illegal or tries to escape workdir
-        """
-        logger.debug(f"Resolving path: {p}")
-        
-        # Handle empty or None paths
-        if not p:
-            return workdir
-            
-        # Detect and prevent path duplication issue
-        if workdir in p:
-            # If the workdir is already in the path, extract just the relative part
-            rel_path = p.replace(workdir, '')
-            # Remove any leading slashes from the relative path
-            rel_path = rel_path.lstrip('/')
-            logger.debug(f"Path contains workdir already, extracted relative part: {rel_path}")
-            p = rel_path
-        # Handle absolute paths by making them relative to workdir
-        elif p.startswith("/"):
-            p = p[1:]  # Remove leading slash to make relative
-            
-        # Use safe_join to ensure path cannot escape workdir
-        try:
-            resolved = safe_join(workdir, p)
-            if resolved is None:
-                raise Exception(f"Invalid path: {p}")
-            logger.debug(f"Resolved path: {resolved}")
-            return resolved
-        except Exception as e:
-            logger.error(f"Failed to resolve path {p}: {str(e)}")
-            raise Exception(f"Failed to resolve path {p}: {str(e)}")
+def read_file_range(path, offset, length):
+    """Read up to ``length`` bytes of a file from ``offset``.
 
-    async def file_stat(file):
-        stats = await file.stat()
-        return convert_stat_to_dict(stats)
+    ``os.pread`` hands back the bytes object it read into, so the data is not
+    copied again; only a read cut short before the end of the file is joined.
+    """
+    with open(path, "rb", buffering=0) as f:
+        data = os.pread(f.fileno(), length, offset)
+        if len(data) == length or not data:
+            return data
+        chunks = [data]
+        total = len(data)
+        while total < length:
+            chunk = os.pread(f.fileno(), length - total, offset + total)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            total += len(chunk)
+        return b"".join(chunks)
 
-    async def file_close(file):
-        await file.close()
+def pread_ranges(fd, ranges):
+    """Read several ``(offset, length)`` ranges of a file in one go."""
+    return [os.pread(fd, length, offset) for offset, length in ranges]
 
-    async def file_truncate(file, length):
-        await file.truncate(length)
+def content_validator(stats):
+    """The stat fields identifying one version of a file's contents."""
+    return (stats.st_ino, stats.st_size, stats.st_mtime_ns)
 
-    async def file_sync(file):
-        await file.flush()
-        os.fsync(file.fileno())
+def read_file_contents(path):
+    """Read a whole file; returns its content validator and its bytes."""
+    with open(path, "rb", buffering=0) as f:
+        stats = os.fstat(f.fileno())
+        return content_validator(stats), f.read()
 
-    async def file_write(file, buffer, offset, length, position):
-        await file.seek(position)
-        await file.write(buffer[offset:offset+length])
-        return length
+def decode_text(data, encoding):
+    """Decode file contents like reading the file in text mode, newline translation included."""
+    return io.TextIOWrapper(io.BytesIO(data), encoding=encoding).read()
 
-    async def file_read(file, buffer, offset, length, position):
-        await file.seek(position)
-        data = await file.read(length)
-        buffer[offset:offset+len(data)] = data
-        return len(data)
 
-    async def file_datasync(file):
-        os.fdatasync(file.fileno())
+def copy_file_contents(src, dst, overwrite=False):
+    """Copy a regular file, kernel-side where possible.
 
-    async def file_chown(file, uid, gid):
-        os.chown(file.name, uid, gid)
+    Tries ``os.copy_file_range`` (which can reflink on CoW filesystems), then
+    ``os.sendfile``, then falls back to a buffered copy. Without ``overwrite``
+    an existing ``dst`` raises ``FileExistsError``, and a ``dst`` that is
+    the same file as ``src`` (e.g. a hard link) raises ``shutil.SameFileError``
+    instead of being truncated.
 
-    async def file_chmod(file, mode):
-        os.chmod(file.name, mode)
+    Returns:
+        int: The number of bytes copied.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | (0 if overwrite else os.O_EXCL)
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        src_stat = os.fstat(src_fd)
+        dst_fd = os.open(dst, flags, stat_module.S_IMODE(src_stat.st_mode))
+        try:
+            dst_stat = os.fstat(dst_fd)
+            if (dst_stat.st_dev, dst_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino):
+                raise shutil.SameFileError(f"{src} and {dst} are the same file")
+            # Truncated only now that it is known not to be the source
+            os.ftruncate(dst_fd, 0)
+            size = src_stat.st_size
+            copied = 0
+            for copy_chunk in (
+                lambda n: os.copy_file_range(src_fd, dst_fd, n, copied, copied),
+                lambda n: os.sendfile(dst_fd, src_fd, copied, n),
+            ):
+                try:
+                    while copied < size:
+                        n = copy_chunk(min(size - copied, COPY_CHUNK_SIZE))
+                        if n == 0:
+                            break
+                        copied += n
+                    break
+                except (OSError, AttributeError) as e:
+                    # Unsupported by the kernel/filesystem pair, try the next method
+                    if copied or (isinstance(e, OSError) and e.errno not in COPY_FALLBACK_ERRNOS):
+                        raise
+            if copied < size:
+                os.lseek(src_fd, copied, os.SEEK_SET)
+                os.lseek(dst_fd, copied, os.SEEK_SET)
+                while True:
+                    data = os.read(src_fd, COPY_CHUNK_SIZE)
+                    if not data:
+                        break
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(dst_fd, view):]
+                    copied += len(data)
+            return copied
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
 
-    async def file_utimes(file, atime, mtime):
-        os.utime(file.name, (atime, mtime))
+def copy_range(src_fd, dst_fd, offset, length, position):
+    """Copy ``length`` bytes at ``offset`` of one file to ``position`` of another, kernel-side where possible."""
+    copied = 0
+    try:
+        while copied < length:
+            n = os.copy_file_range(src_fd, dst_fd, min(length - copied, COPY_CHUNK_SIZE),
+                                   offset + copied, position + copied)
+            if n == 0:
+                break
+            copied += n
+    except (OSError, AttributeError) as e:
+        # Unsupported by the kernel/filesystem pair, copy through user space
+        if copied or (isinstance(e, OSError) and e.errno not in COPY_FALLBACK_ERRNOS):
+            raise
+    while copied < length:
+        data = os.pread(src_fd, min(length - copied, COPY_CHUNK_SIZE), offset + copied)
+        if not data:
+            break
+        copied += pwrite_from(dst_fd, data, 0, len(data), position + copied)
+    return copied
 
-    async def diskSpace(p):
-        p = resolve_path(p)
-        statvfs = os.statvfs(p)
-        total = statvfs.f_frsize * statvfs.f_blocks
-        free = statvfs.f_frsize * statvfs.f_bavail
-        return {"total": total, "free": free}
+def delta_block_size(size):
+    """Pick the block size of delta writes to a file of ``size`` bytes: a power of two near its square root."""
+    block_size = DELTA_MIN_BLOCK_SIZE
+    while block_size * block_size < size and block_size < DELTA_MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
 
-    async def openFile(p, flag):
-        p = resolve_path(p)
-        try:
-            mode = js_flag_to_python_mode(flag)
-            file = await aiofiles.open(p, mode=mode)
-            return create_async_file(file)
-        except Exception as e:
-            return {"error": str(e)}
+def content_version(stats):
+    """A string identifying one version of a file's contents, for clients to hand back."""
+    return "-".join(str(value) for value in content_validator(stats))
 
-    async def createFile(p, flag, mode):
-        p = resolve_path(p)
-        try:
-            py_mode = js_flag_to_python_mode(flag)
-            file = await aiofiles.open(p, mode=py_mode)
-            if mode is not None:
-                os.chmod(p, mode)
-            return create_async_file(file)
-        except Exception as e:
-            return {"error": str(e)}
+def block_checksums(path, block_size, algorithm):
+    """Checksum each ``block_size`` block of a file, for delta writes.
 
-    async def rename(oldPath, newPath):
-        oldPath = resolve_path(oldPath)
-        newPath = resolve_path(newPath)
-        try:
-            os.rename(oldPath, newPath)
-        except Exception as e:
-            return {"error": str(e)}
+    Returns:
+        tuple: ``(version, size, weak, strong)``: the content version and
+        size of the file, the Adler-32 checksums of its blocks as an
+        ``array("I")`` and their concatenated ``algorithm`` digests.
+    """
+    weak = array.array("I")
+    strong = bytearray()
+    buffer = bytearray(block_size)
+    with open(path, "rb", buffering=0) as f:
+        stats = os.fstat(f.fileno())
+        position = 0
+        while True:
+            n = pread_into(f.fileno(), buffer, 0, block_size, position)
+            if n == 0:
+                break
+            block = memoryview(buffer)[:n]
+            weak.append(zlib.adler32(block))
+            strong += hashlib.new(algorithm, block).digest()
+            position += n
+    return content_version(stats), stats.st_size, weak, bytes(strong)
 
-    async def stat(p, isLstat=False):
-        p = resolve_path(p)
-        try:
-            logger.debug(f"Getting stat for: {p} (isLstat: {isLstat})")
-            stats = os.lstat(p) if isLstat else os.stat(p)
-            
-            # Manually construct the result in a format compatible with BrowserFS
-            mtime = int(stats.st_mtime)
-            is_dir = stat_module.S_ISDIR(stats.st_mode)
-            is_file = stat_module.S_ISREG(stats.st_mode)
-            
-            result = {
-                "_rintf": True,
-                "st_mode": stats.st_mode,
-                "st_ino": stats.st_ino,
-                "st_dev": stats.st_dev,
-                "st_nlink": stats.st_nlink,
-                "st_uid": stats.st_uid,
-                "st_gid": stats.st_gid,
-                "st_size": stats.st_size,
-                "st_atime": stats.st_atime,
-                "st_mtime": stats.st_mtime,
-                "st_ctime": stats.st_ctime,
-                "mtime": mtime * 1000,
-                "size": stats.st_size,
-                "isDirectory": is_dir,
-                "isFile": is_file,
-            }
-            
-            # Explicitly add mime property that elFinder expects
-            if is_dir:
-                result["mime"] = "directory"
-            else:
-                # For files, try to get a mime type based on extension
-                mime_type, _ = mimetypes.guess_type(p)
-                result["mime"] = mime_type or "application/octet-stream"
-            
-            logger.debug(f"Stat result for {p}: isDir={is_dir}, isFile={is_file}, mime={result.get('mime')}")
-            return result
-        except Exception as e:
-            logger.error(f"Error in stat for {p}: {str(e)}", exc_info=True)
-            # Raise the error so it can be properly handled by the JavaScript client
-            raise e
+def apply_delta(path, tmp_path, ops, base=None):
+    """Write a new version of ``path`` to ``tmp_path`` from delta instructions.
 
-    async def unlink(p):
-        p = resolve_path(p)
-        try:
-            os.unlink(p)
-        except Exception as e:
-            return {"error": str(e)}
+    Each op is ``{"copy": offset, "length": n}``, copying bytes of the
+    current file, or ``{"data": bytes}``, adding literal bytes. With
+    ``base``, the file must still be at that content version.
 
-    async def rmdir(p):
-        p = resolve_path(p)
+    Returns:
+        tuple: ``(copied, literal)``, the bytes taken from the file and from the ops.
+    """
+    with open(path, "rb", buffering=0) as src:
+        stats = os.fstat(src.fileno())
+        if base is not None and content_version(stats) != base:
+            raise ValueError(f"File changed since its checksums were taken: {path}")
+        dst_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
         try:
-            os.rmdir(p)
-        except Exception as e:
-            return {"error": str(e)}
+            os.fchmod(dst_fd, stat_module.S_IMODE(stats.st_mode))
+            position = copied = literal = 0
+            pending = None  # [offset, length] of adjacent copies, done as one
+            for op in [*ops, None]:
+                if pending is not None and (op is None or "data" in op or op["copy"] != sum(pending)):
+                    n = copy_range(src.fileno(), dst_fd, pending[0], pending[1], position)
+                    position += n
+                    copied += n
+                    pending = None
+                if op is None:
+                    break
+                if "data" in op:
+                    data = op["data"]
+                    position += pwrite_from(dst_fd, data, 0, len(data), position)
+                    literal += len(data)
+                    continue
+                offset, length = op["copy"], op["length"]
+                if offset < 0 or length < 0 or offset + length > stats.st_size:
+                    raise ValueError(f"Copy of [{offset}, {offset + length}) is outside the file of {stats.st_size} bytes")
+                if pending is None:
+                    pending = [offset, length]
+                else:
+                    pending[1] += length
+            os.fsync(dst_fd)
+        finally:
+            os.close(dst_fd)
+    return copied, literal
 
-    async def mkdir(p, mode):
-        try:
-            p = resolve_path(p)
-            logger.debug(f"Creating directory: {p}, mode: {mode}")
-            os.makedirs(p, mode=mode, exist_ok=True)
-            return {"success": True}
-        except Exception as e:
-            error_msg = f"Error creating directory {p}: {str(e)}"
-            logger.error(error_msg, exc_info=True)
-            return {"error": error_msg}
+def transfer_file(src, dst, policy="error", move=False):
+    """Copy (or move) one file or symlink, applying an overwrite ``policy``.
 
-    async def readdir(p):
-        try:
-            p = resolve_path(p)
-            logger.debug(f"Reading directory: {p}")
+    ``policy`` is "overwrite", "skip" or "error". Moves use ``os.rename``
+    and fall back to copy + unlink across devices. Overwriting a file with
+    itself (the same inode, e.g. through a hard link) raises
+    ``shutil.SameFileError``.
 
-            # Ensure directory exists
-            if not os.path.exists(p):
-                os.makedirs(p, exist_ok=True)
-            
-            # Get directory listing
-            files = os.listdir(p)
-            
-            # Process the files with simplified info
-            
-            logger.debug(f"Directory contents: {len(files)} items")
-            return files
-        except Exception as e:
-            error_msg = f"Error reading directory {p}: {str(e)}"
-            logger.error(error_msg, exc_info=True)
-            raise e
-    
-    async def readdirwithstats(p):
-        p = resolve_path(p)
+    Returns:
+        bool: False if the file was skipped.
+    """
+    if os.path.lexists(dst):
+        if policy == "skip":
+            return False
+        if policy != "overwrite":
+            raise FileExistsError(errno.EEXIST, "Destination exists", dst)
+        src_stat, dst_stat = os.lstat(src), os.lstat(dst)
+        if (dst_stat.st_dev, dst_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino):
+            # rename() would do nothing and a copy would truncate the source
+            raise shutil.SameFileError(f"{src} and {dst} are the same file")
+        if stat_module.S_ISLNK(dst_stat.st_mode):
+            os.unlink(dst)
+    if move:
         try:
-            logger.debug(f"Reading directory with stats: {p}")
-            files = os.listdir(p)
-            
-            # Create a list to hold stats for each file
-            result = []
-            
-            # Process each file and get its stats
-            for f in files:
-                # Safely join paths to prevent duplication
-                file_path = os.path.join(p, f)
-                logger.debug(f"Getting stats for file: {file_path}")
-                file_stats = await stat(file_path)
-                # Add the name to the stats object for easier processing on the client
-                file_stats["name"] = f
-                result.append(file_stats)
-                
-            return result
-        except Exception as e:
-            logger.error(f"Error in readdirwithstats for {p}: {str(e)}", exc_info=True)
-            return {"error": str(e)}
+            os.rename(src, dst)
+            return True
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+    else:
+        copy_file_contents(src, dst, overwrite=True)
+    if move:
+        os.unlink(src)
+    return True
 
-    async def exists(p):
-        try:
-            p = resolve_path(p)
-            logger.debug(f"Checking if path exists: {p}")
-            exists = os.path.exists(p)
-            logger.debug(f"Path {p} exists: {exists}")
-            return exists
-        except Exception as e:
-            logger.error(f"Error checking if path exists {p}: {str(e)}", exc_info=True)
-            # Return False instead of raising to match expected behavior
-            return False
+def plan_tree_copy(src, dst):
+    """Walk ``src`` with scandir and list what copying it to ``dst`` involves.
 
-    async def realpath(p, cache):
-        p = resolve_path(p)
-        try:
-            return os.path.realpath(p)
-        except Exception as e:
-            return {"error": str(e)}
+    Returns:
+        tuple: ``(directories, files, symlinks)`` where directories are
+        ``(src, dst, mode)`` in top-down order, files are ``(src, dst, size)``
+        and symlinks are ``(src, dst)``.
+    """
+    src_stat = os.lstat(src)
+    if stat_module.S_ISLNK(src_stat.st_mode):
+        return [], [], [(src, dst)]
+    if not stat_module.S_ISDIR(src_stat.st_mode):
+        return [], [(src, dst, src_stat.st_size)], []
+    directories = [(src, dst, stat_module.S_IMODE(src_stat.st_mode))]
+    files = []
+    symlinks = []
+    stack = [(src, dst)]
+    while stack:
+        src_dir, dst_dir = stack.pop()
+        with os.scandir(src_dir) as it:
+            for entry in it:
+                target = os.path.join(dst_dir, entry.name)
+                if entry.is_symlink():
+                    symlinks.append((entry.path, target))
+                elif entry.is_dir():
+                    mode = stat_module.S_IMODE(entry.stat().st_mode)
+                    directories.append((entry.path, target, mode))
+                    stack.append((entry.path, target))
+                else:
+                    files.append((entry.path, target, entry.stat().st_size))
+    return directories, files, symlinks
 
-    async def readFile(fname, encoding, flag):
-        try:
-            fname = resolve_path(fname)
-            logger.debug(f"Reading file: {fname}, encoding: {encoding}, flag: {flag}")
-            
-            py_mode = js_flag_to_python_mode(flag)
-            py_encoding = js_encoding_to_python(encoding)
-            
-            # If binary mode requested, read in binary mode
-            if py_encoding is None:
-                async with aiofiles.open(fname, mode=f"{py_mode}b") as f:
-                    data = await f.read()
-            else:
-                async with aiofiles.open(fname, mode=py_mode, encoding=py_encoding) as f:
-                    data = await f.read()
-                    
-            logger.debug(f"Successfully read file: {fname}")
-            return data
-        except Exception as e:
-            logger.error(f"Error reading file {fname}: {str(e)}", exc_info=True)
-            return {"error": str(e)}
 
-    async def writeFile(fname, data, encoding, flag, mode):
-        try:
-            fname = resolve_path(fname)
-            logger.debug(f"Writing file: {fname}, encoding: {encoding}, flag: {flag}, mode: {mode}")
-            
-            # Convert mode from decimal to octal if it's a number
-            if isinstance(mode, int):
-                mode = oct(mode)[2:]  # Convert to octal string without '0o' prefix
-                mode = int(mode, 8)  # Convert back to int in octal
-                logger.debug(f"Converted mode to octal: {oct(mode)}")
+def plan_tree_removal(path):
+    """Walk ``path`` with scandir and list what removing it involves.
 
-            # Create parent directory if it doesn't exist
-            dirname = os.path.dirname(fname)
-            if dirname:
-                try:
-                    os.makedirs(dirname, exist_ok=True)
-                except Exception as e:
-                    logger.error(f"Failed to create directory {dirname}: {str(e)}")
-            
-            py_encoding = js_encoding_to_python(encoding)
-            py_mode = js_flag_to_python_mode(flag)
-            
-            logger.debug(f"Python mode: {py_mode}, encoding: {py_encoding}")
-            
-            # Handle binary vs text mode
-            try:
-                if py_encoding is None:
-                    if isinstance(data, str):
-                        data = data.encode()
-                    async with aiofiles.open(fname, mode=f"{py_mode}b") as f:
-                        await f.write(data)
+    Returns:
+        tuple: ``(files, directories)`` where files include symlinks and
+        directories are in bottom-up order.
+    """
+    if not stat_module.S_ISDIR(os.lstat(path).st_mode):
+        return [path], []
+    files = []
+    directories = [path]
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                    stack.append(entry.path)
                 else:
-                    async with aiofiles.open(fname, mode=py_mode, encoding=py_encoding) as f:
-                        await f.write(data)
-                
-                # Set mode after file is created
-                if mode is not None:
-                    os.chmod(fname, mode)
-                    
-                logger.debug(f"Successfully wrote file: {fname}")
-                return {"success": True}
-            except Exception as e:
-                error_msg = f"Failed to write file {fname}: {str(e)}"
-                logger.error(error_msg, exc_info=True)
-                return {"error": error_msg}
-        except Exception as e:
-            error_msg = f"Error in writeFile {fname}: {str(e)}"
-            logger.error(error_msg, exc_info=True)
-            return {"error": error_msg}
+                    files.append(entry.path)
+    directories.reverse()
+    return files, directories
 
-    async def appendFile(fname, data, encoding, flag, mode):
-        try:
-            fname = resolve_path(fname)
-            py_encoding = js_encoding_to_python(encoding)
-            py_mode = js_flag_to_python_mode(flag) if flag else 'a'
-            
-            if py_encoding is None:
-                if isinstance(data, str):
-                    data = data.encode()
-                async with aiofiles.open(fname, mode=f"{py_mode}b") as f:
-                    await f.write(data)
-            else:
-                async with aiofiles.open(fname, mode=py_mode, encoding=py_encoding) as f:
-                    await f.write(data)
-            
-            if mode is not None:
-                os.chmod(fname, mode)
-                
-            return {"success": True}
-        except Exception as e:
-            return {"error": str(e)}
+def unlink_files(paths):
+    """Unlink ``paths``, ignoring those already gone.
 
-    async def symlink(srcpath, dstpath, type):
-        srcpath = resolve_path(srcpath)
-        dstpath = resolve_path(dstpath)
+    Returns:
+        list: ``(path, error)`` pairs of the files that could not be removed.
+    """
+    failed = []
+    for p in paths:
         try:
-            os.symlink(srcpath, dstpath, target_is_directory=(type == 'dir'))
+            os.unlink(p)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            failed.append((p, str(e)))
+    return failed
+
+def remove_if_exists(p):
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(p)
+
+
+def is_compressed_file(name):
+    """Guess from the file name whether its content is already compressed."""
+    mime_type, encoding = mimetypes.guess_type(name)
+    if encoding is not None:
+        return True
+    return mime_type is not None and (
+        mime_type in ARCHIVE_STORED_MIME_TYPES or mime_type.startswith(ARCHIVE_STORED_MIME_PREFIXES)
+    )
+
+def transfer_codecs():
+    """The transfer compression codecs available on this server."""
+    return [codec for codec in TRANSFER_CODEC_LEVELS if codec != "zstd" or zstandard is not None]
+
+def negotiate_codec(compression):
+    """Resolve a client's ``compression`` preference to the ``(codec, level)`` to use.
+
+    ``compression`` is ``True`` or ``"auto"`` (any codec), a codec name, a
+    list of codec names in order of preference, or a dict of codec names to
+    levels (``None`` for the default level). Returns ``(None, None)`` if no
+    accepted codec is available.
+    """
+    if not compression:
+        return None, None
+    if compression is True or compression == "auto":
+        compression = transfer_codecs()
+    elif isinstance(compression, str):
+        compression = [compression]
+    preferences = compression if isinstance(compression, dict) else dict.fromkeys(compression)
+    available = transfer_codecs()
+    for codec, level in preferences.items():
+        if codec in available:
+            return codec, level
+    return None, None
+
+def compress_payload(data, codec, level=None):
+    if level is None:
+        level = TRANSFER_CODEC_LEVELS[codec]
+    if codec == "zlib":
+        return zlib.compress(data, level)
+    if codec == "lzma":
+        return lzma.compress(data, preset=level)
+    if codec == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError(f"Unsupported compression: {codec}")
+
+def decompress_payload(data, codec, max_size=None):
+    """Decompress a payload; more than ``max_size`` bytes of output raise ``ValueError``."""
+    limit = None if max_size is None else max_size + 1
+    if codec == "zlib":
+        result = zlib.decompress(data) if limit is None else zlib.decompressobj().decompress(data, limit)
+    elif codec == "lzma":
+        result = lzma.LZMADecompressor().decompress(data, -1 if limit is None else limit)
+    elif codec == "zstd" and zstandard is not None:
+        # A stream reader also handles frames without a content size
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            result = reader.read(-1 if limit is None else limit)
+    else:
+        raise ValueError(f"Unsupported compression: {codec}")
+    if max_size is not None and len(result) > max_size:
+        raise ValueError(f"Decompressed payload exceeds {max_size} bytes")
+    return result
+
+def worth_compressing(data, name, codec):
+    """Whether a payload of file ``name`` is worth compressing with ``codec``.
+
+    Small payloads and files whose type is already compressed are not; for
+    the others, the first ``COMPRESSION_PROBE_SIZE`` bytes are compressed at
+    the fastest level and must shrink below ``COMPRESSION_MAX_RATIO``.
+    """
+    if len(data) < COMPRESSION_MIN_SIZE or is_compressed_file(name):
+        return False
+    probe = memoryview(data)[:COMPRESSION_PROBE_SIZE]
+    return len(compress_payload(probe, codec, COMPRESSION_PROBE_LEVELS[codec])) < len(probe) * COMPRESSION_MAX_RATIO
+
+def encode_payload(data, name, codec, level=None):
+    """Compress ``data`` of file ``name`` with ``codec`` if it is worth it.
+
+    Returns:
+        dict: ``{"codec": str or None, "data": bytes, "size": int}``, ``size``
+        being the uncompressed length.
+    """
+    if codec is not None and worth_compressing(data, name, codec):
+        return {"codec": codec, "data": compress_payload(data, codec, level), "size": len(data)}
+    return {"codec": None, "data": data, "size": len(data)}
+
+class ChunkWriter:
+    """Non-seekable file object passing what is written to ``emit`` in fixed-size chunks."""
+
+    def __init__(self, emit, chunk_size):
+        self._emit = emit
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._chunk_size:
+            self._emit(bytes(self._buffer[:self._chunk_size]))
+            del self._buffer[:self._chunk_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._buffer:
+            self._emit(bytes(self._buffer))
+            self._buffer.clear()
+
+def write_archive(fileobj, sources, fmt="zip"):
+    """Write ``sources`` (``(path, arcname)`` pairs) as a zip or tar.gz archive to ``fileobj``.
+
+    ``fileobj`` does not need to be seekable, so the archive can be streamed
+    while it is generated. Zip members switch to ZIP64 as needed and
+    already-compressed files are stored without compression. Symlinks are
+    not followed.
+    """
+    if fmt == "zip":
+        archive = zipfile.ZipFile(fileobj, mode="w", compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        add_file = lambda path, arcname: archive.write(
+            path, arcname,
+            compress_type=zipfile.ZIP_STORED if is_compressed_file(arcname) else zipfile.ZIP_DEFLATED,
+        )
+        add_directory = lambda path, arcname: archive.write(path, arcname)
+    elif fmt in ("tar.gz", "tgz"):
+        archive = tarfile.open(fileobj=fileobj, mode="w|gz")
+        add_file = add_directory = lambda path, arcname: archive.add(path, arcname, recursive=False)
+    else:
+        raise ValueError(f"Unsupported archive format: {fmt}")
+    with archive:
+        for path, arcname in sources:
+            directories, files, _symlinks = plan_tree_copy(path, arcname)
+            for src_dir, dir_arcname, _ in directories:
+                add_directory(src_dir, dir_arcname)
+            for src_file, file_arcname, _ in files:
+                add_file(src_file, file_arcname)
+
+
+def render_thumbnail(src, dst, size):
+    """Decode an image, shrink it to fit ``size`` x ``size`` and save it as PNG to ``dst``.
+
+    Runs in the thumbnail process pool.
+    """
+    with Image.open(src) as img:
+        # Let the JPEG decoder downscale while decoding
+        img.draft("RGB", (size, size))
+        img.thumbnail((size, size))
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        tmp_path = f"{dst}.{os.getpid()}.tmp"
+        img.save(tmp_path, "PNG")
+    os.replace(tmp_path, dst)
+    with open(dst, "rb") as f:
+        return f.read()
+
+def prune_thumbnail_cache(directory, max_bytes, max_age):
+    """Delete cached thumbnails unused for ``max_age`` seconds, then the least recently used beyond ``max_bytes``.
+
+    A thumbnail's mtime is its last use. Temporary files of renders still
+    running are left alone.
+
+    Returns:
+        tuple: ``(removed, remaining_bytes)``
+    """
+    now = time.time()
+    entries = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    stats = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if not stat_module.S_ISREG(stats.st_mode):
+                    continue
+                if entry.name.endswith(".tmp") and now - stats.st_mtime < THUMBNAIL_PRUNE_INTERVAL:
+                    continue
+                entries.append((stats.st_mtime, stats.st_size, entry.path))
+    except FileNotFoundError:
+        return 0, 0
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for mtime, size, path in entries:
+        if now - mtime <= max_age and total <= max_bytes:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        total -= size
+        removed += 1
+    return removed, total
+
+
+def sweep_trash_directory(directory):
+    """Create the trash directory and list the trees an earlier run left in it."""
+    os.makedirs(directory, exist_ok=True)
+    return [os.path.join(directory, name) for name in os.listdir(directory)]
+
+
+def sweep_upload_directory(directory, max_age):
+    """Delete the files staged in ``directory`` that were not written to for ``max_age`` seconds.
+
+    Upload sessions do not survive a restart, but other processes serving the
+    same root may still be writing to the newer files.
+    """
+    cutoff = time.time() - max_age
+    with contextlib.suppress(FileNotFoundError), os.scandir(directory) as it:
+        for entry in it:
+            with contextlib.suppress(FileNotFoundError):
+                if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    os.unlink(entry.path)
+
+
+def hash_file(path, algorithm):
+    """Hash a file in fixed-size blocks read into one reused buffer.
+
+    The file is not memory mapped, as a map faults (SIGBUS) if the file is
+    truncated while it is hashed.
+
+    Returns:
+        tuple: ``(hexdigest, stat_key)`` where ``stat_key`` is
+        ``(st_dev, st_ino, st_size, st_mtime_ns)`` if the file did not change
+        while it was hashed, else ``None``.
+    """
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(HASH_BLOCK_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        before = os.fstat(f.fileno())
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+        after = os.fstat(f.fileno())
+    key = (after.st_dev, after.st_ino, after.st_size, after.st_mtime_ns)
+    if key != (before.st_dev, before.st_ino, before.st_size, before.st_mtime_ns):
+        key = None
+    return digest.hexdigest(), key
+
+
+def add_range(ranges, start, end):
+    """Insert ``[start, end)`` into a sorted list of disjoint ranges, merging overlaps."""
+    merged = []
+    for range_start, range_end in ranges:
+        if range_end < start or range_start > end:
+            merged.append((range_start, range_end))
+        else:
+            start, end = min(start, range_start), max(end, range_end)
+    merged.append((start, end))
+    merged.sort()
+    return merged
+
+def preallocate(fd, size):
+    """Reserve ``size`` bytes for a file, falling back to a sparse truncate."""
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (OSError, AttributeError):
+        os.ftruncate(fd, size)
+
+
+def stat_entries(entries):
+    """Stat ``os.DirEntry`` objects, returning ``(name, stat_result)`` rows.
+
+    Entries that cannot be stat'ed (e.g. broken symlinks) are skipped.
+    """
+    rows = []
+    for entry in entries:
+        try:
+            rows.append((entry.name, entry.stat()))
+        except OSError:
+            continue
+    return rows
+
+
+def stats_to_columns(rows, fields, guess_mime):
+    """Encode ``(name, stat_result)`` rows as a columnar listing.
+
+    Each field becomes one little-endian typed array (sent as bytes) whose
+    i-th element belongs to ``names[i]``; times are in milliseconds. The
+    ``mime`` column holds indexes into the ``mimes`` table, so each mime
+    type is sent once per listing.
+    """
+    fields = list(LISTING_DEFAULT_COLUMNS if fields is None else fields)
+    unknown = [field for field in fields if field not in LISTING_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unsupported listing fields: {', '.join(unknown)}")
+    names = []
+    mimes = []
+    mime_ids = {}
+    columns = {field: array.array(LISTING_COLUMNS[field][0]) for field in fields}
+    getters = [(columns[field], LISTING_COLUMNS[field][2]) for field in fields if field != "mime"]
+    mime_column = columns.get("mime")
+    for name, st in rows:
+        names.append(name)
+        for column, getter in getters:
+            column.append(getter(st))
+        if mime_column is not None:
+            mime = "directory" if stat_module.S_ISDIR(st.st_mode) else guess_mime(name)
+            mime_id = mime_ids.get(mime)
+            if mime_id is None:
+                mime_id = mime_ids[mime] = len(mimes)
+                mimes.append(mime)
+            mime_column.append(mime_id)
+    if sys.byteorder == "big":
+        for column in columns.values():
+            column.byteswap()
+    return {
+        "format": "columns",
+        "count": len(names),
+        "names": names,
+        "types": {field: LISTING_COLUMNS[field][1] for field in fields},
+        "columns": {field: column.tobytes() for field, column in columns.items()},
+        "mimes": mimes,
+    }
+
+
+class ContentCache:
+    """Byte-budgeted LRU cache of file contents, used by ``readFile``.
+
+    Files of up to ``max_file_size`` bytes are kept in memory, at most
+    ``max_bytes`` in total; larger ones are not cached. Each lookup is validated
+    against the file's current ``(st_ino, st_size, st_mtime_ns)``, and the
+    service invalidates the paths it writes to.
+    """
+
+    def __init__(self, max_bytes, max_file_size):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # path -> (validator, bytes)
+        self._bytes = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, path, stats):
+        """Return the cached contents of ``path`` if they match ``stats``, else ``None``."""
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == content_validator(stats):
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            self.invalidate(path)
+        self.misses += 1
+        return None
+
+    def put(self, path, validator, content):
+        """Cache ``content`` read while the file matched ``validator``."""
+        if not self.enabled:
+            return
+        self.invalidate(path)
+        if len(content) > self.max_file_size:
+            return
+        self._entries[path] = (validator, content)
+        self._bytes += len(content)
+        while self._bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "bytes": self._bytes,
+            "maxBytes": self.max_bytes,
+            "maxFileSize": self.max_file_size,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+class DirectorySizeCache:
+    """Thread-safe LRU of per-directory subtotals, validated by directory mtime.
+
+    A subtotal covers only the directory's direct entries: regular files
+    (``bytes``, ``files``), hard-linked files by ``(st_dev, st_ino)`` so
+    they can be counted once per tree, and the list of subdirectories. A
+    directory's mtime changes when entries are added, removed or renamed,
+    but not when a file inside grows, so in-place size changes are picked up
+    only once the directory itself changes.
+    """
+
+    def __init__(self, maxsize=DIRSIZE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def scan(self, directory):
+        """Return the subtotal of a directory, rescanning it only if its mtime changed."""
+        mtime_ns = os.stat(directory).st_mtime_ns
+        with self._lock:
+            record = self._entries.get(directory)
+            if record is not None and record["mtime_ns"] == mtime_ns:
+                self._entries.move_to_end(directory)
+                self.hits += 1
+                return record
+            self.misses += 1
+        record = {"mtime_ns": mtime_ns, "bytes": 0, "files": 0, "linked": {}, "subdirs": []}
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        record["subdirs"].append(entry.path)
+                        continue
+                    stats = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if stats.st_nlink > 1 and not entry.is_symlink():
+                    record["linked"][(stats.st_dev, stats.st_ino)] = stats.st_size
+                else:
+                    record["bytes"] += stats.st_size
+                    record["files"] += 1
+        with self._lock:
+            self._entries[directory] = record
+            self._entries.move_to_end(directory)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return record
+
+
+def inotify_watch_limit(configured=None):
+    """The inotify watches the service may use: ``configured``, else the user's limit."""
+    if configured is not None:
+        return configured
+    try:
+        with open("/proc/sys/fs/inotify/max_user_watches") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 8192
+
+
+def inotify_watch_budget(configured=None):
+    """Split the inotify watches the service may use between its users.
+
+    Returns:
+        dict: Maximum watches per user of inotify, keyed as ``INOTIFY_WATCH_SHARES``.
+    """
+    total = inotify_watch_limit(configured)
+    return {name: max(int(total * share), 1) for name, share in INOTIFY_WATCH_SHARES.items()}
+
+class InotifyWatcher:
+    """Minimal ctypes binding to Linux inotify, delivering events on the asyncio loop.
+
+    The callback is invoked as ``callback(directory, name, mask, cookie)``;
+    ``name`` is ``None`` for events on the watched directory itself,
+    ``directory`` is ``None`` when the kernel event queue overflowed, and
+    ``cookie`` pairs the ``IN_MOVED_FROM`` and ``IN_MOVED_TO`` halves of a
+    rename.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    DIRECTORY_EVENTS = (
+        IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    )
+
+    _EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, callback, max_watches=None):
+        self.max_watches = max_watches
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._callback = callback
+        self._paths = {}  # watch descriptor -> directory
+        self._wds = {}  # directory -> watch descriptor
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self._fd, self._read_events)
+
+    @classmethod
+    def create(cls, callback, max_watches=None):
+        """Return a watcher, or ``None`` if inotify is unavailable on this platform."""
+        try:
+            return cls(callback, max_watches)
+        except (OSError, AttributeError, RuntimeError, NotImplementedError) as e:
+            logger.info(f"inotify unavailable, falling back to mtime checks: {str(e)}")
+            return None
+
+    def __len__(self):
+        return len(self._wds)
+
+    def add_watch(self, directory, mask=DIRECTORY_EVENTS):
+        """Watch a directory; raises OSError if the watch could not be added.
+
+        Beyond ``max_watches`` watches this fails with ENOSPC, like reaching
+        the kernel's per-user limit.
+        """
+        if directory in self._wds:
+            return
+        if self.max_watches is not None and len(self._wds) >= self.max_watches:
+            raise OSError(errno.ENOSPC, "inotify watch budget exhausted", directory)
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), mask | self.IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), directory)
+        self._paths[wd] = directory
+        self._wds[directory] = wd
+
+    def remove_watch(self, directory):
+        wd = self._wds.pop(directory, None)
+        if wd is not None:
+            self._paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def close(self):
+        self._loop.remove_reader(self._fd)
+        os.close(self._fd)
+        self._paths.clear()
+        self._wds.clear()
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = self._EVENT_HEADER.unpack_from(data, pos)
+            pos += self._EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b"\0")
+            pos += length
+            if mask & self.IN_Q_OVERFLOW:
+                self._callback(None, None, mask, cookie)
+                continue
+            directory = self._paths.get(wd)
+            if directory is None:
+                continue
+            if mask & self.IN_IGNORED:
+                # The kernel dropped the watch (directory deleted or unmounted)
+                self._paths.pop(wd, None)
+                self._wds.pop(directory, None)
+            self._callback(directory, os.fsdecode(name) if name else None, mask, cookie)
+
+
+class MetadataCache:
+    """Bounded LRU cache for stat results, directory listings and mime guesses.
+
+    Entries are keyed by ``(kind, path)``. Each cached path is tied to the
+    directory whose changes can invalidate it (the path itself for listings
+    and directory stats, its parent otherwise). With inotify those
+    directories are watched and entries are dropped as events arrive.
+    Without inotify, listings and directory stats are validated against the
+    directory mtime and other entries expire after ``fallback_ttl`` seconds.
+    """
+
+    LISTING_KINDS = ("readdir", "readdirwithstats")
+
+    def __init__(self, maxsize, fallback_ttl=1.0, use_inotify=True, max_watches=None):
+        self.maxsize = maxsize
+        self.fallback_ttl = fallback_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.watch_failures = 0  # Entries left uncached as no inotify watch was left
+        self._entries = OrderedDict()  # (kind, path) -> (value, directory, weight, validator)
+        self._by_directory = {}  # directory -> set of keys
+        self._mimes = OrderedDict()  # file name suffix -> mime type
+        self._weight = 0
+        self._watcher = InotifyWatcher.create(self._on_event, max_watches) if use_inotify else None
+
+    def get(self, kind, path):
+        """Return the cached value, or ``None`` on a miss."""
+        key = (kind, path)
+        entry = self._entries.get(key)
+        if entry is not None and self._is_valid(entry, path):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry is not None:
+            self._discard(key)
+        self.misses += 1
+        return None
+
+    def put(self, kind, path, value, weight=1, is_directory=False):
+        """Cache ``value``; ``is_directory`` marks the stat of a directory.
+
+        A directory's mtime and size change when entries are created inside
+        it, which raises no event on its parent's watch, so such stats are
+        tied to the directory itself like its listings.
+        """
+        if self.maxsize <= 0 or weight > self.maxsize:
+            return
+        own_directory = kind in self.LISTING_KINDS or is_directory
+        directory = path if own_directory else os.path.dirname(path)
+        if self._watcher is not None:
+            try:
+                self._watcher.add_watch(directory)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    if not self.watch_failures:
+                        logger.warning(f"Out of inotify watches ({len(self._watcher)} in use), "
+                                       f"the metadata cache skips directories it cannot watch")
+                    self.watch_failures += 1
+                return
+            validator = None
+        elif own_directory:
+            try:
+                validator = os.stat(path).st_mtime_ns
+            except OSError:
+                return
+        else:
+            validator = time.monotonic() + self.fallback_ttl
+        key = (kind, path)
+        self._discard(key)
+        self._entries[key] = (value, directory, weight, validator)
+        self._by_directory.setdefault(directory, set()).add(key)
+        self._weight += weight
+        while self._weight > self.maxsize:
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    def guess_mime(self, name):
+        """Cached ``mimetypes.guess_type`` keyed by the file name's suffixes."""
+        dot = name.find(".", 1)
+        suffix = name[dot:] if dot > 0 else name
+        mime_type = self._mimes.get(suffix)
+        if mime_type is not None:
+            self._mimes.move_to_end(suffix)
+            self.hits += 1
+            return mime_type
+        self.misses += 1
+        mime_type, _ = mimetypes.guess_type(name)
+        mime_type = mime_type or "application/octet-stream"
+        self._mimes[suffix] = mime_type
+        if len(self._mimes) > max(self.maxsize, 1):
+            self._mimes.popitem(last=False)
+        return mime_type
+
+    def invalidate(self, path, ancestors=False):
+        """Drop everything cached for a path, its subtree and its parent directory.
+
+        With ``ancestors`` the entries of every parent directory are dropped as
+        well, for calls that may create intermediate directories.
+        """
+        self.invalidations += 1
+        self._invalidate_directory(path, recursive=True)
+        parent = os.path.dirname(path)
+        self._invalidate_directory(parent, recursive=False, name=os.path.basename(path))
+        while ancestors and parent != os.path.dirname(parent):
+            child, parent = parent, os.path.dirname(parent)
+            self._invalidate_directory(parent, recursive=False, name=os.path.basename(child))
+
+    def clear(self):
+        for key in list(self._entries):
+            self._discard(key)
+
+    def close(self):
+        """Stop watching directories; the cache then validates entries by mtime and TTL."""
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "mode": "inotify" if self._watcher is not None else "mtime",
+            "size": self._weight,
+            "maxsize": self.maxsize,
+            "entries": len(self._entries),
+            "watches": len(self._watcher) if self._watcher is not None else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "watchFailures": self.watch_failures,
+        }
+
+    def prometheus(self):
+        """Render cache statistics in the Prometheus text exposition format."""
+        lines = []
+        for metric, kind, help_text, value in (
+            ("asyncfs_metadata_cache_hits_total", "counter", "Metadata cache hits.", self.hits),
+            ("asyncfs_metadata_cache_misses_total", "counter", "Metadata cache misses.", self.misses),
+            ("asyncfs_metadata_cache_watches", "gauge", "inotify watches held by the metadata cache.",
+             len(self._watcher) if self._watcher is not None else 0),
+            ("asyncfs_metadata_cache_watch_failures_total", "counter",
+             "Metadata cache entries not cached as no inotify watch was left.", self.watch_failures),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _is_valid(self, entry, path):
+        # The validator is None under inotify, a directory mtime (int, ns) for
+        # listings, or an expiry deadline (float, monotonic seconds) otherwise
+        validator = entry[3]
+        if validator is None:
+            return True
+        if isinstance(validator, float):
+            return time.monotonic() < validator
+        try:
+            return os.stat(path).st_mtime_ns == validator
+        except OSError:
+            return False
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        directory = entry[1]
+        self._weight -= entry[2]
+        keys = self._by_directory.get(directory)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_directory[directory]
+                if self._watcher is not None:
+                    self._watcher.remove_watch(directory)
+
+    def _invalidate_directory(self, directory, recursive, name=None):
+        """Drop the listings of a directory and the entries of one (or all) of its children."""
+        prefix = directory.rstrip("/") + "/"
+        targets = [directory]
+        if recursive:
+            targets += [d for d in self._by_directory if d.startswith(prefix)]
+        for target in targets:
+            for key in list(self._by_directory.get(target, ())):
+                if (key[0] in self.LISTING_KINDS or recursive or name is None
+                        or key[1] == directory or key[1] == prefix + name):
+                    self._discard(key)
+        # Entries about the directory's name (exists, realpath) are cached under its parent
+        parent = os.path.dirname(directory)
+        for key in list(self._by_directory.get(parent, ())):
+            if key[1] == directory and key[0] not in self.LISTING_KINDS:
+                self._discard(key)
+
+    def _on_event(self, directory, name, mask, cookie):
+        if directory is None:
+            logger.warning("inotify event queue overflowed, clearing metadata cache")
+            self.clear()
+            return
+        self.invalidations += 1
+        if name is None:
+            # The watched directory itself was deleted, moved or had its attributes changed
+            recursive = bool(mask & (InotifyWatcher.IN_DELETE_SELF | InotifyWatcher.IN_MOVE_SELF | InotifyWatcher.IN_IGNORED))
+            self._invalidate_directory(directory, recursive=recursive)
+        else:
+            self._invalidate_directory(directory, recursive=False, name=name)
+            if mask & InotifyWatcher.IN_ISDIR:
+                self._invalidate_directory(os.path.join(directory, name), recursive=True)
+
+
+class FileIndex:
+    """Persistent SQLite index of file names and metadata under a root directory.
+
+    The index is filled by a background scandir crawl and kept current through
+    inotify and :meth:`refresh` (called for the service's own mutations).
+    After a restart only directories whose mtime changed are rescanned.
+    Substring and glob name searches use an FTS5 trigram index where SQLite
+    supports it.
+    """
+
+    # Events that change names, sizes or mtimes; IN_MODIFY is left out as it
+    # fires on every write() and IN_CLOSE_WRITE covers it
+    WATCH_EVENTS = (
+        InotifyWatcher.IN_ATTRIB | InotifyWatcher.IN_CLOSE_WRITE | InotifyWatcher.IN_MOVED_FROM
+        | InotifyWatcher.IN_MOVED_TO | InotifyWatcher.IN_CREATE | InotifyWatcher.IN_DELETE
+    )
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            parent TEXT NOT NULL,
+            name TEXT NOT NULL,
+            is_dir INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            mime TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_parent ON entries(parent);
+        CREATE INDEX IF NOT EXISTS entries_mime ON entries(mime);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS names USING fts5(
+            name, content='entries', content_rowid='id', tokenize='trigram'
+        );
+        CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+            INSERT INTO names(rowid, name) VALUES (new.id, new.name);
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+            INSERT INTO names(names, rowid, name) VALUES ('delete', old.id, old.name);
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_au AFTER UPDATE OF name ON entries BEGIN
+            INSERT INTO names(names, rowid, name) VALUES ('delete', old.id, old.name);
+            INSERT INTO names(rowid, name) VALUES (new.id, new.name);
+        END;
+    """
+
+    # Entries written per crawl step before yielding to other index updates
+    CRAWL_BATCH = 5000
+    # Seconds to wait for more changes before applying queued refreshes
+    REFRESH_DELAY = 0.2
+
+    def __init__(self, root, db_path, excluded=(), max_watches=None):
+        self.root = root
+        self.db_path = db_path
+        self.max_watches = max_watches
+        self.excluded = tuple(excluded)  # Absolute paths whose subtrees are not indexed
+        self._crawl_task = None
+        self._recrawl = False
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-writer")
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-reader")
+        self._write_db = None
+        self._read_db = None
+        self._fts = False
+        self._watcher = None
+        self._pending = set()
+        self._flush_handle = None
+        self._tasks = set()
+
+    async def start(self):
+        """Open the database and start the background crawl."""
+        loop = asyncio.get_running_loop()
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        await loop.run_in_executor(self._writer, self._open_writer)
+        await loop.run_in_executor(self._reader, self._open_reader)
+        self._watcher = InotifyWatcher.create(self._on_event, self.max_watches)
+        self._start_crawl()
+
+    async def close(self):
+        """Stop crawling and watching, and close the database."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for task in [self._crawl_task, *self._tasks]:
+            if task is not None:
+                task.cancel()
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+        loop = asyncio.get_running_loop()
+        for executor, attr in ((self._writer, "_write_db"), (self._reader, "_read_db")):
+            db = getattr(self, attr)
+            setattr(self, attr, None)
+            if db is not None:
+                await loop.run_in_executor(executor, db.close)
+            executor.shutdown(wait=False)
+
+    @property
+    def crawling(self):
+        return self._crawl_task is not None and not self._crawl_task.done()
+
+    def refresh(self, path):
+        """Queue a path (and its subtree) to be re-read into the index."""
+        if self._write_db is None:
+            return
+        self._pending.add(path)
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.REFRESH_DELAY, self._flush)
+
+    async def search(self, query, path=None, mimes=None, limit=100, cursor=None):
+        """Search names by substring, or by glob pattern if ``query`` contains ``*?[``.
+
+        Returns:
+            tuple: ``(rows, next_cursor)`` where rows are
+            ``(path, name, is_dir, size, mtime, mime)`` with paths relative to the root.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._reader, self._search, query, path, mimes, limit, cursor
+        )
+
+    async def status(self):
+        def count():
+            return self._read_db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+        return {
+            "entries": await asyncio.get_running_loop().run_in_executor(self._reader, count),
+            "crawling": self.crawling,
+            "watches": len(self._watcher) if self._watcher is not None else 0,
+            "fts": self._fts,
+            "path": self.db_path,
+        }
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _open_writer(self):
+        db = sqlite3.connect(self.db_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(self.SCHEMA)
+        try:
+            db.executescript(self.FTS_SCHEMA)
+            self._fts = True
+        except sqlite3.OperationalError as e:
+            logger.info(f"FTS5 trigram index unavailable, searches will scan: {str(e)}")
+        stored_root = db.execute("SELECT value FROM meta WHERE key = 'root'").fetchone()
+        if stored_root is not None and stored_root[0] != self.root:
+            # The database was built for another root directory
+            db.execute("DELETE FROM entries")
+            db.execute("DELETE FROM meta")
+        db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('root', ?)", (self.root,))
+        db.commit()
+        self._write_db = db
+
+    def _open_reader(self):
+        self._read_db = sqlite3.connect(self.db_path, check_same_thread=False)
+        # SQLite's lower() only folds ASCII
+        self._read_db.create_function("py_lower", 1, str.lower, deterministic=True)
+
+    def _rel(self, path):
+        rel_path = os.path.relpath(path, self.root)
+        return "" if rel_path == "." else rel_path.replace(os.path.sep, "/")
+
+    def _row(self, rel_path, name, stats):
+        is_dir = stat_module.S_ISDIR(stats.st_mode)
+        if is_dir:
+            mime = "directory"
+        else:
+            mime = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        parent = rel_path.rpartition("/")[0]
+        return (rel_path, parent, name, int(is_dir), stats.st_size, stats.st_mtime, mime)
+
+    def _upsert(self, rows):
+        self._write_db.executemany(
+            """INSERT INTO entries(path, parent, name, is_dir, size, mtime, mime)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(path) DO UPDATE SET
+                   is_dir = excluded.is_dir, size = excluded.size,
+                   mtime = excluded.mtime, mime = excluded.mime""",
+            rows,
+        )
+
+    def _delete_subtree(self, rel_path):
+        self._write_db.execute(
+            "DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)",
+            (rel_path, rel_path + "/", rel_path + "0"),
+        )
+
+    def _index_directory(self, directory, recursive):
+        """Re-read one directory; returns the subdirectories still to visit and the entry count.
+
+        Children that disappeared are dropped with their subtrees. Without
+        ``recursive`` only newly found subdirectories are returned.
+        """
+        rel_dir = self._rel(directory)
+        prefix = rel_dir + "/" if rel_dir else ""
+        rows, subdirs, names = [], [], set()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.path in self.excluded:
+                        continue
+                    try:
+                        stats = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    names.add(entry.name)
+                    rows.append(self._row(prefix + entry.name, entry.name, stats))
+                    if stat_module.S_ISDIR(stats.st_mode):
+                        subdirs.append(entry.path)
+        except (FileNotFoundError, NotADirectoryError):
+            self._delete_subtree(rel_dir)
+            return [], 0
+        known = {
+            name for (name,) in self._write_db.execute("SELECT name FROM entries WHERE parent = ?", (rel_dir,))
+        }
+        for name in known - names:
+            self._delete_subtree(prefix + name)
+        self._upsert(rows)
+        if not recursive:
+            subdirs = [d for d in subdirs if os.path.basename(d) not in known]
+        return subdirs, len(rows)
+
+    def _crawl_step(self, stack, recursive):
+        """Index directories from ``stack`` until a batch worth of entries is written."""
+        visited = []
+        written = 0
+        while stack and written < self.CRAWL_BATCH:
+            directory = stack.pop()
+            new_dirs, count = self._index_directory(directory, recursive)
+            visited.append(directory)
+            stack.extend(new_dirs)
+            written += count + 1
+        self._write_db.commit()
+        return visited
+
+    def _stale_directories(self):
+        """Directories whose mtime differs from the indexed one, plus the root."""
+        stale = [self.root]
+        for rel_path, mtime in self._write_db.execute("SELECT path, mtime FROM entries WHERE is_dir = 1").fetchall():
+            directory = os.path.join(self.root, rel_path)
+            try:
+                if os.stat(directory).st_mtime != mtime:
+                    stale.append(directory)
+            except OSError:
+                stale.append(directory)
+        return stale
+
+    def _start_crawl(self):
+        if self.crawling:
+            # Let the running crawl go over changed directories again when done
+            self._recrawl = True
+            return
+        self._crawl_task = self._spawn(self._crawl())
+
+    async def _crawl(self):
+        while True:
+            self._recrawl = False
+            await self._crawl_once()
+            if not self._recrawl:
+                break
+
+    async def _crawl_once(self):
+        loop = asyncio.get_running_loop()
+        try:
+            complete = await loop.run_in_executor(
+                self._writer,
+                lambda: self._write_db.execute("SELECT value FROM meta WHERE key = 'complete'").fetchone(),
+            )
+            if complete is None:
+                logger.info(f"Building file index for {self.root}")
+                stack, recursive = [self.root], True
+            else:
+                stack = await loop.run_in_executor(self._writer, self._stale_directories)
+                recursive = False
+                logger.info(f"Updating file index, {len(stack)} directories changed")
+            # Watches are added for every directory, changed or not
+            if self._watcher is not None and not recursive:
+                all_dirs = await loop.run_in_executor(
+                    self._writer,
+                    lambda: [os.path.join(self.root, p) for (p,) in
+                             self._write_db.execute("SELECT path FROM entries WHERE is_dir = 1")],
+                )
+                self._add_watches([self.root] + all_dirs)
+            while stack:
+                visited = await loop.run_in_executor(self._writer, self._crawl_step, stack, recursive)
+                self._add_watches(visited)
+            await loop.run_in_executor(self._writer, self._mark_complete)
+            logger.info("File index is up to date")
+        except Exception as e:
+            logger.error(f"File index crawl failed: {str(e)}", exc_info=True)
+
+    def _mark_complete(self):
+        self._write_db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('complete', '1')")
+        self._write_db.commit()
+
+    def _add_watches(self, directories):
+        if self._watcher is None:
+            return
+        for directory in directories:
+            try:
+                self._watcher.add_watch(directory, self.WATCH_EVENTS)
+            except OSError as e:
+                if e.errno != errno.ENOSPC:
+                    # Most likely removed since it was listed
+                    continue
+                logger.warning("inotify watch limit reached, index updates now rely on service calls")
+                self._watcher.close()
+                self._watcher = None
+                return
+
+    def _on_event(self, directory, name, mask, cookie):
+        if directory is None:
+            # Events were lost: rescan every directory that changed
+            self._start_crawl()
+        elif name is not None:
+            self.refresh(os.path.join(directory, name))
+
+    def _flush(self):
+        self._flush_handle = None
+        paths, self._pending = self._pending, set()
+        self._spawn(self._apply_refresh(paths))
+
+    async def _apply_refresh(self, paths):
+        loop = asyncio.get_running_loop()
+        try:
+            stack = await loop.run_in_executor(self._writer, self._refresh_paths, paths)
+            while stack:
+                visited = await loop.run_in_executor(self._writer, self._crawl_step, stack, True)
+                self._add_watches(visited)
+        except Exception as e:
+            logger.error(f"File index refresh failed: {str(e)}", exc_info=True)
+
+    def _refresh_paths(self, paths):
+        """Update the rows of changed paths; returns new directories to crawl."""
+        stack = []
+        for path in paths:
+            rel_path = self._rel(path)
+            if not rel_path or rel_path.startswith("..") or self._is_excluded(path):
+                continue
+            try:
+                stats = os.lstat(path)
+            except OSError:
+                self._delete_subtree(rel_path)
+                continue
+            # Make sure parents created together with the path are indexed too
+            rows = [self._row(rel_path, os.path.basename(path), stats)]
+            parent = os.path.dirname(path)
+            while parent != self.root and parent.startswith(self.root):
+                try:
+                    rows.append(self._row(self._rel(parent), os.path.basename(parent), os.lstat(parent)))
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+            self._upsert(rows)
+            if stat_module.S_ISDIR(stats.st_mode):
+                stack.append(path)
+        self._write_db.commit()
+        return stack
+
+    def _is_excluded(self, path):
+        return any(path == excluded or path.startswith(excluded + "/") for excluded in self.excluded)
+
+    def _search(self, query, path, mimes, limit, cursor):
+        conditions, params = [], []
+        query = (query or "").lower()
+        # LIKE on the trigram index only folds ASCII case, so it would drop e.g. "Ä" for "ä"
+        prefilter = self._fts and query.isascii()
+        if any(c in query for c in "*?["):
+            if prefilter and "[" not in query:
+                # The trigram index narrows candidates down, GLOB checks them exactly
+                conditions.append("e.id IN (SELECT rowid FROM names WHERE name LIKE ?)")
+                params.append(query.replace("*", "%").replace("?", "_"))
+            conditions.append("py_lower(e.name) GLOB ?")
+            params.append(query)
+        elif query:
+            if prefilter:
+                conditions.append("e.id IN (SELECT rowid FROM names WHERE name LIKE ?)")
+                params.append(f"%{query}%")
+            conditions.append("instr(py_lower(e.name), ?) > 0")
+            params.append(query)
+        rel_dir = self._rel(path) if path else ""
+        if rel_dir:
+            conditions.append("e.path >= ? AND e.path < ?")
+            params += [rel_dir + "/", rel_dir + "0"]
+        if mimes:
+            mime_conditions = []
+            for mime in mimes:
+                if "/" in mime:
+                    mime_conditions.append("e.mime = ?")
+                    params.append(mime)
+                else:
+                    mime_conditions.append("e.mime LIKE ?")
+                    params.append(f"{mime}/%")
+            conditions.append("(" + " OR ".join(mime_conditions) + ")")
+        if cursor:
+            conditions.append("e.path > ?")
+            params.append(cursor)
+        sql = "SELECT e.path, e.name, e.is_dir, e.size, e.mtime, e.mime FROM entries e"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY e.path LIMIT ?"
+        params.append(limit + 1)
+        rows = self._read_db.execute(sql, params).fetchall()
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return rows[:limit], next_cursor
+
+
+def summarize_args(args, kwargs):
+    """Describe call arguments briefly for traces, eliding payloads and callbacks."""
+    def describe(value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return f"<{len(value)} bytes>"
+        if callable(value):
+            return "<callback>"
+        return repr(value)
+
+    parts = [describe(value) for value in args]
+    parts.extend(f"{key}={describe(value)}" for key, value in kwargs.items())
+    summary = ", ".join(parts)
+    if len(summary) > TRACE_ARGS_LENGTH:
+        summary = summary[:TRACE_ARGS_LENGTH] + "..."
+    return summary
+
+
+def histogram_quantile(buckets, count, maximum, q):
+    """Estimate a quantile of a ``LATENCY_BUCKETS`` histogram as the upper bound of its bucket."""
+    target = q * count
+    seen = 0
+    for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+        seen += bucket
+        if seen >= target:
+            return min(bound, maximum)
+    return maximum
+
+
+def client_id(context):
+    """Return the calling client's id from a hypha-rpc call context."""
+    return (context or {}).get("from")
+
+
+def disconnected_client_id(event):
+    """Return the id of the client a hypha-rpc ``client_disconnected`` event is about."""
+    data = event.get("data", event)
+    raw_id = data.get("id") or event.get("client")
+    workspace = data.get("workspace")
+    if raw_id and workspace:
+        return f"{workspace}/{raw_id}"
+    return raw_id
+
+
+def bind_client(func):
+    """Wrap a service function so :data:`CURRENT_CLIENT` identifies its caller.
+
+    hypha-rpc passes the caller's ``context`` as a keyword argument when the
+    service requires it; the wrapper consumes it. Calls without a context
+    (e.g. the operations of a batch) keep the client already set.
+    """
+    if inspect.isasyncgenfunction(func):
+        @functools.wraps(func)
+        async def generator_wrapper(*args, context=None, **kwargs):
+            # Generator steps may run in different tasks, so the value is not reset
+            if context is not None:
+                CURRENT_CLIENT.set(client_id(context))
+            async for item in func(*args, **kwargs):
+                yield item
+        return generator_wrapper
+
+    @functools.wraps(func)
+    async def wrapper(*args, context=None, **kwargs):
+        if context is None:
+            return await func(*args, **kwargs)
+        token = CURRENT_CLIENT.set(client_id(context))
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            CURRENT_CLIENT.reset(token)
+    return wrapper
+
+
+def lower_thread_priority():
+    """Raise the niceness of the calling thread, which also lowers its I/O priority on Linux."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), BULK_THREAD_NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+
+class BlockingExecutor:
+    """Runs blocking filesystem calls on bounded thread pools, one per lane.
+
+    The ``interactive`` lane (stat, listings, small reads and writes) and the
+    ``bulk`` lane (large transfers, fsync, archives) have separate pools, so
+    bulk work never delays interactive calls; bulk threads also run at a
+    lower CPU and I/O priority. A call first waits for a slot among the
+    ``client_concurrency`` of its client on that lane, then for a free thread.
+    A call arriving when ``max_queue`` calls already wait on the lane is
+    rejected with ``EBUSY``. Queue waits are recorded per lane.
+    """
+
+    def __init__(self, interactive_workers, bulk_workers, max_queue, client_concurrency):
+        self.max_queue = max_queue
+        self.client_concurrency = client_concurrency
+        self._lanes = {}
+        for name, workers, initializer in (
+            ("interactive", interactive_workers, None),
+            ("bulk", bulk_workers, lower_thread_priority),
+        ):
+            self._lanes[name] = {
+                "pool": ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name,
+                                           initializer=initializer),
+                "slots": asyncio.Semaphore(workers),
+                "clients": {},  # client id -> [semaphore, calls holding or waiting for it]
+                "workers": workers,
+                "queued": 0,
+                "running": 0,
+                "completed": 0,
+                "rejected": 0,
+                "waitSum": 0.0,
+                "waitMax": 0.0,
+                "waitBuckets": [0] * (len(LATENCY_BUCKETS) + 1),
+            }
+
+    async def run(self, lane_name, func, *args):
+        """Run ``func(*args)`` on a lane's pool and return its result."""
+        lane = self._lanes[lane_name]
+        if lane["queued"] >= self.max_queue:
+            lane["rejected"] += 1
+            raise OSError(errno.EBUSY, f"Server busy: {lane['queued']} {lane_name} calls queued")
+        client = CURRENT_CLIENT.get()
+        client_slot = lane["clients"].get(client)
+        if client_slot is None:
+            client_slot = lane["clients"][client] = [asyncio.Semaphore(self.client_concurrency), 0]
+        client_slot[1] += 1
+        lane["queued"] += 1
+        queued = True
+        enqueued = time.perf_counter()
+        try:
+            async with client_slot[0], lane["slots"]:
+                lane["queued"] -= 1
+                queued = False
+                self._record_wait(lane, time.perf_counter() - enqueued)
+                lane["running"] += 1
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(lane["pool"], func, *args)
+                finally:
+                    lane["running"] -= 1
+                    lane["completed"] += 1
+        finally:
+            if queued:
+                lane["queued"] -= 1
+            client_slot[1] -= 1
+            if client_slot[1] == 0:
+                lane["clients"].pop(client, None)
+
+    def _record_wait(self, lane, wait):
+        lane["waitSum"] += wait
+        lane["waitMax"] = max(lane["waitMax"], wait)
+        lane["waitBuckets"][bisect.bisect_left(LATENCY_BUCKETS, wait)] += 1
+
+    def stats(self):
+        """Return occupancy and queue-wait statistics per lane, waits in milliseconds."""
+        result = {}
+        for name, lane in self._lanes.items():
+            started = sum(lane["waitBuckets"])
+            result[name] = {
+                "workers": lane["workers"],
+                "running": lane["running"],
+                "queued": lane["queued"],
+                "clients": len(lane["clients"]),
+                "completed": lane["completed"],
+                "rejected": lane["rejected"],
+                "waitMeanMs": lane["waitSum"] / started * 1000 if started else 0.0,
+                "waitP95Ms": histogram_quantile(lane["waitBuckets"], started, lane["waitMax"], 0.95) * 1000,
+                "waitMaxMs": lane["waitMax"] * 1000,
+            }
+        return result
+
+    def prometheus(self):
+        """Render lane statistics in the Prometheus text exposition format."""
+        lines = []
+        for metric, kind, help_text, key in (
+            ("asyncfs_executor_running", "gauge", "Blocking calls running per executor lane.", "running"),
+            ("asyncfs_executor_queued", "gauge", "Blocking calls waiting per executor lane.", "queued"),
+            ("asyncfs_executor_rejected_total", "counter", "Blocking calls rejected as busy.", "rejected"),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, lane in self._lanes.items():
+                lines.append(f'{metric}{{lane="{name}"}} {lane[key]}')
+        lines.append("# HELP asyncfs_executor_queue_wait_seconds Time blocking calls waited for a thread.")
+        lines.append("# TYPE asyncfs_executor_queue_wait_seconds histogram")
+        for name, lane in self._lanes.items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, lane["waitBuckets"]):
+                cumulative += count
+                lines.append(f'asyncfs_executor_queue_wait_seconds_bucket{{lane="{name}",le="{bound}"}} {cumulative}')
+            started = sum(lane["waitBuckets"])
+            lines.append(f'asyncfs_executor_queue_wait_seconds_bucket{{lane="{name}",le="+Inf"}} {started}')
+            lines.append(f'asyncfs_executor_queue_wait_seconds_sum{{lane="{name}"}} {lane["waitSum"]:.6f}')
+            lines.append(f'asyncfs_executor_queue_wait_seconds_count{{lane="{name}"}} {started}')
+        return "\n".join(lines) + "\n"
+
+    def shutdown(self):
+        for lane in self._lanes.values():
+            lane["pool"].shutdown(wait=False, cancel_futures=True)
+
+
+class HandleTable:
+    """Registry of the file handles opened through ``openFile``/``createFile``.
+
+    Each handle belongs to the client that opened it, and opening fails with
+    ``EMFILE`` once ``max_handles`` handles are open in total or
+    ``max_per_client`` for the client. Handles unused for ``idle_timeout``
+    seconds are closed by a background sweep, and a client's handles are
+    closed when it disconnects; calls on a closed handle fail with ``EBADF``.
+    Descriptors held elsewhere (upload sessions) are counted toward
+    ``max_handles`` with :meth:`reserve` and :meth:`release`.
+
+    Handles also keep a read-ahead buffer: while a handle is read
+    sequentially, each read going to disk fetches a window that doubles up
+    to ``readahead_max`` bytes, and the reads that follow are served from
+    it. Buffers of a path are dropped when the service writes to it.
+    """
+
+    def __init__(self, close_file, max_handles, max_per_client, idle_timeout, readahead_max):
+        self._close_file = close_file
+        self.max_handles = max_handles
+        self.max_per_client = max_per_client
+        self.idle_timeout = idle_timeout
+        self.readahead_max = readahead_max
+        self._handles = {}  # handle id -> handle
+        self._by_client = {}  # client id -> handle ids
+        self._by_path = {}  # path -> handle ids
+        self._sweep_task = None
+        self.reserved = 0  # descriptors open outside the table
+        self.evicted = 0
+        self.readahead_hits = 0
+        self.readahead_fills = 0
+
+    def __len__(self):
+        return len(self._handles)
+
+    def add(self, file, path, client):
+        """Register an open ``file`` of ``client`` and return its handle."""
+        if len(self._handles) + self.reserved >= self.max_handles:
+            raise OSError(errno.EMFILE, f"Too many open file handles ({self.max_handles})")
+        if len(self._by_client.get(client, ())) >= self.max_per_client:
+            raise OSError(errno.EMFILE, f"Too many open file handles for this client ({self.max_per_client})")
+        handle = {
+            "id": uuid.uuid4().hex,
+            "file": file,
+            "path": path,
+            "client": client,
+            "lastUsed": time.monotonic(),
+            "inFlight": 0,
+            "closed": None,  # why the handle was closed
+            "drained": None,  # future a close waits on for calls still using the fd
+            # Read-ahead state: bytes buffered from "start", the position a
+            # sequential read continues at, the current window size, and a
+            # generation bumped whenever the buffer is dropped
+            "buffer": b"",
+            "start": 0,
+            "eof": False,
+            "next": None,
+            "window": 0,
+            "generation": 0,
+        }
+        self._handles[handle["id"]] = handle
+        self._by_client.setdefault(client, set()).add(handle["id"])
+        self._by_path.setdefault(path, set()).add(handle["id"])
+        if self.idle_timeout > 0 and (self._sweep_task is None or self._sweep_task.done()):
+            self._sweep_task = asyncio.ensure_future(self._sweep())
+        return handle
+
+    def reserve(self):
+        """Count one more descriptor held outside the table toward ``max_handles``."""
+        if len(self._handles) + self.reserved >= self.max_handles:
+            raise OSError(errno.EMFILE, f"Too many open file handles ({self.max_handles})")
+        self.reserved += 1
+
+    def release(self):
+        """Give back a descriptor counted by :meth:`reserve`."""
+        self.reserved -= 1
+
+    @contextlib.contextmanager
+    def use(self, handle):
+        """Mark ``handle`` busy for one call, made on behalf of the client owning it."""
+        if handle["closed"] is not None:
+            raise OSError(errno.EBADF, f"File handle of {handle['path']} is closed ({handle['closed']})")
+        handle["inFlight"] += 1
+        token = CURRENT_CLIENT.set(handle["client"])
+        try:
+            yield handle["file"]
+        finally:
+            CURRENT_CLIENT.reset(token)
+            handle["inFlight"] -= 1
+            handle["lastUsed"] = time.monotonic()
+            if not handle["inFlight"] and handle["drained"] is not None and not handle["drained"].done():
+                handle["drained"].set_result(None)
+
+    async def close(self, handle, reason="closed"):
+        """Unregister ``handle`` and close its file; closing it again does nothing.
+
+        New calls on the handle fail at once, but the file is only closed
+        once the calls already using its fd are done, so that they never run
+        on a closed fd or one reused by another file.
+        """
+        if handle["closed"] is not None:
+            return
+        handle["closed"] = reason
+        handle["buffer"] = b""
+        del self._handles[handle["id"]]
+        for index, key in ((self._by_client, handle["client"]), (self._by_path, handle["path"])):
+            index[key].discard(handle["id"])
+            if not index[key]:
+                del index[key]
+        if handle["inFlight"]:
+            handle["drained"] = asyncio.get_running_loop().create_future()
+            await handle["drained"]
+        await self._close_file(handle["file"])
+
+    async def close_client(self, client, reason="client disconnected"):
+        """Close all handles of ``client``; returns how many were open."""
+        handles = [self._handles[handle_id] for handle_id in self._by_client.get(client, ())]
+        for handle in handles:
+            try:
+                await self.close(handle, reason)
+            except Exception as e:
+                logger.warning(f"Error closing handle of {handle['path']}: {str(e)}")
+        return len(handles)
+
+    async def close_all(self):
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+        for client in list(self._by_client):
+            await self.close_client(client, "service stopped")
+
+    async def _sweep(self):
+        while self._handles:
+            await asyncio.sleep(self.idle_timeout / 4)
+            cutoff = time.monotonic() - self.idle_timeout
+            for handle in list(self._handles.values()):
+                if handle["inFlight"] or handle["lastUsed"] > cutoff or handle["closed"] is not None:
+                    continue
+                logger.info("Closing idle file handle of %s opened by %s", handle["path"], handle["client"])
+                self.evicted += 1
+                try:
+                    await self.close(handle, "idle")
+                except Exception as e:
+                    logger.warning(f"Error closing idle handle of {handle['path']}: {str(e)}")
+
+    def read_buffered(self, handle, buffer, offset, length, position):
+        """Copy a read from the read-ahead buffer into ``buffer``.
+
+        Returns:
+            int: The bytes copied, or ``None`` if the buffer does not cover the read.
+        """
+        data = handle["buffer"]
+        start = position - handle["start"]
+        if start < 0 or start >= len(data) or (start + length > len(data) and not handle["eof"]):
+            return None
+        chunk = memoryview(data)[start:start + length]
+        memoryview(buffer)[offset:offset + len(chunk)] = chunk
+        handle["next"] = position + len(chunk)
+        self.readahead_hits += 1
+        return len(chunk)
+
+    def readahead_size(self, handle, position, length):
+        """Return how many bytes a read of ``length`` at ``position`` should fetch from disk."""
+        if position == handle["next"] and self.readahead_max > 0:
+            handle["window"] = min(max(handle["window"] * 2, READAHEAD_MIN_WINDOW), self.readahead_max)
+        else:
+            handle["window"] = 0
+        return max(length, handle["window"])
+
+    def fill(self, handle, position, data, requested, generation):
+        """Buffer ``data`` read at ``position``, unless the buffer was dropped meanwhile."""
+        if handle["generation"] != generation or handle["closed"] is not None:
+            return
+        handle["buffer"], handle["start"], handle["eof"] = data, position, len(data) < requested
+        self.readahead_fills += 1
+
+    def invalidate(self, path):
+        """Drop the read-ahead buffers of the handles of ``path``."""
+        for handle_id in self._by_path.get(path, ()):
+            handle = self._handles[handle_id]
+            handle["buffer"] = b""
+            handle["generation"] += 1
+
+    def stats(self):
+        return {
+            "open": len(self._handles),
+            "reserved": self.reserved,
+            "clients": len(self._by_client),
+            "maxHandles": self.max_handles,
+            "maxPerClient": self.max_per_client,
+            "evicted": self.evicted,
+            "readaheadHits": self.readahead_hits,
+            "readaheadFills": self.readahead_fills,
+            "readaheadBytes": sum(len(handle["buffer"]) for handle in self._handles.values()),
+        }
+
+    def prometheus(self):
+        """Render handle statistics in the Prometheus text exposition format."""
+        lines = []
+        for metric, kind, help_text, value in (
+            ("asyncfs_open_handles", "gauge", "File handles open.", len(self._handles)),
+            ("asyncfs_handles_evicted_total", "counter", "File handles closed after being idle.", self.evicted),
+            ("asyncfs_readahead_hits_total", "counter", "Handle reads served from read-ahead buffers.",
+             self.readahead_hits),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class ServiceMetrics:
+    """Call counts, latency histograms, error counts and in-flight gauges per method.
+
+    Service functions are instrumented by wrapping them with
+    :meth:`instrument`; a call that raises or returns an ``{"error": ...}``
+    dict counts as an error. Calls slower than ``slow_threshold`` seconds
+    are logged, and a ``trace_sample_rate`` fraction of calls is kept as
+    traces in a ring buffer.
+    """
+
+    def __init__(self, slow_threshold=1.0, trace_sample_rate=0.0, trace_buffer_size=TRACE_BUFFER_SIZE):
+        self.slow_threshold = slow_threshold
+        self.trace_sample_rate = trace_sample_rate
+        self.started = time.monotonic()
+        self.bytes = {"read": 0, "written": 0}
+        self.traces = deque(maxlen=trace_buffer_size)
+        self._methods = {}
+
+    def add_bytes(self, direction, count):
+        """Account ``count`` bytes ``"read"`` or ``"written"`` on behalf of clients."""
+        self.bytes[direction] += count
+
+    def instrument(self, name, func):
+        """Wrap a coroutine (or async generator) function so its calls are measured."""
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def generator_wrapper(*args, **kwargs):
+                call = self._begin(name, args, kwargs)
+                error = None
+                try:
+                    async for item in func(*args, **kwargs):
+                        yield item
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    self._end(call, error)
+            return generator_wrapper
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            call = self._begin(name, args, kwargs)
+            error = None
+            try:
+                result = func(*args, **kwargs)
+                if inspect.isawaitable(result):
+                    result = await result
+                if isinstance(result, dict) and "error" in result:
+                    error = result["error"]
+                return result
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                self._end(call, error)
+        return wrapper
+
+    def _method(self, name):
+        method = self._methods.get(name)
+        if method is None:
+            method = self._methods[name] = {
+                "calls": 0,
+                "errors": 0,
+                "inFlight": 0,
+                "sum": 0.0,
+                "max": 0.0,
+                "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+            }
+        return method
+
+    def _begin(self, name, args, kwargs):
+        method = self._method(name)
+        method["inFlight"] += 1
+        trace = None
+        if self.trace_sample_rate and random.random() < self.trace_sample_rate:
+            trace = {
+                "id": uuid.uuid4().hex[:16],
+                "method": name,
+                "args": summarize_args(args, kwargs),
+                "start": time.time(),
+            }
+        return name, method, time.perf_counter(), trace, args, kwargs
+
+    def _end(self, call, error):
+        name, method, start, trace, args, kwargs = call
+        duration = time.perf_counter() - start
+        method["inFlight"] -= 1
+        method["calls"] += 1
+        method["sum"] += duration
+        method["max"] = max(method["max"], duration)
+        method["buckets"][bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+        if error is not None:
+            method["errors"] += 1
+        if self.slow_threshold and duration >= self.slow_threshold:
+            logger.warning("Slow call %s(%s) took %.3fs", name, summarize_args(args, kwargs), duration)
+        if trace is not None:
+            trace["duration"] = duration
+            trace["error"] = None if error is None else str(error)
+            self.traces.append(trace)
+            logger.info("Trace %s: %s(%s) took %.3fs%s", trace["id"], name, trace["args"], duration,
+                        "" if error is None else f", failed: {error}")
+
+    def _quantile(self, method, q):
+        return histogram_quantile(method["buckets"], method["calls"], method["max"], q)
+
+    def state(self):
+        """Return the raw counters and histograms, which :meth:`merged` combines."""
+        return {
+            "uptime": time.monotonic() - self.started,
+            "bytes": dict(self.bytes),
+            "methods": {name: dict(method, buckets=list(method["buckets"])) for name, method in self._methods.items()},
+        }
+
+    @classmethod
+    def merged(cls, states):
+        """Build metrics summing the :meth:`state` of several services (e.g. worker processes)."""
+        metrics = cls(slow_threshold=0)
+        metrics.started = time.monotonic() - max((state["uptime"] for state in states), default=0.0)
+        for state in states:
+            for direction, count in state["bytes"].items():
+                metrics.bytes[direction] = metrics.bytes.get(direction, 0) + count
+            for name, source in state["methods"].items():
+                method = metrics._method(name)
+                for key in ("calls", "errors", "inFlight", "sum"):
+                    method[key] += source[key]
+                method["max"] = max(method["max"], source["max"])
+                method["buckets"] = [a + b for a, b in zip(method["buckets"], source["buckets"])]
+        return metrics
+
+    def snapshot(self):
+        """Return all metrics as a dict, with latencies in milliseconds."""
+        methods = {}
+        for name, method in sorted(self._methods.items()):
+            calls = method["calls"]
+            methods[name] = {
+                "calls": calls,
+                "errors": method["errors"],
+                "inFlight": method["inFlight"],
+                "meanMs": method["sum"] / calls * 1000 if calls else 0.0,
+                "p50Ms": self._quantile(method, 0.5) * 1000 if calls else 0.0,
+                "p95Ms": self._quantile(method, 0.95) * 1000 if calls else 0.0,
+                "p99Ms": self._quantile(method, 0.99) * 1000 if calls else 0.0,
+                "maxMs": method["max"] * 1000,
+            }
+        return {
+            "uptime": time.monotonic() - self.started,
+            "bytes": dict(self.bytes),
+            "methods": methods,
+        }
+
+    def prometheus(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = [
+            "# HELP asyncfs_uptime_seconds Seconds since the service started.",
+            "# TYPE asyncfs_uptime_seconds gauge",
+            f"asyncfs_uptime_seconds {time.monotonic() - self.started:.3f}",
+            "# HELP asyncfs_bytes_total Bytes read or written on behalf of clients.",
+            "# TYPE asyncfs_bytes_total counter",
+        ]
+        for direction, count in self.bytes.items():
+            lines.append(f'asyncfs_bytes_total{{direction="{direction}"}} {count}')
+        for metric, kind, help_text, key in (
+            ("asyncfs_calls_total", "counter", "Completed service calls.", "calls"),
+            ("asyncfs_errors_total", "counter", "Service calls that failed.", "errors"),
+            ("asyncfs_in_flight", "gauge", "Service calls currently running.", "inFlight"),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, method in sorted(self._methods.items()):
+                lines.append(f'{metric}{{method="{name}"}} {method[key]}')
+        lines.append("# HELP asyncfs_call_duration_seconds Latency of service calls.")
+        lines.append("# TYPE asyncfs_call_duration_seconds histogram")
+        for name, method in sorted(self._methods.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, method["buckets"]):
+                cumulative += count
+                lines.append(f'asyncfs_call_duration_seconds_bucket{{method="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'asyncfs_call_duration_seconds_bucket{{method="{name}",le="+Inf"}} {method["calls"]}')
+            lines.append(f'asyncfs_call_duration_seconds_sum{{method="{name}"}} {method["sum"]:.6f}')
+            lines.append(f'asyncfs_call_duration_seconds_count{{method="{name}"}} {method["calls"]}')
+        return "\n".join(lines) + "\n"
+
+
+class ChangeNotifier:
+    """Pushes coalesced change events of watched directories to subscribers.
+
+    Directories are watched with inotify where available and otherwise
+    polled by diffing ``os.scandir`` snapshots. Events of a subscription are
+    merged per path and delivered as one batch once no new event arrived for
+    ``WATCH_DEBOUNCE`` seconds (at the latest ``WATCH_MAX_DELAY`` after the
+    first). A subscription with more than ``WATCH_QUEUE_LIMIT`` queued paths,
+    or every subscription when the kernel queue overflows, drops its events
+    and receives a batch with ``resync`` set instead.
+    """
+
+    INOTIFY_KINDS = (
+        (InotifyWatcher.IN_CREATE, "create"),
+        (InotifyWatcher.IN_DELETE, "delete"),
+        (InotifyWatcher.IN_MODIFY | InotifyWatcher.IN_CLOSE_WRITE | InotifyWatcher.IN_ATTRIB, "modify"),
+    )
+
+    def __init__(self, to_virtual_path, run_blocking, poll_interval=WATCH_POLL_INTERVAL, hidden=(),
+                 max_watches=None):
+        self._to_virtual_path = to_virtual_path
+        self._max_watches = max_watches
+        self._run_blocking = run_blocking  # Coroutine function running a blocking call off the loop
+        self._poll_interval = poll_interval
+        self._hidden = set(hidden)  # Absolute paths never reported to subscribers
+        self._subscriptions = {}  # watch id -> subscription dict
+        self._by_directory = {}  # directory -> set of watch ids
+        self._snapshots = {}  # polled directory -> {name: (ino, is_dir, size, mtime_ns)}
+        self._moves = OrderedDict()  # inotify cookie -> (directory, name)
+        self._watcher = None
+        self._watcher_created = False
+        self._poll_task = None
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    async def subscribe(self, directory, callback):
+        """Deliver change batches of ``directory`` to ``callback``; returns the watch id."""
+        if not os.path.isdir(directory):
+            raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), directory)
+        watch_id = uuid.uuid4().hex
+        self._subscriptions[watch_id] = {
+            "id": watch_id,
+            "directory": directory,
+            "callback": callback,
+            "pending": OrderedDict(),  # name -> event dict
+            "resync": False,
+            "first": None,
+            "timer": None,
+            "task": None,
+        }
+        ids = self._by_directory.setdefault(directory, set())
+        if not ids:
+            await self._start_watching(directory)
+        ids.add(watch_id)
+        return watch_id
+
+    def unsubscribe(self, watch_id):
+        """Cancel a subscription; returns False if it did not exist."""
+        sub = self._subscriptions.pop(watch_id, None)
+        if sub is None:
+            return False
+        if sub["timer"] is not None:
+            sub["timer"].cancel()
+        ids = self._by_directory.get(sub["directory"])
+        if ids is not None:
+            ids.discard(watch_id)
+            if not ids:
+                del self._by_directory[sub["directory"]]
+                self._stop_watching(sub["directory"])
+        return True
+
+    def close(self):
+        for watch_id in list(self._subscriptions):
+            self.unsubscribe(watch_id)
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+    async def _start_watching(self, directory):
+        if not self._watcher_created:
+            self._watcher_created = True
+            self._watcher = InotifyWatcher.create(self._on_event, self._max_watches)
+        if self._watcher is not None:
+            try:
+                self._watcher.add_watch(directory)
+                return
+            except OSError as e:
+                logger.warning(f"Cannot watch {directory} with inotify, polling it instead: {str(e)}")
+        self._snapshots[directory] = await self._run_blocking(self._snapshot, directory)
+        if self._poll_task is None or self._poll_task.done():
+            self._poll_task = asyncio.ensure_future(self._poll())
+
+    def _stop_watching(self, directory):
+        if self._snapshots.pop(directory, None) is None and self._watcher is not None:
+            self._watcher.remove_watch(directory)
+
+    def _on_event(self, directory, name, mask, cookie):
+        if directory is None:
+            logger.warning("inotify event queue overflowed, asking watch subscribers to resync")
+            for sub in self._subscriptions.values():
+                self._overflow(sub)
+            return
+        if name is None:
+            if mask & (InotifyWatcher.IN_DELETE_SELF | InotifyWatcher.IN_MOVE_SELF):
+                self._emit(directory, None, "delete", True)
+            return
+        is_dir = bool(mask & InotifyWatcher.IN_ISDIR)
+        if mask & InotifyWatcher.IN_MOVED_FROM:
+            self._moves[cookie] = (directory, name)
+            while len(self._moves) > WATCH_QUEUE_LIMIT:
+                self._moves.popitem(last=False)
+            self._emit(directory, name, "delete", is_dir)
+        elif mask & InotifyWatcher.IN_MOVED_TO:
+            source = self._moves.pop(cookie, None)
+            if source is not None and source[0] == directory:
+                self._emit(directory, name, "move", is_dir, old_name=source[1])
+            else:
+                self._emit(directory, name, "create", is_dir)
+        else:
+            for flags, kind in self.INOTIFY_KINDS:
+                if mask & flags:
+                    self._emit(directory, name, kind, is_dir)
+                    break
+
+    @staticmethod
+    def _snapshot(directory):
+        try:
+            snapshot = {}
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        stats = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    snapshot[entry.name] = (stats.st_ino, stat_module.S_ISDIR(stats.st_mode),
+                                            stats.st_size, stats.st_mtime_ns)
+            return snapshot
+        except OSError:
+            return None
+
+    async def _poll(self):
+        while self._snapshots:
+            await asyncio.sleep(self._poll_interval)
+            for directory in list(self._snapshots):
+                current = await self._run_blocking(self._snapshot, directory)
+                if directory not in self._snapshots:
+                    continue  # unsubscribed while scanning
+                previous, self._snapshots[directory] = self._snapshots[directory], current
+                self._diff(directory, previous, current)
+
+    def _diff(self, directory, previous, current):
+        if current is None:
+            if previous is not None:
+                self._emit(directory, None, "delete", True)
+            return
+        previous = previous or {}
+        added = {name: info for name, info in current.items() if name not in previous}
+        added_by_ino = {info[0]: name for name, info in added.items()}
+        for name, info in previous.items():
+            if name in current:
+                if current[name] != info:
+                    self._emit(directory, name, "modify", current[name][1])
+                continue
+            self._emit(directory, name, "delete", info[1])
+            new_name = added_by_ino.pop(info[0], None)
+            if new_name is not None:
+                del added[new_name]
+                self._emit(directory, new_name, "move", info[1], old_name=name)
+        for name, info in added.items():
+            self._emit(directory, name, "create", info[1])
+
+    def _emit(self, directory, name, kind, is_dir, old_name=None):
+        if name is not None and os.path.join(directory, name) in self._hidden:
+            return
+        for watch_id in self._by_directory.get(directory, ()):
+            sub = self._subscriptions[watch_id]
+            if not sub["resync"]:
+                self._queue(sub, name, kind, is_dir, old_name)
+
+    def _queue(self, sub, name, kind, is_dir, old_name):
+        pending = sub["pending"]
+        if kind == "move":
+            source = pending.get(old_name)
+            if source is not None and source["type"] == "delete":
+                del pending[old_name]
+                event = {"type": "move", "oldName": source.get("oldName", old_name), "isDir": is_dir}
+            else:
+                # The source only existed within this batch
+                event = {"type": "create", "isDir": is_dir}
+        else:
+            event = {"type": kind, "isDir": is_dir}
+        previous = pending.pop(name, None)
+        if previous is not None:
+            if previous["type"] == "create" and kind == "delete":
+                event = None
+            elif previous["type"] == "create" and kind == "modify":
+                event = previous
+            elif previous["type"] == "delete" and kind == "create":
+                event = {"type": "modify", "isDir": is_dir}
+            elif previous["type"] == "move" and kind == "modify":
+                event = previous
+        if event is not None:
+            pending[name] = event
+        if len(pending) > WATCH_QUEUE_LIMIT:
+            self._overflow(sub)
+        else:
+            self._schedule(sub)
+
+    def _overflow(self, sub):
+        sub["pending"].clear()
+        sub["resync"] = True
+        self._schedule(sub)
+
+    def _schedule(self, sub):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if sub["first"] is None:
+            sub["first"] = now
+        if sub["timer"] is not None:
+            sub["timer"].cancel()
+        delay = max(0, min(WATCH_DEBOUNCE, sub["first"] + WATCH_MAX_DELAY - now))
+        sub["timer"] = loop.call_later(delay, self._flush, sub)
+
+    def _flush(self, sub):
+        sub["timer"] = None
+        # A delivery in flight reschedules itself once the client acknowledged it
+        if sub["task"] is None or sub["task"].done():
+            sub["task"] = asyncio.ensure_future(self._deliver(sub))
+
+    async def _deliver(self, sub):
+        directory = sub["directory"]
+        events = []
+        for name, event in sub["pending"].items():
+            path = directory if name is None else os.path.join(directory, name)
+            item = {"type": event["type"], "path": self._to_virtual_path(path), "isDir": event["isDir"]}
+            if event["type"] == "move":
+                item["oldPath"] = self._to_virtual_path(os.path.join(directory, event["oldName"]))
+            events.append(item)
+        batch = {
+            "watchId": sub["id"],
+            "path": self._to_virtual_path(directory),
+            "events": events,
+            "resync": sub["resync"],
+        }
+        sub["pending"] = OrderedDict()
+        sub["resync"] = False
+        sub["first"] = None
+        try:
+            await sub["callback"](batch)
+        except Exception as e:
+            logger.warning(f"Dropping watch {sub['id']} on {directory}, delivery failed: {str(e)}")
+            self.unsubscribe(sub["id"])
+            return
+        if sub["id"] in self._subscriptions and (sub["pending"] or sub["resync"]) and sub["timer"] is None:
+            self._schedule(sub)
+
+
+async def run_batch_op(operations, op):
+    """Run one batch entry, returning ``{"op", "result"}`` or ``{"op", "error"}``."""
+    name = op.get("op")
+    func = operations.get(name)
+    if func is None or name == "batch" or inspect.isasyncgenfunction(func):
+        return {"op": name, "error": f"Unsupported batch operation: {name}"}
+    args = op.get("args") or []
+    try:
+        if isinstance(args, dict):
+            result = await func(**args)
+        else:
+            result = await func(*args)
+    except Exception as e:
+        return {"op": name, "error": str(e)}
+    # Most service functions report failures as {"error": ...} instead of raising
+    if isinstance(result, dict) and "error" in result:
+        return {"op": name, "error": result["error"]}
+    return {"op": name, "result": result}
+
+async def run_batch(operations, ops, concurrent=False, stopOnError=False, maxConcurrency=BATCH_MAX_CONCURRENCY):
+    """Execute many of the service ``operations`` in one round-trip.
+
+    Each entry of ``ops`` is ``{"op": name, "args": [...] or {...}}``.
+    With ``concurrent`` the operations run at the same time (at most
+    ``maxConcurrency`` at once) and must be independent of each other.
+    Otherwise they run in order, and ``stopOnError`` skips everything
+    after the first failure, which suits ordered mutations.
+
+    Returns:
+        list: One ``{"op", "result"}``, ``{"op", "error"}`` or
+        ``{"op", "skipped": True}`` entry per operation, in order.
+    """
+    if concurrent:
+        limit = asyncio.Semaphore(maxConcurrency)
+
+        async def run_limited(op):
+            async with limit:
+                return await run_batch_op(operations, op)
+
+        return list(await asyncio.gather(*[run_limited(op) for op in ops]))
+
+    results = []
+    failed = False
+    for op in ops:
+        if failed:
+            results.append({"op": op.get("op"), "skipped": True})
+            continue
+        result = await run_batch_op(operations, op)
+        results.append(result)
+        failed = stopOnError and "error" in result
+    return results
+
+async def create_operations(args):
+    """Build the service operations for the options in ``args``.
+
+    Returns:
+        tuple: ``(operations, shutdown, client_disconnected, paths_changed)``,
+        the dict of service functions by name, a coroutine function releasing
+        the pools, watchers and index they use, one releasing the file handles
+        of a client that disconnected, and a function applying changes made
+        by another process serving the same root (see :data:`CHANGED_PATHS`).
+    """
+    workdir = os.path.abspath(args.root)
+    os.makedirs(workdir, exist_ok=True)
+    logger.info(f"Using root directory: {workdir}")
+    # Hidden from listings, watches and the index
+    trash_dir = os.path.join(workdir, TRASH_DIRECTORY)
+    upload_dir = os.path.join(workdir, UPLOAD_DIRECTORY)
+    hidden_dirs = (trash_dir, upload_dir)
+
+    watch_budget = inotify_watch_budget(args.max_inotify_watches)
+    metadata_cache = MetadataCache(args.metadata_cache_size, max_watches=watch_budget["metadata"])
+    content_cache = ContentCache(args.content_cache_size, args.content_cache_max_file)
+    metrics = ServiceMetrics(args.slow_op_threshold, args.trace_sample_rate)
+    executor = BlockingExecutor(args.interactive_workers, args.bulk_workers, args.max_queue, args.client_concurrency)
+
+    def io_lane(size):
+        """Pick the executor lane for a transfer of ``size`` bytes."""
+        return "interactive" if size <= INTERACTIVE_IO_LIMIT else "bulk"
+    logger.info(f"Metadata cache: {metadata_cache.stats()}")
+
+    file_index = None
+    if not args.no_index:
+        index_db = args.index_db or os.path.expanduser(
+            f"~/.cache/async-file-service/index-{hashlib.sha1(workdir.encode()).hexdigest()[:12]}.sqlite3"
+        )
+        file_index = FileIndex(workdir, index_db, excluded=hidden_dirs, max_watches=watch_budget["index"])
+        await file_index.start()
+
+    def apply_change(p, ancestors=False):
+        """Propagate a change of ``p`` to the metadata cache, the search index and open handles."""
+        metadata_cache.invalidate(p, ancestors=ancestors)
+        content_cache.invalidate(p)
+        handles.invalidate(p)
+        if file_index is not None:
+            file_index.refresh(p)
+
+    def notify_changed(p, ancestors=False):
+        """Propagate a change made by the service, recording it for other worker processes."""
+        apply_change(p, ancestors)
+        changed = CHANGED_PATHS.get()
+        if changed is not None:
+            changed.append([p, ancestors])
+
+    def paths_changed(changes):
+        """Apply the ``[path, ancestors]`` changes another process serving the root made."""
+        for p, ancestors in changes:
+            apply_change(p, ancestors)
+
+    async def close_handle_file(file):
+        await executor.run("interactive", file.close)
+        if "r" not in file.mode or "+" in file.mode:
+            notify_changed(file.name)
+
+    handles = HandleTable(close_handle_file, args.max_handles, args.max_handles_per_client,
+                          args.handle_idle_timeout, args.readahead_max)
+
+    async def open_handle(p, mode):
+        """Open ``p`` unbuffered in binary ``mode`` and register it for the calling client."""
+        # All handle I/O goes through the raw fd
+        file = await executor.run("interactive", open, p, f"{mode}b", 0)
+        try:
+            return handles.add(file, p, CURRENT_CLIENT.get())
+        except OSError:
+            await executor.run("interactive", file.close)
+            raise
+
+    def create_async_file(handle):
+        return {
+            "_rintf": True,
+            "stat": lambda: file_stat(handle),
+            "close": lambda: file_close(handle),
+            "truncate": lambda length: file_truncate(handle, length),
+            "sync": lambda: file_sync(handle),
+            "write": lambda buffer, offset, length, position: file_write(handle, buffer, offset, length, position),
+            "read": lambda buffer, offset, length, position: file_read(handle, buffer, offset, length, position),
+            "readMany": lambda ranges: file_read_many(handle, ranges),
+            "datasync": lambda: file_datasync(handle),
+            "chown": lambda uid, gid: file_chown(handle, uid, gid),
+            "chmod": lambda mode: file_chmod(handle, mode),
+            "utimes": lambda atime, mtime: file_utimes(handle, atime, mtime),
+        }
+
+    def convert_stat_to_dict(stats):
+        mtime = int(stats.st_mtime)
+        return {
+            "_rintf": True,
+            "st_mode": stats.st_mode,
+            "st_ino": stats.st_ino,
+            "st_dev": stats.st_dev,
+            "st_nlink": stats.st_nlink,
+            "st_uid": stats.st_uid,
+            "st_gid": stats.st_gid,
+            "st_size": stats.st_size,
+            "st_atime": stats.st_atime,
+            "st_mtime": stats.st_mtime,
+            "st_ctime": stats.st_ctime,
+            "mtime": mtime * 1000,
+            "size": stats.st_size,
+            "isDirectory": stat_module.S_ISDIR(stats.st_mode),
+            "isFile": stat_module.S_ISREG(stats.st_mode),
+        }
+
+    def stat_result_with_mime(stats, p):
+        """Convert stats to a dict and add the mime property that elFinder expects."""
+        result = convert_stat_to_dict(stats)
+        if result["isDirectory"]:
+            result["mime"] = "directory"
+        else:
+            # For files, try to get a mime type based on extension
+            result["mime"] = metadata_cache.guess_mime(os.path.basename(p))
+        return result
+
+    def to_virtual_path(p):
+        """Map an absolute path under the workdir back to the path the client sees."""
+        rel_path = os.path.relpath(p, workdir)
+        return "/" if rel_path == "." else "/" + rel_path.replace(os.path.sep, "/")
+
+    def resolve_path(p):
+        """Safely resolve a path relative to the workdir.
+        
+        This function ensures that:
+        1. All paths are safely joined using safe_join
+        2. Paths cannot escape the workdir
+        3. Root paths (/) are mapped to workdir
+        4. Special prefixes like /async-file-service/ are handled
+        
+        Args:
+            p: The path to resolve
+            
+        Returns:
+            str: The safely resolved absolute path
+            
+        Raises:
+            Exception: If the path is illegal or tries to escape workdir
+        """
+        logger.debug("Resolving path: %s", p)
+        
+        # Handle empty or None paths
+        if not p:
+            return workdir
+            
+        # Detect and prevent path duplication issue
+        if workdir in p:
+            # If the workdir is already in the path, extract just the relative part
+            rel_path = p.replace(workdir, '')
+            # Remove any leading slashes from the relative path
+            rel_path = rel_path.lstrip('/')
+            logger.debug("Path contains workdir already, extracted relative part: %s", rel_path)
+            p = rel_path
+        # Handle absolute paths by making them relative to workdir
+        elif p.startswith("/"):
+            p = p[1:]  # Remove leading slash to make relative
+            
+        # Use safe_join to ensure path cannot escape workdir
+        try:
+            resolved = safe_join(workdir, p)
+            if resolved is None:
+                raise Exception(f"Invalid path: {p}")
+            logger.debug("Resolved path: %s", resolved)
+            return resolved
+        except Exception as e:
+            logger.error(f"Failed to resolve path {p}: {str(e)}")
+            raise Exception(f"Failed to resolve path {p}: {str(e)}")
+
+    async def file_stat(handle):
+        with handles.use(handle) as file:
+            stats = await executor.run("interactive", os.fstat, file.fileno())
+        return convert_stat_to_dict(stats)
+
+    async def file_close(handle):
+        await handles.close(handle)
+
+    async def file_truncate(handle, length):
+        with handles.use(handle) as file:
+            await executor.run("interactive", file.truncate, length)
+            content_cache.invalidate(handle["path"])
+            handles.invalidate(handle["path"])
+
+    async def file_sync(handle):
+        with handles.use(handle) as file:
+            await executor.run("bulk", os.fsync, file.fileno())
+
+    # Handle I/O is positional (pread/pwrite), so concurrent calls on one
+    # handle never race on a shared file position
+    async def file_write(handle, buffer, offset, length, position):
+        with handles.use(handle) as file:
+            written = await executor.run(io_lane(length), pwrite_from, file.fileno(), buffer, offset, length, position)
+            # Dropped after the write, so read-ahead overlapping it is discarded too
+            content_cache.invalidate(handle["path"])
+            handles.invalidate(handle["path"])
+        metrics.add_bytes("written", written)
+        return written
+
+    async def file_read(handle, buffer, offset, length, position):
+        with handles.use(handle) as file:
+            read = handles.read_buffered(handle, buffer, offset, length, position)
+            if read is None:
+                size = handles.readahead_size(handle, position, length)
+                if size > length:
+                    generation = handle["generation"]
+                    data = await executor.run(io_lane(size), os.pread, file.fileno(), size, position)
+                    read = min(len(data), length)
+                    memoryview(buffer)[offset:offset + read] = memoryview(data)[:read]
+                    handles.fill(handle, position, data, size, generation)
+                else:
+                    read = await executor.run(io_lane(length), pread_into, file.fileno(), buffer, offset, length, position)
+                handle["next"] = position + read
+        metrics.add_bytes("read", read)
+        return read
+
+    async def file_read_many(handle, ranges):
+        """Read a batch of ``(offset, length)`` ranges in one round-trip."""
+        with handles.use(handle) as file:
+            lane = io_lane(sum(length for _, length in ranges))
+            chunks = await executor.run(lane, pread_ranges, file.fileno(), ranges)
+        metrics.add_bytes("read", sum(len(chunk) for chunk in chunks))
+        return chunks
+
+    async def file_datasync(handle):
+        with handles.use(handle) as file:
+            await executor.run("bulk", os.fdatasync, file.fileno())
+
+    async def file_chown(handle, uid, gid):
+        with handles.use(handle):
+            await executor.run("interactive", os.chown, handle["path"], uid, gid)
+
+    async def file_chmod(handle, mode):
+        with handles.use(handle):
+            await executor.run("interactive", os.chmod, handle["path"], mode)
+
+    async def file_utimes(handle, atime, mtime):
+        with handles.use(handle):
+            await executor.run("interactive", os.utime, handle["path"], (atime, mtime))
+
+    # Handle operations are measured as "file.<operation>"
+    file_stat = metrics.instrument("file.stat", file_stat)
+    file_close = metrics.instrument("file.close", file_close)
+    file_truncate = metrics.instrument("file.truncate", file_truncate)
+    file_sync = metrics.instrument("file.sync", file_sync)
+    file_write = metrics.instrument("file.write", file_write)
+    file_read = metrics.instrument("file.read", file_read)
+    file_read_many = metrics.instrument("file.readMany", file_read_many)
+
+    async def diskSpace(p):
+        p = resolve_path(p)
+        statvfs = await executor.run("interactive", os.statvfs, p)
+        total = statvfs.f_frsize * statvfs.f_blocks
+        free = statvfs.f_frsize * statvfs.f_bavail
+        return {"total": total, "free": free}
+
+    async def openFile(p, flag):
+        p = resolve_path(p)
+        try:
+            handle = await open_handle(p, js_flag_to_python_mode(flag))
+            return create_async_file(handle)
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def createFile(p, flag, mode):
+        p = resolve_path(p)
+        try:
+            handle = await open_handle(p, js_flag_to_python_mode(flag))
+            notify_changed(p)
+            if mode is not None:
+                await executor.run("interactive", os.chmod, p, mode)
+            return create_async_file(handle)
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def rename(oldPath, newPath):
+        oldPath = resolve_path(oldPath)
+        newPath = resolve_path(newPath)
+        try:
+            await executor.run("interactive", os.rename, oldPath, newPath)
+            notify_changed(oldPath)
+            notify_changed(newPath)
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def stat(p, isLstat=False):
+        p = resolve_path(p)
+        try:
+            kind = "lstat" if isLstat else "stat"
+            cached = metadata_cache.get(kind, p)
+            if cached is not None:
+                return dict(cached)
+            logger.debug("Getting stat for: %s (isLstat: %s)", p, isLstat)
+            stats = await executor.run("interactive", os.lstat if isLstat else os.stat, p)
+            result = stat_result_with_mime(stats, p)
+            metadata_cache.put(kind, p, result, is_directory=stat_module.S_ISDIR(stats.st_mode))
+            result = dict(result)
+            logger.debug("Stat result for %s: isDir=%s, isFile=%s, mime=%s", p, result['isDirectory'], result['isFile'], result['mime'])
+            return result
+        except Exception as e:
+            logger.error(f"Error in stat for {p}: {str(e)}", exc_info=True)
+            # Raise the error so it can be properly handled by the JavaScript client
+            raise e
+
+    async def unlink(p):
+        p = resolve_path(p)
+        try:
+            await executor.run("interactive", os.unlink, p)
+            notify_changed(p)
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def rmdir(p):
+        p = resolve_path(p)
+        try:
+            await executor.run("interactive", os.rmdir, p)
+            notify_changed(p)
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def mkdir(p, mode):
+        try:
+            p = resolve_path(p)
+            logger.debug("Creating directory: %s, mode: %s", p, mode)
+            await executor.run("interactive", functools.partial(os.makedirs, p, mode=mode, exist_ok=True))
+            notify_changed(p, ancestors=True)
+            return {"success": True}
+        except Exception as e:
+            error_msg = f"Error creating directory {p}: {str(e)}"
+            logger.error(error_msg, exc_info=True)
+            return {"error": error_msg}
+
+    async def readdir(p):
+        try:
+            p = resolve_path(p)
+            logger.debug("Reading directory: %s", p)
+
+            cached = metadata_cache.get("readdir", p)
+            if cached is not None:
+                return list(cached)
+
+            # Ensure directory exists
+            if not await executor.run("interactive", os.path.exists, p):
+                await executor.run("interactive", functools.partial(os.makedirs, p, exist_ok=True))
+                notify_changed(p, ancestors=True)
+            
+            # Get directory listing
+            files = await executor.run("interactive", os.listdir, p)
+            if os.path.normpath(p) == workdir:
+                files = [name for name in files if name not in (TRASH_DIRECTORY, UPLOAD_DIRECTORY)]
+            metadata_cache.put("readdir", p, files, weight=len(files) + 1)
+            files = list(files)
+            
+            # Process the files with simplified info
+            
+            logger.debug("Directory contents: %s items", len(files))
+            return files
+        except Exception as e:
+            error_msg = f"Error reading directory {p}: {str(e)}"
+            logger.error(error_msg, exc_info=True)
+            raise e
+    
+    # Directory snapshots backing the cursors handed out by readdirpage
+    listing_snapshots = OrderedDict()
+
+    def scan_directory(p, sortBy=None, reverse=False):
+        """List a directory with os.scandir, optionally sorted by name, size or mtime."""
+        with os.scandir(p) as it:
+            entries = [entry for entry in it if entry.path not in hidden_dirs]
+        if sortBy == "name":
+            entries.sort(key=lambda entry: entry.name, reverse=reverse)
+        elif sortBy in ("size", "mtime"):
+            attr = "st_size" if sortBy == "size" else "st_mtime"
+
+            def sort_key(entry):
+                try:
+                    return getattr(entry.stat(), attr)
+                except OSError:
+                    return 0
+
+            entries.sort(key=sort_key, reverse=reverse)
+        elif sortBy is not None:
+            raise ValueError(f"Unsupported sort key: {sortBy}")
+        return entries
+
+    async def entries_with_stats(entries):
+        """Build stat dicts from DirEntry objects; entries that cannot be stat'ed are skipped."""
+        result = []
+        for name, stats in await executor.run("interactive", stat_entries, entries):
+            file_stats = stat_result_with_mime(stats, name)
+            # Add the name to the stats object for easier processing on the client
+            file_stats["name"] = name
+            result.append(file_stats)
+        return result
+
+    async def readdirwithstats(p):
+        p = resolve_path(p)
+        try:
+            cached = metadata_cache.get("readdirwithstats", p)
+            if cached is not None:
+                return [dict(file_stats) for file_stats in cached]
+            logger.debug("Reading directory with stats: %s", p)
+            result = await entries_with_stats(await executor.run("interactive", scan_directory, p))
+            metadata_cache.put("readdirwithstats", p, result, weight=len(result) + 1)
+            return [dict(file_stats) for file_stats in result]
+        except Exception as e:
+            logger.error(f"Error in readdirwithstats for {p}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def listing_page(p, cursor, limit, sortBy, reverse):
+        """Return ``(entries, total, next_cursor)`` of one page of a directory snapshot.
+
+        Raises ValueError if ``cursor`` refers to an expired snapshot or
+        ``limit`` is not a positive integer; it is clamped to ``LISTING_PAGE_MAX``.
+        """
+        limit = page_limit(limit)
+        if cursor:
+            token, _, offset = cursor.rpartition(":")
+            snapshot = listing_snapshots.get(token)
+            if snapshot is None:
+                raise ValueError(f"Listing cursor expired: {cursor}")
+            listing_snapshots.move_to_end(token)
+            offset = int(offset)
+        else:
+            p = resolve_path(p)
+            snapshot = await executor.run("interactive", scan_directory, p, sortBy, reverse)
+            token = uuid.uuid4().hex
+            listing_snapshots[token] = snapshot
+            while len(listing_snapshots) > LISTING_SNAPSHOT_LIMIT:
+                listing_snapshots.popitem(last=False)
+            offset = 0
+
+        next_offset = offset + limit
+        if next_offset >= len(snapshot):
+            listing_snapshots.pop(token, None)
+            next_cursor = None
+        else:
+            next_cursor = f"{token}:{next_offset}"
+        return snapshot[offset:next_offset], len(snapshot), next_cursor
+
+    async def readdirpage(p, cursor=None, limit=LISTING_PAGE_SIZE, sortBy=None, reverse=False):
+        """Read a directory with stats, one page at a time.
+
+        The first call (without ``cursor``) takes a snapshot of the directory,
+        sorted by ``sortBy`` ("name", "size" or "mtime") if given. Pass the
+        returned ``cursor`` to get the next page; it is ``None`` on the last page.
+
+        Returns:
+            dict: ``{"entries": [...], "total": int, "cursor": str or None}``
+        """
+        try:
+            entries, total, next_cursor = await listing_page(p, cursor, limit, sortBy, reverse)
+            return {"entries": await entries_with_stats(entries), "total": total, "cursor": next_cursor}
+        except Exception as e:
+            logger.error(f"Error in readdirpage for {p}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def readdircolumns(p, fields=None, cursor=None, limit=LISTING_PAGE_SIZE, sortBy=None, reverse=False):
+        """Read a directory page like :func:`readdirpage`, encoded as columns.
+
+        Instead of one stat dict per entry, the page holds ``names`` and one
+        typed array per requested field (see ``LISTING_COLUMNS``; by default
+        size, mtime, mode and mime), which is much smaller on the wire and
+        can be decoded without building per-entry objects.
+
+        Returns:
+            dict: the :func:`stats_to_columns` encoding plus ``total`` and ``cursor``
+        """
+        try:
+            entries, total, next_cursor = await listing_page(p, cursor, limit, sortBy, reverse)
+            rows = await executor.run("interactive", stat_entries, entries)
+            result = stats_to_columns(rows, fields, metadata_cache.guess_mime)
+            result["total"] = total
+            result["cursor"] = next_cursor
+            return result
+        except Exception as e:
+            logger.error(f"Error in readdircolumns for {p}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def exists(p):
+        try:
+            p = resolve_path(p)
+            exists = metadata_cache.get("exists", p)
+            if exists is not None:
+                return exists
+            logger.debug("Checking if path exists: %s", p)
+            exists = await executor.run("interactive", os.path.exists, p)
+            metadata_cache.put("exists", p, exists)
+            logger.debug("Path %s exists: %s", p, exists)
+            return exists
+        except Exception as e:
+            logger.error(f"Error checking if path exists {p}: {str(e)}", exc_info=True)
+            # Return False instead of raising to match expected behavior
+            return False
+
+    async def realpath(p, cache):
+        p = resolve_path(p)
+        try:
+            resolved = metadata_cache.get("realpath", p)
+            if resolved is None:
+                resolved = await executor.run("interactive", os.path.realpath, p)
+                metadata_cache.put("realpath", p, resolved)
+            return resolved
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def readFile(fname, encoding, flag, compression=None):
+        """Read a whole file, as text unless ``encoding`` is "binary".
+
+        With ``compression`` (see :func:`negotiate_codec`) the result is a
+        payload dict ``{"codec", "data", "size"}`` whose ``data`` is
+        compressed if that is worth it; text is then sent as UTF-8 bytes and
+        the dict also has ``"encoding": "utf-8"``.
+        """
+        try:
+            fname = resolve_path(fname)
+            logger.debug("Reading file: %s, encoding: %s, flag: %s", fname, encoding, flag)
+            
+            py_mode = js_flag_to_python_mode(flag)
+            py_encoding = js_encoding_to_python(encoding)
+            
+            stats = await executor.run("interactive", os.stat, fname)
+            if py_mode == "r" and content_cache.enabled:
+                data = await read_cached(fname, stats, 0, stats.st_size)
+                if py_encoding is not None:
+                    data = await executor.run(io_lane(len(data)), decode_text, data, py_encoding)
+            else:
+                # Small files are read on the interactive lane, large ones on the bulk lane
+                data = await executor.run(io_lane(stats.st_size), read_file, fname, py_mode, py_encoding)
+
+            logger.debug("Successfully read file: %s", fname)
+            metrics.add_bytes("read", len(data))
+            if compression:
+                text = isinstance(data, str)
+                if text:
+                    data = data.encode("utf-8")
+                codec, level = negotiate_codec(compression)
+                data = await executor.run(io_lane(len(data)), encode_payload, data, fname, codec, level)
+                if text:
+                    data["encoding"] = "utf-8"
+            return data
+        except Exception as e:
+            logger.error(f"Error reading file {fname}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def read_cached(p, stats, offset, length):
+        """Read a byte range of ``p`` through the content cache, given its current ``stats``.
+
+        Files too large for the cache are read with pread; they are not
+        memory mapped, as a map faults (SIGBUS) once its file is truncated.
+        """
+        if stats.st_size > content_cache.max_file_size:
+            return await executor.run(io_lane(length), read_file_range, p, offset, length)
+        content = content_cache.get(p, stats)
+        if content is None:
+            validator, content = await executor.run(io_lane(stats.st_size), read_file_contents, p)
+            content_cache.put(p, validator, content)
+        if offset == 0 and length >= len(content):
+            return content
+        return content[offset:offset + length]
+
+    def resolve_range(size, offset, length):
+        """Clamp a byte range to the file size; a negative offset counts from the end."""
+        offset = offset or 0
+        if offset < 0:
+            offset = max(size + offset, 0)
+        offset = min(offset, size)
+        if length is None or offset + length > size:
+            length = size - offset
+        return offset, max(length, 0)
+
+    async def iter_file_chunks(p, chunk_size, offset, length):
+        """Yield the bytes of a file range in chunks of at most ``chunk_size`` bytes."""
+        fd = await executor.run("interactive", os.open, p, os.O_RDONLY)
+        try:
+            lane = io_lane(chunk_size)
+            position = offset
+            end = offset + length
+            while position < end:
+                chunk = await executor.run(lane, os.pread, fd, min(chunk_size, end - position), position)
+                if not chunk:
+                    break
+                position += len(chunk)
+                metrics.add_bytes("read", len(chunk))
+                yield chunk
+        finally:
+            os.close(fd)
+
+    async def readFileRange(fname, offset=0, length=None, compression=None):
+        """Read ``length`` bytes of a file starting at ``offset``.
+
+        Follows HTTP Range semantics: a negative ``offset`` reads the last
+        bytes of the file and the range is clamped to the file size. With
+        ``compression``, ``data`` may be compressed with the returned ``codec``.
+
+        Returns:
+            dict: ``{"data": bytes, "offset": int, "length": int, "size": int}``
+        """
+        try:
+            fname = resolve_path(fname)
+            stats = await executor.run("interactive", os.stat, fname)
+            size = stats.st_size
+            offset, length = resolve_range(size, offset, length)
+            if content_cache.enabled:
+                data = await read_cached(fname, stats, offset, length)
+            else:
+                data = await executor.run(io_lane(length), read_file_range, fname, offset, length)
+            metrics.add_bytes("read", len(data))
+            result = {"data": data, "offset": offset, "length": len(data), "size": size}
+            if compression:
+                codec, level = negotiate_codec(compression)
+                payload = await executor.run(io_lane(len(data)), encode_payload, data, fname, codec, level)
+                result.update(data=payload["data"], codec=payload["codec"])
+            return result
+        except Exception as e:
+            logger.error(f"Error reading range of file {fname}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def encode_chunks(chunks, name, compression):
+        """Pass chunks of file ``name`` on as payload dicts, compressed as negotiated by ``compression``.
+
+        Whether compressing is worth it is probed on the first chunk only.
+        Without ``compression`` chunks pass through unchanged.
+        """
+        codec, level = negotiate_codec(compression)
+        probed = False
+        async for chunk in chunks:
+            if not compression:
+                yield chunk
+                continue
+            if not probed:
+                probed = True
+                if codec is not None and not await executor.run("interactive", worth_compressing, chunk, name, codec):
+                    codec = None
+            data = chunk if codec is None else await executor.run(io_lane(len(chunk)), compress_payload, chunk, codec, level)
+            yield {"codec": codec, "data": data, "size": len(chunk)}
+
+    async def readFileChunks(fname, chunkSize=READ_CHUNK_SIZE, offset=0, length=None, compression=None):
+        """Stream a file (or a byte range of it) as a generator of chunks.
+
+        Chunks are read on demand as the client pulls them, so memory use is
+        bounded by ``chunkSize`` regardless of the file size. With
+        ``compression`` each chunk is a payload dict ``{"codec", "data", "size"}``.
+        """
+        fname = resolve_path(fname)
+        stats = await executor.run("interactive", os.stat, fname)
+        offset, length = resolve_range(stats.st_size, offset, length)
+        async for chunk in encode_chunks(iter_file_chunks(fname, chunkSize, offset, length), fname, compression):
+            yield chunk
+
+    async def readFileStream(fname, callback, chunkSize=READ_CHUNK_SIZE, maxInFlight=READ_MAX_IN_FLIGHT, offset=0, length=None,
+                             compression=None):
+        """Push a file (or a byte range of it) to ``callback(chunk, position)`` in chunks.
+
+        At most ``maxInFlight`` callbacks are pending at any time, which bounds
+        memory use to ``chunkSize * maxInFlight`` bytes. With ``compression``
+        each chunk is a payload dict ``{"codec", "data", "size"}``.
+
+        Returns:
+            dict: ``{"success": True, "bytes": int, "size": int}``
+        """
+        try:
+            fname = resolve_path(fname)
+            size = (await executor.run("interactive", os.stat, fname)).st_size
+            offset, length = resolve_range(size, offset, length)
+            in_flight = asyncio.Semaphore(maxInFlight)
+            pending = set()
+
+            async def deliver(chunk, position):
+                try:
+                    await callback(chunk, position)
+                finally:
+                    in_flight.release()
+
+            position = offset
+            try:
+                chunks = encode_chunks(iter_file_chunks(fname, chunkSize, offset, length), fname, compression)
+                async for chunk in chunks:
+                    await in_flight.acquire()
+                    # Surface callback failures before reading further
+                    for task in [t for t in pending if t.done()]:
+                        pending.discard(task)
+                        task.result()
+                    pending.add(asyncio.ensure_future(deliver(chunk, position)))
+                    position += chunk["size"] if compression else len(chunk)
+                await asyncio.gather(*pending)
+            except BaseException:
+                for task in pending:
+                    task.cancel()
+                raise
+            return {"success": True, "bytes": position - offset, "size": size}
+        except Exception as e:
+            logger.error(f"Error streaming file {fname}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def writeFile(fname, data, encoding, flag, mode, compression=None, size=None):
+        """Write a whole file; ``compression`` names the codec ``data`` is compressed with, if any.
+
+        Compressed ``data`` must decompress to exactly ``size`` bytes when
+        given, and to at most ``--max-decompressed-size`` bytes in any case.
+        """
+        try:
+            fname = resolve_path(fname)
+            logger.debug("Writing file: %s, encoding: %s, flag: %s, mode: %s", fname, encoding, flag, mode)
+            
+            # Convert mode from decimal to octal if it's a number
+            if isinstance(mode, int):
+                mode = oct(mode)[2:]  # Convert to octal string without '0o' prefix
+                mode = int(mode, 8)  # Convert back to int in octal
+                logger.debug("Converted mode to octal: %s", oct(mode))
+
+            # Create parent directory if it doesn't exist
+            dirname = os.path.dirname(fname)
+            if dirname:
+                try:
+                    await executor.run("interactive", functools.partial(os.makedirs, dirname, exist_ok=True))
+                except Exception as e:
+                    logger.error(f"Failed to create directory {dirname}: {str(e)}")
+            
+            py_encoding = js_encoding_to_python(encoding)
+            py_mode = js_flag_to_python_mode(flag)
+            
+            logger.debug("Python mode: %s, encoding: %s", py_mode, py_encoding)
+            
+            # Handle binary vs text mode
+            try:
+                if compression:
+                    limit = args.max_decompressed_size if size is None else min(size, args.max_decompressed_size)
+                    data = await executor.run(io_lane(len(data)), decompress_payload, data, compression, limit)
+                    if size is not None and len(data) != size:
+                        raise ValueError(f"Decompressed payload has {len(data)} bytes instead of {size}")
+                    if py_encoding is not None:
+                        data = data.decode(py_encoding)
+                if py_encoding is None and isinstance(data, str):
+                    data = data.encode()
+                await executor.run(io_lane(len(data)), write_file, fname, py_mode, data, py_encoding)
+                
+                # Set mode after file is created
+                if mode is not None:
+                    await executor.run("interactive", os.chmod, fname, mode)
+                notify_changed(fname, ancestors=True)
+                metrics.add_bytes("written", len(data))
+                    
+                logger.debug("Successfully wrote file: %s", fname)
+                return {"success": True}
+            except Exception as e:
+                error_msg = f"Failed to write file {fname}: {str(e)}"
+                logger.error(error_msg, exc_info=True)
+                return {"error": error_msg}
+        except Exception as e:
+            error_msg = f"Error in writeFile {fname}: {str(e)}"
+            logger.error(error_msg, exc_info=True)
+            return {"error": error_msg}
+
+    async def appendFile(fname, data, encoding, flag, mode):
+        try:
+            fname = resolve_path(fname)
+            py_encoding = js_encoding_to_python(encoding)
+            py_mode = js_flag_to_python_mode(flag) if flag else 'a'
+            
+            if py_encoding is None and isinstance(data, str):
+                data = data.encode()
+            await executor.run(io_lane(len(data)), write_file, fname, py_mode, data, py_encoding)
+            
+            if mode is not None:
+                await executor.run("interactive", os.chmod, fname, mode)
+            notify_changed(fname)
+            metrics.add_bytes("written", len(data))
+                
+            return {"success": True}
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def symlink(srcpath, dstpath, type):
+        srcpath = resolve_path(srcpath)
+        dstpath = resolve_path(dstpath)
+        try:
+            await executor.run("interactive", os.symlink, srcpath, dstpath, type == 'dir')
+            notify_changed(dstpath)
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def getCacheStats():
+        """Return hit/miss counters and occupancy of the metadata cache."""
+        return metadata_cache.stats()
+
+    async def getMetrics(format=None):
+        """Return per-method call counts, latencies, errors and in-flight gauges.
+
+        With ``format="prometheus"`` the metrics are rendered in the
+        Prometheus text exposition format instead of a dict. ``format="state"``
+        returns the raw counters and histograms, which worker mode merges.
+        """
+        try:
+            if format == "prometheus":
+                return (metrics.prometheus() + executor.prometheus() + handles.prometheus()
+                        + metadata_cache.prometheus())
+            if format == "state":
+                return {
+                    "service": metrics.state(),
+                    "prometheus": executor.prometheus() + handles.prometheus() + metadata_cache.prometheus(),
+                    "metadataCache": metadata_cache.stats(),
+                    "contentCache": content_cache.stats(),
+                    "executors": executor.stats(),
+                    "handles": handles.stats(),
+                }
+            if format is not None:
+                raise ValueError(f"Unsupported metrics format: {format}")
+            result = metrics.snapshot()
+            result["metadataCache"] = metadata_cache.stats()
+            result["contentCache"] = content_cache.stats()
+            result["executors"] = executor.stats()
+            result["handles"] = handles.stats()
+            return result
+        except Exception as e:
+            logger.error(f"Error collecting metrics: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def getTraces(limit=100):
+        """Return the most recent sampled call traces, newest last."""
+        try:
+            return list(metrics.traces)[-page_limit(limit, TRACE_BUFFER_SIZE):]
+        except Exception as e:
+            return {"error": str(e)}
+
+    copy_pool = ThreadPoolExecutor(max_workers=args.copy_workers, thread_name_prefix="copy")
+
+    def make_progress(callback, **totals):
+        """Create a progress state dict and a throttled coroutine reporting it to ``callback``."""
+        state = {"files": 0, "bytes": 0, "skipped": 0, "errors": 0, **totals}
+        last_report = [0.0]
+
+        async def report(force=False):
+            now = time.monotonic()
+            if callback is None or (not force and now - last_report[0] < PROGRESS_INTERVAL):
+                return
+            last_report[0] = now
+            try:
+                await callback(dict(state))
+            except Exception as e:
+                logger.warning(f"Progress callback failed: {str(e)}")
+
+        return state, report
+
+    async def transfer_tree(src, dst, policy, move, progress_callback):
+        """Copy or move a file or directory tree on the copy pool."""
+        if dst == src or dst.startswith(src.rstrip("/") + "/"):
+            raise ValueError(f"Cannot copy or move {to_virtual_path(src)} into itself")
+        loop = asyncio.get_running_loop()
+        directories, files, symlinks = await loop.run_in_executor(copy_pool, plan_tree_copy, src, dst)
+        state, report = make_progress(
+            progress_callback,
+            totalFiles=len(files) + len(symlinks),
+            totalBytes=sum(size for _, _, size in files),
+        )
+        errors = []
+
+        def make_directories():
+            for _, dst_dir, mode in directories:
+                try:
+                    os.makedirs(dst_dir, mode=mode, exist_ok=True)
+                except OSError as e:
+                    errors.append({"path": to_virtual_path(dst_dir), "error": str(e)})
+
+        await loop.run_in_executor(copy_pool, make_directories)
+
+        jobs = iter([(s, d, size) for s, d, size in files] + [(s, d, 0) for s, d in symlinks])
+
+        async def worker():
+            for src_file, dst_file, size in jobs:
+                try:
+                    done = await loop.run_in_executor(copy_pool, transfer_file, src_file, dst_file, policy, move)
+                except Exception as e:
+                    state["errors"] += 1
+                    errors.append({"path": to_virtual_path(src_file), "error": str(e)})
+                    continue
+                if done:
+                    state["files"] += 1
+                    state["bytes"] += size
+                else:
+                    state["skipped"] += 1
+                await report()
+
+        await asyncio.gather(*[worker() for _ in range(args.copy_workers)])
+
+        if move:
+            def remove_source_directories():
+                # Bottom-up; directories still holding skipped or failed files stay
+                for src_dir, _, _ in reversed(directories):
+                    try:
+                        os.rmdir(src_dir)
+                    except OSError:
+                        pass
+
+            await loop.run_in_executor(copy_pool, remove_source_directories)
+            notify_changed(src)
+        notify_changed(dst, ancestors=True)
+        await report(force=True)
+        return {**state, "success": not errors, "errors": errors}
+
+    async def copyTree(src, dst, options=None):
+        """Copy a file or directory tree to ``dst`` on the server.
+
+        Files are copied kernel-side (copy_file_range/sendfile) in parallel on
+        the copy pool. Supported ``options``:
+
+        - ``overwrite``: "error" (default), "overwrite" or "skip", applied to
+          files that already exist in ``dst``; directories are merged.
+        - ``onProgress``: callback receiving progress dicts while copying.
+
+        Returns:
+            dict: Counts of copied/skipped files and bytes plus per-path ``errors``.
+        """
+        options = options or {}
+        try:
+            src = resolve_path(src)
+            dst = resolve_path(dst)
+            return await transfer_tree(src, dst, options.get("overwrite", "error"), False, options.get("onProgress"))
+        except Exception as e:
+            logger.error(f"Error copying {src} to {dst}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def moveTree(src, dst, options=None):
+        """Move a file or directory tree to ``dst`` on the server.
+
+        A single ``os.rename`` is used when ``dst`` does not exist and is on
+        the same device. Otherwise the tree is moved file by file (rename on
+        the same device, copy + unlink across devices) with the same
+        ``options`` as :func:`copyTree`.
+        """
+        options = options or {}
+        try:
+            src = resolve_path(src)
+            dst = resolve_path(dst)
+            return await move_tree(src, dst, options.get("overwrite", "error"), options.get("onProgress"))
+        except Exception as e:
+            logger.error(f"Error moving {src} to {dst}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def move_tree(src, dst, policy, progress_callback):
+        """Move ``src`` to ``dst`` with one rename if possible, file by file otherwise."""
+        if not await executor.run("interactive", os.path.lexists, dst):
+            try:
+                await asyncio.get_running_loop().run_in_executor(copy_pool, os.rename, src, dst)
+                notify_changed(src)
+                notify_changed(dst)
+                return {"success": True, "renamed": True, "errors": []}
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+        return await transfer_tree(src, dst, policy, True, progress_callback)
+
+    async def moveMany(pairs, options=None):
+        """Move many files or directory trees on the server in one call.
+
+        ``pairs`` is a list of ``(src, dst)`` pairs, each moved as by
+        :func:`moveTree`; up to ``--copy-workers`` of them are moved at once.
+        Supported ``options``:
+
+        - ``overwrite``: as for :func:`copyTree`.
+        - ``onProgress``: callback receiving progress dicts (``paths`` moved
+          out of ``totalPaths``) while moving.
+
+        Returns:
+            dict: The ``paths`` moved and per-path ``errors``.
+        """
+        options = options or {}
+        policy = options.get("overwrite", "error")
+        state, report = make_progress(options.get("onProgress"), paths=0, totalPaths=len(pairs))
+        errors = []
+        jobs = iter(pairs)
+
+        async def worker():
+            for src, dst in jobs:
+                try:
+                    result = await move_tree(resolve_path(src), resolve_path(dst), policy, None)
+                except Exception as e:
+                    result = {"error": str(e)}
+                if result.get("error"):
+                    errors.append({"path": src, "error": result["error"]})
+                else:
+                    errors.extend(result["errors"])
+                if result.get("success"):
+                    state["paths"] += 1
+                else:
+                    state["errors"] += 1
+                await report()
+
+        await asyncio.gather(*[worker() for _ in range(min(args.copy_workers, len(pairs)) or 1)])
+        await report(force=True)
+        return {**state, "success": not errors, "errors": errors}
+
+    # Background purges of trashed trees by trash path
+    purge_tasks = {}
+
+    async def remove_tree(paths, progress_callback):
+        """Remove files and directory trees, unlinking files in batches on the copy pool."""
+        loop = asyncio.get_running_loop()
+        errors = []
+        files = []
+        directories = []
+        for p in paths:
+            try:
+                tree_files, tree_directories = await loop.run_in_executor(copy_pool, plan_tree_removal, p)
+            except OSError as e:
+                errors.append({"path": to_virtual_path(p), "error": str(e)})
+                continue
+            files.extend(tree_files)
+            directories.extend(tree_directories)
+        state, report = make_progress(progress_callback, directories=0,
+                                      totalFiles=len(files), totalDirectories=len(directories))
+        batches = iter(range(0, len(files), REMOVE_BATCH_SIZE))
+
+        async def worker():
+            for start in batches:
+                batch = files[start:start + REMOVE_BATCH_SIZE]
+                failed = await loop.run_in_executor(copy_pool, unlink_files, batch)
+                state["files"] += len(batch) - len(failed)
+                state["errors"] += len(failed)
+                errors.extend({"path": to_virtual_path(p), "error": error} for p, error in failed)
+                await report()
+
+        await asyncio.gather(*[worker() for _ in range(args.copy_workers)])
+
+        def remove_directories():
+            for directory in directories:
+                try:
+                    os.rmdir(directory)
+                    state["directories"] += 1
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    # Directories still holding files that failed are expected to stay
+                    if e.errno != errno.ENOTEMPTY or not errors:
+                        state["errors"] += 1
+                        errors.append({"path": to_virtual_path(directory), "error": str(e)})
+
+        await loop.run_in_executor(copy_pool, remove_directories)
+        for p in paths:
+            notify_changed(p)
+        await report(force=True)
+        return {**state, "success": not errors, "errors": errors}
+
+    async def purge_trash(p):
+        try:
+            result = await remove_tree([p], None)
+            if result["errors"]:
+                logger.warning(f"Failed to purge {len(result['errors'])} entries of {p}: {result['errors'][0]}")
+        except Exception as e:
+            logger.error(f"Error purging {p}: {str(e)}", exc_info=True)
+        finally:
+            purge_tasks.pop(p, None)
+
+    # Trees trashed before a crash or restart are purged again, unless another process does that
+    leftovers = await executor.run("bulk", sweep_trash_directory, trash_dir)
+    if not args.no_sweep:
+        for trash in leftovers:
+            purge_tasks[trash] = asyncio.ensure_future(purge_trash(trash))
+
+    async def removeTree(paths, options=None):
+        """Remove files and directory trees on the server.
+
+        Trees are walked with scandir and their files unlinked in parallel on
+        the copy pool. Supported ``options``:
+
+        - ``trash``: rename each path into the trash directory under the root
+          and return at once; the trashed trees are then purged in the
+          background, or at the next start if the service stops first.
+        - ``onProgress``: callback receiving progress dicts (``files`` and
+          ``directories`` removed out of ``totalFiles``/``totalDirectories``)
+          while removing.
+
+        Returns:
+            dict: Counts of removed files and directories (or the ``trashed``
+            paths) plus per-path ``errors``.
+        """
+        options = options or {}
+        try:
+            resolved = [os.path.normpath(resolve_path(p)) for p in paths]
+            if workdir in resolved:
+                raise ValueError("Cannot remove the root directory")
+            if not options.get("trash"):
+                return await remove_tree(resolved, options.get("onProgress"))
+            trashed = []
+            errors = []
+            for p in resolved:
+                trash = os.path.join(trash_dir, uuid.uuid4().hex)
+                try:
+                    await executor.run("interactive", os.rename, p, trash)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        errors.append({"path": to_virtual_path(p), "error": str(e)})
+                        continue
+                    # Mounted from another device: remove it in place instead
+                    result = await remove_tree([p], None)
+                    errors.extend(result["errors"])
+                    if not result["errors"]:
+                        trashed.append(to_virtual_path(p))
+                    continue
+                notify_changed(p)
+                trashed.append(to_virtual_path(p))
+                purge_tasks[trash] = asyncio.ensure_future(purge_trash(trash))
+            return {"success": not errors, "trashed": trashed, "errors": errors}
+        except Exception as e:
+            logger.error(f"Error removing {paths}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    def archive_sources(paths):
+        """Resolve archive input paths to ``(path, arcname)`` pairs."""
+        sources = []
+        for p in paths:
+            p = os.path.normpath(resolve_path(p))
+            if p == workdir:
+                raise ValueError("Cannot archive the root directory")
+            sources.append((p, os.path.basename(p)))
+        return sources
+
+    async def archive(paths, dest, format="zip"):
+        """Build a zip or tar.gz archive of ``paths`` on the server and save it as ``dest``.
+
+        The archive is written to a temporary file next to ``dest`` and
+        renamed into place once complete.
+        """
+        try:
+            sources = archive_sources(paths)
+            dest = resolve_path(dest)
+            tmp_path = f"{dest}.{uuid.uuid4().hex}.tmp"
+
+            def build():
+                try:
+                    with open(tmp_path, "wb") as f:
+                        write_archive(f, sources, format)
+                    os.replace(tmp_path, dest)
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+                    raise
+
+            await executor.run("bulk", build)
+            notify_changed(dest)
+            size = (await executor.run("interactive", os.stat, dest)).st_size
+            return {"success": True, "path": to_virtual_path(dest), "size": size}
+        except Exception as e:
+            logger.error(f"Error creating archive {dest}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def archiveChunks(paths, format="zip", chunkSize=READ_CHUNK_SIZE):
+        """Stream a zip or tar.gz archive of ``paths`` as a generator of chunks.
+
+        The archive is built in a thread of its own while the client pulls
+        chunks; at most ``ARCHIVE_QUEUE_SIZE`` chunks are buffered, so memory
+        stays bounded regardless of the archive size. The thread blocks
+        while the client is not pulling, which is why it does not take an
+        executor lane slot away from other calls. It gives up, closing the
+        archived files, once the stream is closed or no chunk was pulled for
+        ``ARCHIVE_STALL_TIMEOUT`` seconds.
+        """
+        sources = archive_sources(paths)
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+        cancelled = False
+        pulled = time.monotonic()  # When the client last asked for a chunk
+        done = object()
+
+        def emit(item):
+            if cancelled:
+                raise asyncio.CancelledError("Archive stream closed by the client")
+            future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+            while True:
+                try:
+                    return future.result(timeout=ARCHIVE_POLL_INTERVAL)
+                except concurrent.futures.TimeoutError:
+                    pass
+                if cancelled or time.monotonic() - pulled > ARCHIVE_STALL_TIMEOUT:
+                    future.cancel()
+                    raise asyncio.CancelledError("Archive stream closed or abandoned by the client")
+
+        def build():
+            lower_thread_priority()
+            writer = ChunkWriter(emit, chunkSize)
+            try:
+                write_archive(writer, sources, format)
+                writer.close()
+                emit(done)
+            except asyncio.CancelledError:
+                pass  # Nobody reads the stream any more
+            except BaseException as e:
+                with contextlib.suppress(asyncio.CancelledError):
+                    emit(e)
+            finally:
+                with contextlib.suppress(RuntimeError):  # The loop may be closed already
+                    loop.call_soon_threadsafe(producer.set_result, None)
+
+        producer = loop.create_future()
+        threading.Thread(target=build, name="archive-stream", daemon=True).start()
+        try:
+            while True:
+                pulled = time.monotonic()
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            cancelled = True
+            # Unblock the producer if it is waiting on a full queue
+            while not queue.empty():
+                queue.get_nowait()
+            await producer
+
+    thumbnail_pool = None
+    thumbnail_slots = asyncio.Semaphore(args.thumbnail_workers)
+    thumbnail_pruned = -math.inf  # When the thumbnail cache was last pruned
+    thumbnail_prune_task = None
+
+    def thumbnail_cache_path(p, size):
+        """Cache file of a thumbnail, keyed by the image's inode, mtime and the thumbnail size."""
+        stats = os.stat(p)
+        key = f"{stats.st_dev}-{stats.st_ino}-{stats.st_mtime_ns}-{size}"
+        return os.path.join(args.thumbnail_cache_dir, f"{key}.png")
+
+    def read_cached_thumbnails(paths, size):
+        """Split ``paths`` into cached thumbnails and cache files still to render."""
+        cached, missing = [], []
+        for p in paths:
+            try:
+                cache_path = thumbnail_cache_path(resolve_path(p), size)
+            except Exception as e:
+                cached.append({"path": p, "error": str(e)})
+                continue
+            try:
+                with open(cache_path, "rb") as f:
+                    cached.append({"path": p, "data": f.read()})
+                # The mtime records the last use for pruning
+                with contextlib.suppress(OSError):
+                    os.utime(cache_path)
+            except FileNotFoundError:
+                missing.append((p, cache_path))
+            except Exception as e:
+                cached.append({"path": p, "error": str(e)})
+        return cached, missing
+
+    async def thumbnails(paths, size=THUMBNAIL_SIZE):
+        """Generate PNG thumbnails of images, as a generator of result batches.
+
+        The first batch holds every thumbnail already in the on-disk cache
+        (plus per-path errors); the remaining ones are rendered in a process
+        pool and yielded one by one as they complete. Each result is
+        ``{"path", "data"}`` or ``{"path", "error"}``.
+        """
+        nonlocal thumbnail_pool
+        if Image is None:
+            raise RuntimeError("Server-side thumbnails require Pillow to be installed")
+        loop = asyncio.get_running_loop()
+        await executor.run("interactive", functools.partial(os.makedirs, args.thumbnail_cache_dir, exist_ok=True))
+        cached, missing = await executor.run("interactive", read_cached_thumbnails, paths, size)
+        if cached:
+            yield cached
+        if not missing:
+            return
+        if thumbnail_pool is None:
+            thumbnail_pool = ProcessPoolExecutor(
+                max_workers=args.thumbnail_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+        async def render(p, cache_path):
+            async with thumbnail_slots:
+                try:
+                    data = await loop.run_in_executor(thumbnail_pool, render_thumbnail, resolve_path(p), cache_path, size)
+                    return {"path": p, "data": data}
+                except Exception as e:
+                    return {"path": p, "error": str(e)}
+
+        for task in asyncio.as_completed([render(p, cache_path) for p, cache_path in missing]):
+            yield [await task]
+        prune_thumbnails()
+
+    def prune_thumbnails():
+        """Prune the thumbnail cache in the background, at most every ``THUMBNAIL_PRUNE_INTERVAL`` seconds."""
+        nonlocal thumbnail_pruned, thumbnail_prune_task
+        if time.monotonic() - thumbnail_pruned < THUMBNAIL_PRUNE_INTERVAL:
+            return
+        thumbnail_pruned = time.monotonic()
+
+        async def prune():
+            try:
+                removed, remaining = await executor.run(
+                    "bulk", prune_thumbnail_cache, args.thumbnail_cache_dir,
+                    args.thumbnail_cache_size, args.thumbnail_cache_max_age,
+                )
+                if removed:
+                    logger.info(f"Pruned {removed} cached thumbnails, {remaining} bytes left")
+            except Exception as e:
+                logger.error(f"Error pruning the thumbnail cache: {str(e)}", exc_info=True)
+
+        thumbnail_prune_task = asyncio.ensure_future(prune())
+
+    async def search(query, path="/", mimes=None, limit=100, cursor=None):
+        """Search file names under ``path`` using the index.
+
+        ``query`` matches as a case-insensitive substring, or as a glob
+        pattern if it contains ``*``, ``?`` or ``[``. ``mimes`` restricts
+        results to mime types or type prefixes (e.g. ``["image"]``). Results
+        are ordered by path; pass the returned ``cursor`` for the next page.
+
+        Returns:
+            dict: ``{"entries": [...], "cursor": str or None}``
+        """
+        try:
+            if file_index is None:
+                return {"error": "The search index is disabled"}
+            rows, next_cursor = await file_index.search(query, resolve_path(path), mimes, page_limit(limit), cursor)
+            entries = [
+                {
+                    "path": "/" + rel_path,
+                    "name": name,
+                    "isDirectory": bool(is_dir),
+                    "isFile": not is_dir,
+                    "size": size,
+                    "mtime": int(mtime) * 1000,
+                    "mime": mime,
+                }
+                for rel_path, name, is_dir, size, mtime, mime in rows
+            ]
+            return {"entries": entries, "cursor": next_cursor}
+        except Exception as e:
+            logger.error(f"Error searching for {query} in {path}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def getIndexStatus():
+        """Return the size and crawl state of the search index."""
+        if file_index is None:
+            return {"enabled": False}
+        return {"enabled": True, **(await file_index.status())}
+
+    hash_pool = ThreadPoolExecutor(max_workers=args.hash_workers, thread_name_prefix="hash")
+    # (algorithm, st_dev, st_ino, st_size, st_mtime_ns) -> hex digest, LRU ordered
+    hash_cache = OrderedDict()
+    # The hash pool threads share the cache
+    hash_cache_lock = threading.Lock()
+
+    def cached_hash(p, algorithm):
+        """Hash a file unless an unchanged version of it is in the hash cache."""
+        stats = os.stat(p)
+        if stat_module.S_ISDIR(stats.st_mode):
+            raise IsADirectoryError(errno.EISDIR, "Is a directory", p)
+        key = (algorithm, stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns)
+        with hash_cache_lock:
+            digest = hash_cache.get(key)
+            if digest is not None:
+                hash_cache.move_to_end(key)
+                return digest
+        digest, stat_key = hash_file(p, algorithm)
+        if stat_key is not None:
+            with hash_cache_lock:
+                hash_cache[(algorithm, *stat_key)] = digest
+                while len(hash_cache) > HASH_CACHE_SIZE:
+                    hash_cache.popitem(last=False)
+        return digest
+
+    def drop_hard_links(by_size):
+        """Keep one path per inode in each size group, dropping groups left with a single file."""
+        unique_groups = {}
+        for size, group in by_size.items():
+            seen, unique = set(), []
+            for p in group:
+                try:
+                    stats = os.stat(p)
+                except OSError:
+                    continue
+                if (stats.st_dev, stats.st_ino) not in seen:
+                    seen.add((stats.st_dev, stats.st_ino))
+                    unique.append(p)
+            if len(unique) > 1:
+                unique_groups[size] = unique
+        return unique_groups
+
+    async def hash_paths(resolved_paths, algorithm):
+        """Hash files in parallel on the hash pool; returns digests or exceptions in order."""
+        if algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(
+            *[loop.run_in_executor(hash_pool, cached_hash, p, algorithm) for p in resolved_paths],
+            return_exceptions=True,
+        )
+
+    async def hashFiles(paths, algorithm="sha256"):
+        """Compute content digests (md5, sha1, sha256 or blake2b) of files in parallel.
+
+        Digests are cached by (st_dev, st_ino, st_size, st_mtime_ns), so
+        hashing an unchanged file again is free.
+
+        Returns:
+            list: ``{"path", "hash"}`` or ``{"path", "error"}`` per path, in order.
+        """
+        try:
+            digests = await hash_paths([resolve_path(p) for p in paths], algorithm)
+            return [
+                {"path": p, "error": str(digest)} if isinstance(digest, Exception) else {"path": p, "hash": digest}
+                for p, digest in zip(paths, digests)
+            ]
+        except Exception as e:
+            logger.error(f"Error hashing files: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def findDuplicates(path="/", algorithm="sha256", minSize=1):
+        """Find files with identical content under ``path``.
+
+        Files are grouped by size first and only files sharing a size are
+        hashed. Hard links to the same file count once.
+
+        Returns:
+            list: ``{"size", "hash", "paths"}`` per group of duplicates, largest first.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+            root = resolve_path(path)
+            _, files, _ = await loop.run_in_executor(hash_pool, plan_tree_copy, root, root)
+            by_size = {}
+            for file_path, _, size in files:
+                if size >= minSize:
+                    by_size.setdefault(size, []).append(file_path)
+            by_size = await loop.run_in_executor(
+                hash_pool, drop_hard_links, {size: group for size, group in by_size.items() if len(group) > 1}
+            )
+            candidates = [(p, size) for size, group in by_size.items() for p in group]
+            digests = await hash_paths([p for p, _ in candidates], algorithm)
+            groups = {}
+            for (p, size), digest in zip(candidates, digests):
+                if not isinstance(digest, Exception):
+                    groups.setdefault((size, digest), []).append(to_virtual_path(p))
+            duplicates = [
+                {"size": size, "hash": digest, "paths": sorted(group)}
+                for (size, digest), group in groups.items() if len(group) > 1
+            ]
+            duplicates.sort(key=lambda group: group["size"], reverse=True)
+            return duplicates
+        except Exception as e:
+            logger.error(f"Error finding duplicates in {path}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    # session id -> {"path", "tmp_path", "fd", "size", "ranges", "updated"}
+    upload_sessions = {}
+    upload_expiry_task = None
+
+    def staging_path(p, name):
+        """Pick where the temporary file that will replace ``p`` is built.
+
+        It goes to the hidden upload directory, or next to ``p`` if that is on
+        another filesystem, as os.replace cannot move files across devices.
+        """
+        os.makedirs(upload_dir, exist_ok=True)
+        if os.stat(upload_dir).st_dev == os.stat(os.path.dirname(p)).st_dev:
+            return os.path.join(upload_dir, name)
+        return os.path.join(os.path.dirname(p), f".{os.path.basename(p)}.{name}")
+
+    if not args.no_sweep:
+        await executor.run("bulk", sweep_upload_directory, upload_dir, UPLOAD_SESSION_TTL)
+
+    def get_upload_session(sessionId):
+        session = upload_sessions.get(sessionId)
+        if session is None:
+            raise ValueError(f"Unknown or expired upload session: {sessionId}")
+        session["updated"] = time.monotonic()
+        return session
+
+    def release_upload_file(fd, tmp_path, remove_tmp):
+        os.close(fd)
+        if remove_tmp and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+    async def close_upload_session(sessionId, remove_tmp):
+        session = upload_sessions.pop(sessionId, None)
+        if session is None:
+            return
+        try:
+            await executor.run("interactive", release_upload_file, session["fd"], session["tmp_path"], remove_tmp)
+        finally:
+            handles.release()
+
+    async def expire_upload_sessions():
+        """Abort sessions idle for longer than UPLOAD_SESSION_TTL, checking until none are left."""
+        while upload_sessions:
+            await asyncio.sleep(UPLOAD_EXPIRY_INTERVAL)
+            cutoff = time.monotonic() - UPLOAD_SESSION_TTL
+            for sessionId, session in list(upload_sessions.items()):
+                if session["updated"] < cutoff:
+                    logger.info(f"Aborting idle upload session {sessionId} for {session['path']}")
+                    try:
+                        await close_upload_session(sessionId, remove_tmp=True)
+                    except Exception as e:
+                        logger.warning(f"Error aborting upload session {sessionId}: {str(e)}")
+
+    def create_upload_file(tmp_path, size, mode):
+        """Create and preallocate the temporary file of an upload, returning its fd."""
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644 if mode is None else mode)
+        try:
+            preallocate(fd, size)
+        except BaseException:
+            os.close(fd)
+            os.unlink(tmp_path)
+            raise
+        return fd
+
+    async def beginUpload(p, size, mode=None):
+        """Start a resumable upload of ``size`` bytes to ``p``.
+
+        Data goes to a preallocated temporary file in a hidden directory under
+        the root and only replaces ``p`` on :func:`commitUpload`. Sessions
+        outlive client connections, so an interrupted upload can be resumed
+        with the returned ``sessionId``; sessions idle for a day are aborted.
+        Each session keeps a file handle open, counted toward the handle limit.
+        """
+        nonlocal upload_expiry_task
+        try:
+            if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+                raise ValueError(f"Upload size must be a non-negative integer, got {size!r}")
+            if len(upload_sessions) >= args.max_upload_sessions:
+                raise OSError(errno.EMFILE, f"Too many upload sessions ({args.max_upload_sessions})")
+            p = resolve_path(p)
+            sessionId = uuid.uuid4().hex
+            handles.reserve()
+            try:
+                await executor.run("interactive", functools.partial(os.makedirs, os.path.dirname(p), exist_ok=True))
+                tmp_path = await executor.run("interactive", staging_path, p, f"{sessionId}.upload")
+                # Preallocation writes zeros where the filesystem has no fallocate
+                fd = await executor.run(io_lane(size), create_upload_file, tmp_path, size, mode)
+            except BaseException:
+                handles.release()
+                raise
+            upload_sessions[sessionId] = {
+                "path": p,
+                "tmp_path": tmp_path,
+                "fd": fd,
+                "size": size,
+                "ranges": [],
+                "updated": time.monotonic(),
+            }
+            if upload_expiry_task is None or upload_expiry_task.done():
+                upload_expiry_task = asyncio.ensure_future(expire_upload_sessions())
+            return {"sessionId": sessionId, "size": size}
+        except Exception as e:
+            logger.error(f"Error starting upload to {p}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def putChunk(sessionId, offset, data, compression=None):
+        """Write one chunk of an upload at ``offset``.
+
+        Chunks may arrive in any order and in parallel; each is written with
+        pwrite, so they never interfere with each other. ``compression``
+        names the codec ``data`` is compressed with, if any.
+        """
+        try:
+            session = get_upload_session(sessionId)
+            if compression:
+                data = await executor.run(io_lane(len(data)), decompress_payload, data, compression,
+                                          max(session["size"] - offset, 0))
+            if offset < 0 or offset + len(data) > session["size"]:
+                raise ValueError(f"Chunk [{offset}, {offset + len(data)}) is outside the declared size {session['size']}")
+            written = await executor.run(io_lane(len(data)), pwrite_from, session["fd"], data, 0, len(data), offset)
+            session["ranges"] = add_range(session["ranges"], offset, offset + written)
+            metrics.add_bytes("written", written)
+            return {"success": True, "written": written}
+        except Exception as e:
+            logger.error(f"Error writing upload chunk of session {sessionId}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def getUploadStatus(sessionId):
+        """Return the byte ranges received so far, to resume an interrupted upload.
+
+        Returns:
+            dict: ``{"size": int, "received": int, "ranges": [[start, end], ...]}``
+        """
+        try:
+            session = get_upload_session(sessionId)
+            return {
+                "size": session["size"],
+                "received": sum(end - start for start, end in session["ranges"]),
+                "ranges": [list(r) for r in session["ranges"]],
+            }
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def getTransferCodecs():
+        """Return the compression codecs readFile, writeFile and the chunked transfers accept.
+
+        Returns:
+            dict: ``{"codecs": [str, ...], "levels": {codec: default level}}``
+        """
+        codecs = transfer_codecs()
+        return {"codecs": codecs, "levels": {codec: TRANSFER_CODEC_LEVELS[codec] for codec in codecs}}
+
+    async def getBlockChecksums(p, blockSize=None, algorithm="sha1"):
+        """Checksum the blocks of a file, so a client can send a new version as a delta.
+
+        ``blockSize`` defaults to a power of two near the square root of the
+        file size. ``weak`` holds the Adler-32 checksum of each block as
+        little-endian uint32 values and ``strong`` the concatenated
+        ``algorithm`` digests; the last block may be short. ``version`` is
+        passed back to :func:`applyDelta`.
+
+        Returns:
+            dict: ``{"version", "size", "blockSize", "algorithm", "digestSize", "weak": bytes, "strong": bytes}``
+        """
+        try:
+            if algorithm not in HASH_ALGORITHMS:
+                raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+            p = resolve_path(p)
+            if blockSize is None:
+                blockSize = delta_block_size((await executor.run("interactive", os.stat, p)).st_size)
+            elif blockSize < 1:
+                raise ValueError(f"Invalid block size: {blockSize}")
+            loop = asyncio.get_running_loop()
+            version, size, weak, strong = await loop.run_in_executor(hash_pool, block_checksums, p, blockSize, algorithm)
+            if sys.byteorder == "big":
+                weak.byteswap()
+            metrics.add_bytes("read", size)
+            return {
+                "version": version,
+                "size": size,
+                "blockSize": blockSize,
+                "algorithm": algorithm,
+                "digestSize": hashlib.new(algorithm).digest_size,
+                "weak": weak.tobytes(),
+                "strong": strong,
+            }
+        except Exception as e:
+            logger.error(f"Error checksumming blocks of {p}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def applyDelta(p, ops, base=None, checksum=None, algorithm="sha256"):
+        """Replace a file with a new version built from delta instructions.
+
+        ``ops`` are applied in order: ``{"copy": offset, "length": n}`` copies
+        bytes of the current file and ``{"data": bytes}`` appends literal
+        bytes. The new version is built in a temporary file in the hidden
+        upload directory, verified against ``checksum`` if given, and renamed into
+        place. With ``base`` (the ``version`` from :func:`getBlockChecksums`)
+        the call fails if the file changed in between.
+
+        Returns:
+            dict: ``{"success": True, "size": int, "copied": int, "literal": int}``
+        """
+        tmp_path = None
+        try:
+            p = resolve_path(p)
+            tmp_path = await executor.run("interactive", staging_path, p, f"{uuid.uuid4().hex}.delta")
+            # The whole new version is written and fsynced, not just the literal bytes
+            target_size = sum(len(op["data"]) if "data" in op else op.get("length", 0) for op in ops)
+            copied, literal = await executor.run(io_lane(target_size), apply_delta, p, tmp_path, ops, base)
+            if checksum is not None:
+                if algorithm not in HASH_ALGORITHMS:
+                    raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+                loop = asyncio.get_running_loop()
+                digest, _ = await loop.run_in_executor(hash_pool, hash_file, tmp_path, algorithm)
+                if digest != checksum.lower():
+                    raise ValueError(f"Checksum mismatch: expected {checksum}, got {digest}")
+            await executor.run("interactive", os.replace, tmp_path, p)
+            tmp_path = None
+            notify_changed(p)
+            metrics.add_bytes("written", literal)
+            return {"success": True, "size": copied + literal, "copied": copied, "literal": literal}
+        except Exception as e:
+            logger.error(f"Error applying delta to {p}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+        finally:
+            if tmp_path is not None:
+                await executor.run("interactive", remove_if_exists, tmp_path)
+
+    async def commitUpload(sessionId, checksum=None, algorithm="sha256"):
+        """Finish an upload: verify it is complete (and matches ``checksum`` if
+        given), then atomically move it into place."""
+        try:
+            session = get_upload_session(sessionId)
+            if session["size"] and session["ranges"] != [(0, session["size"])]:
+                missing = session["size"] - sum(end - start for start, end in session["ranges"])
+                raise ValueError(f"Upload is incomplete, {missing} bytes missing")
+            loop = asyncio.get_running_loop()
+            await executor.run("bulk", os.fsync, session["fd"])
+            if checksum is not None:
+                if algorithm not in HASH_ALGORITHMS:
+                    raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+                digest, _ = await loop.run_in_executor(hash_pool, hash_file, session["tmp_path"], algorithm)
+                if digest != checksum.lower():
+                    raise ValueError(f"Checksum mismatch: expected {checksum}, got {digest}")
+            await executor.run("interactive", os.replace, session["tmp_path"], session["path"])
+            await close_upload_session(sessionId, remove_tmp=True)
+            notify_changed(session["path"])
+            return {"success": True, "path": to_virtual_path(session["path"]), "size": session["size"]}
+        except Exception as e:
+            logger.error(f"Error committing upload session {sessionId}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def abortUpload(sessionId):
+        """Cancel an upload and delete its temporary file."""
+        await close_upload_session(sessionId, remove_tmp=True)
+        return {"success": True}
+
+    scan_pool = ThreadPoolExecutor(max_workers=args.scan_workers, thread_name_prefix="scan")
+    dirsize_cache = DirectorySizeCache()
+    # continuation token -> list of dirSize states
+    dirsize_continuations = OrderedDict()
+
+    async def measure_directory(state, deadline_at):
+        """Advance a dirSize computation until its tree is scanned or the deadline passes."""
+        loop = asyncio.get_running_loop()
+        pending = {}
+        while state["frontier"] or pending:
+            while (state["frontier"] and len(pending) < args.scan_workers * 2
+                   and (deadline_at is None or time.monotonic() < deadline_at)):
+                directory = state["frontier"].pop()
+                pending[loop.run_in_executor(scan_pool, dirsize_cache.scan, directory)] = directory
+            if not pending:
+                break
+            # Directories already being scanned are finished even past the deadline
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                directory = pending.pop(future)
+                try:
+                    record = future.result()
+                except OSError as e:
+                    state["errors"].append({"path": to_virtual_path(directory), "error": str(e)})
+                    continue
+                state["bytes"] += record["bytes"]
+                state["files"] += record["files"]
+                state["linked"].update(record["linked"])
+                if directory != state["root"]:
+                    state["dirs"] += 1
+                state["frontier"].extend(subdir for subdir in record["subdirs"] if subdir not in hidden_dirs)
+
+    def dirsize_result(state):
+        return {
+            "path": state["path"],
+            "bytes": state["bytes"] + sum(state["linked"].values()),
+            "files": state["files"] + len(state["linked"]),
+            "dirs": state["dirs"],
+            "complete": not state["frontier"],
+            "errors": state["errors"],
+        }
+
+    async def dirSize(paths=None, deadline=None, continuation=None):
+        """Compute total bytes, file count and directory count of folders.
+
+        Subtrees are scanned in parallel on the scan pool, hard links are
+        counted once, and per-directory subtotals are cached by directory
+        mtime so unchanged parts of a tree are not rescanned. With
+        ``deadline`` (seconds) the call returns partial results once it
+        expires, along with a ``continuation`` token to pass back (instead
+        of ``paths``) to carry on.
+
+        Returns:
+            dict: ``{"results": [...], "continuation": str or None}``
+        """
+        try:
+            if continuation:
+                states = dirsize_continuations.pop(continuation, None)
+                if states is None:
+                    return {"error": f"Unknown or expired continuation: {continuation}"}
+            else:
+                states = []
+                for p in paths:
+                    root = resolve_path(p)
+                    states.append({
+                        "path": p, "root": root, "frontier": [root],
+                        "bytes": 0, "files": 0, "dirs": 0, "linked": {}, "errors": [],
+                    })
+            deadline_at = None if deadline is None else time.monotonic() + deadline
+            await asyncio.gather(*[measure_directory(state, deadline_at) for state in states])
+            results = [dirsize_result(state) for state in states]
+            token = None
+            if not all(result["complete"] for result in results):
+                token = uuid.uuid4().hex
+                dirsize_continuations[token] = states
+                while len(dirsize_continuations) > DIRSIZE_CONTINUATION_LIMIT:
+                    dirsize_continuations.popitem(last=False)
+            return {"results": results, "continuation": token}
+        except Exception as e:
+            logger.error(f"Error computing directory sizes: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    change_notifier = ChangeNotifier(to_virtual_path, functools.partial(executor.run, "bulk"), hidden=hidden_dirs,
+                                     max_watches=watch_budget["notifier"])
+
+    async def watch(p, callback):
+        """Subscribe ``callback`` to changes of the entries of directory ``p``.
+
+        ``callback`` receives batches ``{"watchId", "path", "events",
+        "resync"}`` where each event is ``{"type", "path", "isDir"}`` with
+        type ``create``, ``modify``, ``delete`` or ``move`` (which also has
+        ``oldPath``). Events are coalesced per path and debounced. When
+        ``resync`` is set, events were dropped and the client should re-list
+        the directory. A subscription whose callback fails is cancelled.
+        """
+        try:
+            watchId = await change_notifier.subscribe(resolve_path(p), callback)
+            return {"watchId": watchId, "path": p}
+        except Exception as e:
+            logger.error(f"Error watching {p}: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def unwatch(watchId):
+        """Cancel a subscription created by :func:`watch`."""
+        try:
+            if not change_notifier.unsubscribe(watchId):
+                return {"error": f"Unknown watch: {watchId}"}
+            return {"success": True}
         except Exception as e:
+            logger.error(f"Error removing watch {watchId}: {str(e)}", exc_info=True)
             return {"error": str(e)}
 
     async def readlink(p):
         p = resolve_path(p)
         try:
-            return os.readlink(p)
+            return await executor.run("interactive", os.readlink, p)
         except Exception as e:
             return {"error": str(e)}
 
 
-    svc = await server.register_service({
-        "name": "AsyncFileService",
-        "id": "async-file-service",
-        "config": {
-            "visibility": "public",
-            "run_in_executor": True,
-            "convert_objects": True  # Enable automatic object conversion
-        },
+    async def batch(ops, concurrent=False, stopOnError=False, maxConcurrency=BATCH_MAX_CONCURRENCY):
+        """Execute many service operations in one round-trip (see :func:`run_batch`)."""
+        return await run_batch(operations, ops, concurrent, stopOnError, maxConcurrency)
+
+    operations = {
         "diskSpace": diskSpace,
         "openFile": openFile,
         "createFile": createFile,
@@ -526,14 +4666,881 @@ async def main():
         "mkdir": mkdir,
         "readdir": readdir,
         "readdirwithstats": readdirwithstats,
+        "readdirpage": readdirpage,
+        "readdircolumns": readdircolumns,
         "exists": exists,
         "realpath": realpath,
         "readFile": readFile,
+        "readFileRange": readFileRange,
+        "readFileChunks": readFileChunks,
+        "readFileStream": readFileStream,
         "writeFile": writeFile,
         "appendFile": appendFile,
         "symlink": symlink,
         "readlink": readlink,
-    })
+        "getCacheStats": getCacheStats,
+        "copyTree": copyTree,
+        "moveTree": moveTree,
+        "moveMany": moveMany,
+        "removeTree": removeTree,
+        "archive": archive,
+        "archiveChunks": archiveChunks,
+        "thumbnails": thumbnails,
+        "search": search,
+        "getIndexStatus": getIndexStatus,
+        "hash": hashFiles,
+        "findDuplicates": findDuplicates,
+        "beginUpload": beginUpload,
+        "putChunk": putChunk,
+        "getUploadStatus": getUploadStatus,
+        "commitUpload": commitUpload,
+        "getTransferCodecs": getTransferCodecs,
+        "getBlockChecksums": getBlockChecksums,
+        "applyDelta": applyDelta,
+        "abortUpload": abortUpload,
+        "dirSize": dirSize,
+        "watch": watch,
+        "unwatch": unwatch,
+        "getMetrics": getMetrics,
+        "getTraces": getTraces,
+    }
+    operations = {name: bind_client(metrics.instrument(name, func)) for name, func in operations.items()}
+    operations["batch"] = bind_client(metrics.instrument("batch", batch))
+
+    async def client_disconnected(client):
+        closed = await handles.close_client(client)
+        if closed:
+            logger.info(f"Closed {closed} file handles of disconnected client {client}")
+
+    async def shutdown():
+        change_notifier.close()
+        for task in [*purge_tasks.values(), thumbnail_prune_task, upload_expiry_task]:
+            if task is not None:
+                task.cancel()
+        await handles.close_all()
+        for sessionId in list(upload_sessions):
+            await close_upload_session(sessionId, remove_tmp=True)
+        if file_index is not None:
+            await file_index.close()
+        metadata_cache.close()
+        content_cache.clear()
+        for pool in (copy_pool, hash_pool, scan_pool, thumbnail_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        executor.shutdown()
+
+    return operations, shutdown, client_disconnected, paths_changed
+
+
+class AsyncFileService:
+    """The file service, independent of how it is exposed.
+
+    Options are the command line options of this script by their attribute
+    names (e.g. ``AsyncFileService(root="/data", no_index=True)``), or an
+    ``args`` namespace from :func:`parse_args`. After :meth:`start`, the
+    operations can be registered on a hypha-rpc server with :meth:`register`
+    or called in-process with :meth:`call`.
+    """
+
+    def __init__(self, args=None, **options):
+        self.args = args if args is not None else parse_args([])
+        for key, value in options.items():
+            if not hasattr(self.args, key):
+                raise TypeError(f"Unknown option: {key}")
+            setattr(self.args, key, value)
+        self.operations = {}
+        self._shutdown = None
+        self._client_disconnected = None
+        self._paths_changed = None
+
+    async def start(self):
+        (self.operations, self._shutdown, self._client_disconnected,
+         self._paths_changed) = await create_operations(self.args)
+        return self
+
+    async def close(self):
+        if self._shutdown is not None:
+            await self._shutdown()
+            self._shutdown = None
+            self._client_disconnected = None
+            self._paths_changed = None
+            self.operations = {}
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def call(self, name, *args, **kwargs):
+        """Call an operation in-process; generator operations return an async iterator."""
+        return self.operations[name](*args, **kwargs)
+
+    async def client_disconnected(self, client):
+        """Release what ``client`` held, i.e. close its open file handles."""
+        if self._client_disconnected is not None:
+            await self._client_disconnected(client)
+
+    def paths_changed(self, changes):
+        """Drop the ``[path, ancestors]`` changes another process made from the caches."""
+        if self._paths_changed is not None:
+            self._paths_changed(changes)
+
+    async def register(self, server, service_id=SERVICE_ID):
+        """Register the operations as a service on a hypha-rpc server connection.
+
+        If the connection reports ``client_disconnected`` events, the file
+        handles of disconnected clients are closed.
+        """
+        if hasattr(server, "on"):
+            server.on("client_disconnected",
+                      lambda event: self.client_disconnected(disconnected_client_id(event)))
+        return await server.register_service({
+            "name": "AsyncFileService",
+            "id": service_id,
+            "config": {
+                "visibility": "public",
+                "run_in_executor": True,
+                "require_context": True,  # Identifies the caller for per-client limits
+                "convert_objects": True  # Enable automatic object conversion
+            },
+            **self.operations,
+        })
+
+
+class LocalServer:
+    """In-process stand-in for a hypha-rpc server connection.
+
+    Services registered on it are returned by :meth:`get_service` as proxies
+    calling the functions directly. With ``serialize``, arguments and
+    results are round-tripped through msgpack as on the wire, and
+    ``wire_bytes`` counts their encoded size; values msgpack cannot encode
+    (handles, callbacks) are passed by reference. Services requiring a
+    context receive one naming the ``client`` given to :meth:`get_service`,
+    and :meth:`disconnect` reports a client as gone like hypha-rpc does.
+    """
+
+    def __init__(self, serialize=True):
+        if serialize and msgpack is None:
+            raise RuntimeError("msgpack is required to serialize calls")
+        self.serialize = serialize
+        self.wire_bytes = 0
+        self.config = argparse.Namespace(workspace="local")
+        self._services = {}
+        self._event_handlers = {}
+
+    def on(self, event, handler):
+        self._event_handlers.setdefault(event, []).append(handler)
+
+    async def disconnect(self, client="local-client"):
+        """Fire ``client_disconnected`` for ``client`` and wait for the handlers."""
+        event = {"type": "client_disconnected", "data": {"id": client, "workspace": self.config.workspace}}
+        for handler in self._event_handlers.get("client_disconnected", []):
+            result = handler(event)
+            if inspect.isawaitable(result):
+                await result
+
+    async def register_service(self, spec):
+        self._services[spec["id"]] = spec
+        return argparse.Namespace(id=f"{self.config.workspace}/{spec['id']}")
+
+    async def get_service(self, service_id=SERVICE_ID, client="local-client"):
+        spec = self._services[service_id.split("/")[-1]]
+        context = None
+        if spec.get("config", {}).get("require_context"):
+            context = {"from": f"{self.config.workspace}/{client}", "ws": self.config.workspace}
+        proxy = argparse.Namespace()
+        for name, func in spec.items():
+            if callable(func):
+                setattr(proxy, name, self._proxy(func, context))
+        return proxy
+
+    def _transfer(self, value):
+        if not self.serialize:
+            return value
+        try:
+            data = msgpack.packb(value, use_bin_type=True)
+        except (TypeError, ValueError):
+            return value
+        self.wire_bytes += len(data)
+        return msgpack.unpackb(data, raw=False)
+
+    def _proxy(self, func, context=None):
+        extra = {} if context is None else {"context": context}
+        if inspect.isasyncgenfunction(func):
+            async def generator_proxy(*args, **kwargs):
+                async for item in func(*self._transfer(list(args)), **self._transfer(kwargs), **extra):
+                    yield self._transfer(item)
+            return generator_proxy
+
+        async def proxy(*args, **kwargs):
+            return self._transfer(await func(*self._transfer(list(args)), **self._transfer(kwargs), **extra))
+        return proxy
+
+
+async def read_frame(reader):
+    """Read one length-prefixed pickled message of the worker protocol."""
+    size, = struct.unpack("!Q", await reader.readexactly(8))
+    return pickle.loads(await reader.readexactly(size))
+
+def encode_frame(message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    return [struct.pack("!Q", len(data)), data]
+
+def affinity_path(value):
+    """The path a call is about, taken from its first argument, or None."""
+    if isinstance(value, str):
+        return "/" + posixpath.normpath("/" + value).strip("/")
+    if isinstance(value, dict) and "args" in value:  # A batch operation
+        args = value["args"]
+        return affinity_path(list(args.values()) if isinstance(args, dict) else args)
+    if isinstance(value, (list, tuple)) and value:
+        return affinity_path(value[0])
+    return None
+
+def prefix_watch_id(callback, index):
+    """Wrap a watch callback so the event batches it receives carry the worker-prefixed watch id."""
+    async def forward(batch):
+        if isinstance(batch, dict) and batch.get("watchId") is not None:
+            batch = {**batch, "watchId": f"{index}:{batch['watchId']}"}
+        result = callback(batch)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+    return forward
+
+def merge_prometheus(texts, label="worker"):
+    """Merge the Prometheus texts of several workers, labelling each sample with its worker index.
+
+    Samples are grouped under one ``# HELP``/``# TYPE`` header per metric family.
+    """
+    families = OrderedDict()
+    for index, text in enumerate(texts):
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# "):
+                family = families.setdefault(line.split(" ", 3)[2], {"header": [], "samples": []})
+                if line not in family["header"]:
+                    family["header"].append(line)
+            elif line and family is not None:
+                name, value = line.rsplit(" ", 1)
+                if name.endswith("}"):
+                    name = name.replace("{", f'{{{label}="{index}",', 1)
+                else:
+                    name = f'{name}{{{label}="{index}"}}'
+                family["samples"].append(f"{name} {value}")
+    lines = []
+    for family in families.values():
+        lines.extend(family["header"] + family["samples"])
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+class WorkerConnection:
+    """Serves a :class:`AsyncFileService` to the front process of worker mode.
+
+    Runs in a worker process. Calls arrive as messages on the connection;
+    callbacks among their arguments are called back through it, and
+    results holding functions (open file handles) are kept here as objects
+    the front process invokes by id. Replies list the paths the message
+    changed, for the front process to invalidate on the other workers.
+    """
+
+    def __init__(self, service, reader, writer):
+        self.service = service
+        self.reader = reader
+        self.writer = writer
+        self._write_lock = asyncio.Lock()
+        self._next_id = 0
+        self._objects = {}  # id -> (functions by name, client)
+        self._generators = {}
+        self._callback_calls = {}
+        self._tasks = set()
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    async def send(self, message):
+        async with self._write_lock:
+            self.writer.writelines(encode_frame(message))
+            await self.writer.drain()
+
+    async def serve(self):
+        """Handle messages until the front process closes the connection."""
+        kinds = {name: "generator" if inspect.isasyncgenfunction(func) else "function"
+                 for name, func in self.service.operations.items()}
+        await self.send({"type": "ready", "operations": kinds})
+        try:
+            while True:
+                try:
+                    message = await read_frame(self.reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                if message["type"] == "callback_result":
+                    future = self._callback_calls.pop(message["id"], None)
+                    if future is not None and not future.done():
+                        if "error" in message:
+                            future.set_exception(Exception(message["error"]))
+                        else:
+                            future.set_result(message["value"])
+                    continue
+                task = asyncio.ensure_future(self._handle(message))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+            for future in self._callback_calls.values():
+                future.cancel()
+
+    async def _handle(self, message):
+        changed = []
+        CHANGED_PATHS.set(changed)
+        try:
+            value = await self._dispatch(message)
+            reply = {"type": "result", "id": message["id"], "value": self._export(value, message.get("context"))}
+        except Exception as e:
+            reply = {"type": "error", "id": message["id"], "error": str(e)}
+        if changed:
+            reply["changed"] = changed
+        try:
+            await self.send(reply)
+        except ConnectionError:
+            pass
+
+    async def _dispatch(self, message):
+        kind = message["type"]
+        if kind == "call":
+            args = self._import(message["args"])
+            kwargs = self._import(message.get("kwargs") or {})
+            result = self.service.call(message["method"], *args, context=message["context"], **kwargs)
+            if inspect.isasyncgen(result):
+                generator_id = self._new_id()
+                self._generators[generator_id] = result
+                return generator_id
+            return await result
+        if kind == "next":
+            generator = self._generators[message["generator"]]
+            try:
+                return {"value": await generator.__anext__()}
+            except StopAsyncIteration:
+                del self._generators[message["generator"]]
+                return {"done": True}
+        if kind == "aclose":
+            generator = self._generators.pop(message["generator"], None)
+            if generator is not None:
+                await generator.aclose()
+            return None
+        if kind == "invoke":
+            functions, _ = self._objects[message["object"]]
+            args = self._import(message["args"])
+            try:
+                result = await functions[message["method"]](*args)
+                if message["method"] == "read":
+                    # The buffer filled here is a copy; send back what was read into it
+                    buffer, offset = args[0], args[1]
+                    return {"read": result, "data": bytes(memoryview(buffer)[offset:offset + result])}
+                return result
+            finally:
+                if message["method"] == "close":
+                    self._objects.pop(message["object"], None)
+        if kind == "disconnect":
+            client = message["client"]
+            for object_id in [i for i, (_, owner) in self._objects.items() if owner == client]:
+                del self._objects[object_id]
+            await self.service.client_disconnected(client)
+            return None
+        if kind == "invalidate":
+            self.service.paths_changed(message["changes"])
+            return None
+        raise ValueError(f"Unknown worker message: {kind}")
+
+    def _import(self, value):
+        """Replace the callback references in call arguments by functions calling them back."""
+        if isinstance(value, dict):
+            if "__callback__" in value:
+                return self._callback(value["__callback__"])
+            return {key: self._import(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._import(item) for item in value]
+        return value
+
+    def _callback(self, callback_id):
+        async def callback(*args):
+            call_id = self._new_id()
+            future = asyncio.get_running_loop().create_future()
+            self._callback_calls[call_id] = future
+            await self.send({"type": "callback", "id": call_id, "callback": callback_id, "args": list(args)})
+            return await future
+        return callback
+
+    def _export(self, value, context):
+        """Replace the functions in a result by object references the front process can invoke."""
+        if isinstance(value, dict):
+            functions = {key: item for key, item in value.items() if callable(item)}
+            if functions:
+                object_id = self._new_id()
+                self._objects[object_id] = (functions, client_id(context) if context else None)
+                fields = {key: item for key, item in value.items() if key not in functions}
+                return {"__object__": object_id, "methods": list(functions), "fields": fields}
+            return {key: self._export(item, context) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._export(item, context) for item in value]
+        return value
+
+
+async def serve_worker(fd):
+    """Run a worker process of worker mode on the connection inherited as ``fd``."""
+    reader, writer = await asyncio.open_connection(sock=socket.socket(fileno=fd))
+    start = await read_frame(reader)
+    args = parse_args([])
+    vars(args).update(start["options"])
+    logging.basicConfig(level=getattr(logging, args.log_level))
+    try:
+        async with AsyncFileService(args) as service:
+            await WorkerConnection(service, reader, writer).serve()
+    finally:
+        writer.close()
+        # Nothing is left to do once the front process is gone
+        asyncio.get_running_loop().stop()
+
+
+class WorkerProcess:
+    """One supervised worker process of :class:`MultiProcessFileService`.
+
+    The process is restarted with exponential backoff whenever it exits;
+    calls in flight then fail and new calls wait until it serves again.
+    ``on_changed(worker, changes)`` is awaited with the paths a call changed
+    before the call returns.
+    """
+
+    def __init__(self, index, options, on_changed=None):
+        self.index = index
+        self.options = options
+        self.on_changed = on_changed
+        self.operations = None
+        self.restarts = 0
+        self.ready = asyncio.Event()
+        self.started = asyncio.Event()
+        self._process = None
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._next_id = 0
+        self._pending = {}
+        self._callbacks = {}
+        self._subscriptions = {}  # watch id -> callback ids kept until unwatch
+        self._closing = False
+        self._task = None
+
+    @property
+    def load(self):
+        """Number of calls in flight."""
+        return len(self._pending)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._supervise())
+
+    async def close(self):
+        self._closing = True
+        if self._writer is not None:
+            self._writer.close()
+        if self._process is not None and self._process.returncode is None:
+            try:
+                await asyncio.wait_for(self._process.wait(), WORKER_START_TIMEOUT)
+            except asyncio.TimeoutError:
+                self._process.kill()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _supervise(self):
+        delay = WORKER_RESTART_DELAY
+        while not self._closing:
+            started = time.monotonic()
+            try:
+                await self._run()
+            except Exception as e:
+                logger.error(f"Worker {self.index} failed: {str(e)}", exc_info=True)
+            self.ready.clear()
+            self._fail_pending(ConnectionError(f"Worker {self.index} exited"))
+            if self._closing:
+                return
+            if time.monotonic() - started > WORKER_RESTART_MAX_DELAY:
+                delay = WORKER_RESTART_DELAY
+            self.restarts += 1
+            logger.warning(f"Worker {self.index} exited, restarting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WORKER_RESTART_MAX_DELAY)
+
+    async def _run(self):
+        """Start the process and read its messages until it exits."""
+        parent_sock, child_sock = socket.socketpair()
+        try:
+            self._process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), "--worker-fd", str(child_sock.fileno()),
+                pass_fds=(child_sock.fileno(),),
+            )
+        except BaseException:
+            parent_sock.close()
+            raise
+        finally:
+            child_sock.close()
+        reader, self._writer = await asyncio.open_connection(sock=parent_sock)
+        try:
+            await self._send({"type": "start", "options": self.options})
+            message = await asyncio.wait_for(read_frame(reader), WORKER_START_TIMEOUT)
+            self.operations = message["operations"]
+            self.ready.set()
+            self.started.set()
+            while True:
+                try:
+                    message = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                if message["type"] == "callback":
+                    asyncio.ensure_future(self._run_callback(message))
+                    continue
+                future = self._pending.get(message["id"])
+                if future is not None and not future.done():
+                    future.set_result(message)
+        finally:
+            self._writer.close()
+            self._callbacks.clear()
+            self._subscriptions.clear()
+            if self._process.returncode is None:
+                with contextlib.suppress(ProcessLookupError):
+                    self._process.kill()
+            await self._process.wait()
+
+    def _fail_pending(self, error):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def _send(self, message):
+        async with self._write_lock:
+            self._writer.writelines(encode_frame(message))
+            await self._writer.drain()
+
+    async def request(self, message):
+        """Send a message to the worker and wait for its reply."""
+        if self._closing:
+            raise ConnectionError(f"Worker {self.index} is closed")
+        await self.ready.wait()
+        self._next_id += 1
+        message["id"] = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[message["id"]] = future
+        try:
+            await self._send(message)
+            reply = await future
+        finally:
+            del self._pending[message["id"]]
+        if reply.get("changed") and self.on_changed is not None:
+            await self.on_changed(self, reply["changed"])
+        if reply["type"] == "error":
+            raise Exception(reply["error"])
+        return self._import(reply["value"])
+
+    async def _run_callback(self, message):
+        try:
+            result = self._callbacks[message["callback"]](*message["args"])
+            if inspect.isawaitable(result):
+                result = await result
+            reply = {"type": "callback_result", "id": message["id"], "value": result}
+        except Exception as e:
+            reply = {"type": "callback_result", "id": message["id"], "error": str(e)}
+        try:
+            await self._send(reply)
+        except (ConnectionError, pickle.PicklingError, TypeError):
+            pass
+
+    def export_args(self, value, callback_ids):
+        """Replace the functions in call arguments by callback references, collecting their ids."""
+        if callable(value):
+            self._next_id += 1
+            self._callbacks[self._next_id] = value
+            callback_ids.append(self._next_id)
+            return {"__callback__": self._next_id}
+        if isinstance(value, dict):
+            return {key: self.export_args(item, callback_ids) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.export_args(item, callback_ids) for item in value]
+        return value
+
+    def release_callbacks(self, callback_ids):
+        for callback_id in callback_ids:
+            self._callbacks.pop(callback_id, None)
+
+    def keep_callbacks(self, watch_id, callback_ids):
+        self._subscriptions[watch_id] = callback_ids
+
+    def release_subscription(self, watch_id):
+        self.release_callbacks(self._subscriptions.pop(watch_id, []))
+
+    def _import(self, value):
+        """Turn the object references in a result into functions invoking them on the worker."""
+        if isinstance(value, dict):
+            if "__object__" in value:
+                return {**value["fields"], **{
+                    method: self._invoker(value["__object__"], method) for method in value["methods"]
+                }}
+            return {key: self._import(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._import(item) for item in value]
+        return value
+
+    def _invoker(self, object_id, method):
+        async def invoke(*args):
+            result = await self.request({"type": "invoke", "object": object_id, "method": method, "args": list(args)})
+            if method == "read":
+                buffer, offset = args[0], args[1]
+                if not memoryview(buffer).readonly:
+                    memoryview(buffer)[offset:offset + result["read"]] = result["data"]
+                return result["read"]
+            return result
+        return invoke
+
+
+class MultiProcessFileService(AsyncFileService):
+    """The file service spread over ``workers`` processes serving the same root.
+
+    The operations registered by this front process forward each call to a
+    worker. Calls about a path (their first argument) go to the worker the
+    path hashes to, so one path's calls are served in order by one worker
+    whose caches hold it; calls without a path go to the least loaded
+    worker. Upload session, watch and dirSize continuation ids (also in
+    watch event batches) carry the index of the worker they belong to.
+    Batches run here, each operation routed as a single call would be, and
+    metrics and traces are collected from all workers. Only the first worker keeps the
+    search index, and the CPU-sized hash and thumbnail pools, the handle,
+    upload session and inotify watch limits and the caches are divided
+    between the workers. Before a call that changed paths returns, the
+    other workers drop those paths from their caches, so a change made
+    through one worker is seen at once through the others. Trees left in
+    the trash by an earlier run are purged here rather than by a worker.
+    Crashed workers are restarted.
+    """
+
+    def __init__(self, args=None, **options):
+        super().__init__(args, **options)
+        self.workers = []
+        self._purge_task = None
+
+    async def start(self):
+        count = max(self.args.workers, 1)
+
+        def share(value):
+            """A worker's part of a limit of the whole service; 0 (disabled) stays 0."""
+            return max(value // count, 1) if value > 0 else value
+
+        workdir = os.path.abspath(self.args.root)
+        loop = asyncio.get_running_loop()
+        leftovers = await loop.run_in_executor(None, sweep_trash_directory, os.path.join(workdir, TRASH_DIRECTORY))
+        await loop.run_in_executor(None, sweep_upload_directory, os.path.join(workdir, UPLOAD_DIRECTORY),
+                                   UPLOAD_SESSION_TTL)
+        if leftovers:
+            self._purge_task = asyncio.ensure_future(self._purge(leftovers))
+        for index in range(count):
+            options = dict(vars(self.args), workers=1, worker_fd=None, no_sweep=True,
+                           no_index=self.args.no_index or index > 0,
+                           hash_workers=share(self.args.hash_workers),
+                           thumbnail_workers=share(self.args.thumbnail_workers),
+                           max_handles=share(self.args.max_handles),
+                           max_handles_per_client=share(self.args.max_handles_per_client),
+                           max_upload_sessions=share(self.args.max_upload_sessions),
+                           max_inotify_watches=share(inotify_watch_limit(self.args.max_inotify_watches)),
+                           metadata_cache_size=share(self.args.metadata_cache_size),
+                           content_cache_size=share(self.args.content_cache_size))
+            worker = WorkerProcess(index, options, on_changed=self._broadcast_changes)
+            worker.start()
+            self.workers.append(worker)
+        try:
+            await asyncio.wait_for(asyncio.gather(*[worker.started.wait() for worker in self.workers]),
+                                   WORKER_START_TIMEOUT)
+        except asyncio.TimeoutError:
+            await self._close_workers()
+            raise RuntimeError(f"Worker processes did not start within {WORKER_START_TIMEOUT}s")
+        self.operations = {
+            name: self._generator_proxy(name) if kind == "generator" else self._proxy(name)
+            for name, kind in self.workers[0].operations.items()
+        }
+        self.operations.update(batch=self._batch, getMetrics=self._get_metrics, getTraces=self._get_traces)
+        self._shutdown = self._close_workers
+        self._client_disconnected = self._disconnect_client
+        logger.info(f"Started {count} worker processes")
+        return self
+
+    async def _close_workers(self):
+        if self._purge_task is not None:
+            self._purge_task.cancel()
+        await asyncio.gather(*[worker.close() for worker in self.workers])
+        self.workers = []
+
+    async def _purge(self, paths):
+        """Delete the trees an earlier run left in the trash."""
+        loop = asyncio.get_running_loop()
+        for p in paths:
+            await loop.run_in_executor(None, functools.partial(shutil.rmtree, p, ignore_errors=True))
+        logger.info(f"Purged {len(paths)} trashed trees left by an earlier run")
+
+    async def _broadcast_changes(self, source, changes):
+        """Have the workers other than ``source`` drop the paths a call on ``source`` changed.
+
+        Workers that are restarting are skipped, as they start with empty caches.
+        """
+        results = await asyncio.gather(*[
+            worker.request({"type": "invalidate", "changes": changes})
+            for worker in self.workers if worker is not source and worker.ready.is_set()
+        ], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to invalidate changed paths on a worker: {str(result)}")
+
+    async def _disconnect_client(self, client):
+        await asyncio.gather(*[worker.request({"type": "disconnect", "client": client}) for worker in self.workers],
+                             return_exceptions=True)
+
+    def route(self, name, args, kwargs=None):
+        """Pick the worker of a call, removing the worker prefix from an id argument.
+
+        Returns:
+            tuple: ``(worker, args, kwargs)``
+        """
+        args, kwargs = list(args), dict(kwargs or {})
+        position, key = WORKER_TOKEN_ARGUMENTS.get(name, (None, None))
+        if position is not None:
+            container, slot = (args, position) if len(args) > position else (kwargs, key)
+            value = args[position] if container is args else kwargs.get(key)
+            if isinstance(value, str):
+                index, separator, token = value.partition(":")
+                if separator and index.isdigit() and int(index) < len(self.workers):
+                    container[slot] = token
+                    return self.workers[int(index)], args, kwargs
+        if name in WORKER_INDEX_OPERATIONS:
+            return self.workers[0], args, kwargs
+        first = args[0] if args else next(iter(kwargs.values()), None)
+        path = affinity_path(first)
+        if path is None:
+            return min(self.workers, key=lambda worker: worker.load), args, kwargs
+        return self.workers[zlib.crc32(path.encode()) % len(self.workers)], args, kwargs
+
+    def _proxy(self, name):
+        async def proxy(*args, context=None, **kwargs):
+            worker, args, kwargs = self.route(name, args, kwargs)
+            if name == "watch":
+                # Event batches carry the id watch() returned, with its worker prefix
+                args = [prefix_watch_id(item, worker.index) if callable(item) else item for item in args]
+                kwargs = {key: prefix_watch_id(item, worker.index) if callable(item) else item
+                          for key, item in kwargs.items()}
+            callback_ids = []
+            message = {"type": "call", "method": name, "args": worker.export_args(args, callback_ids),
+                       "kwargs": worker.export_args(kwargs, callback_ids), "context": context}
+            try:
+                result = await worker.request(message)
+            except BaseException:
+                worker.release_callbacks(callback_ids)
+                raise
+            if name == "watch" and isinstance(result, dict) and result.get("watchId"):
+                worker.keep_callbacks(result["watchId"], callback_ids)
+            else:
+                worker.release_callbacks(callback_ids)
+            if name == "unwatch" and isinstance(result, dict) and result.get("success"):
+                worker.release_subscription(args[0] if args else kwargs.get("watchId"))
+            field = WORKER_RESULT_TOKENS.get(name)
+            if field and isinstance(result, dict) and result.get(field) is not None:
+                result = {**result, field: f"{worker.index}:{result[field]}"}
+            return result
+        proxy.__name__ = name
+        return proxy
+
+    async def _batch(self, ops, concurrent=False, stopOnError=False, maxConcurrency=BATCH_MAX_CONCURRENCY, context=None):
+        """Run a batch here, sending each operation to its own worker as a single call would be."""
+        operations = {name: functools.partial(func, context=context) for name, func in self.operations.items()}
+        return await run_batch(operations, ops, concurrent, stopOnError, maxConcurrency)
+
+    async def _gather_workers(self, name, *args, context=None):
+        return await asyncio.gather(*[
+            worker.request({"type": "call", "method": name, "args": list(args), "context": context})
+            for worker in self.workers
+        ])
+
+    async def _get_metrics(self, format=None, context=None):
+        """Metrics of all workers: call counters and histograms summed, the rest per worker."""
+        try:
+            if format not in (None, "prometheus"):
+                raise ValueError(f"Unsupported metrics format: {format}")
+            states = await self._gather_workers("getMetrics", "state", context=context)
+            for state in states:
+                if "error" in state:
+                    raise RuntimeError(state["error"])
+            merged = ServiceMetrics.merged([state["service"] for state in states])
+            if format == "prometheus":
+                return merged.prometheus() + merge_prometheus([state["prometheus"] for state in states])
+            result = merged.snapshot()
+            result["workers"] = [
+                {key: value for key, value in state.items() if key not in ("service", "prometheus")}
+                for state in states
+            ]
+            for index, worker in enumerate(result["workers"]):
+                worker.update(index=index, restarts=self.workers[index].restarts)
+            return result
+        except Exception as e:
+            logger.error(f"Error collecting metrics: {str(e)}", exc_info=True)
+            return {"error": str(e)}
+
+    async def _get_traces(self, limit=100, context=None):
+        """The most recent sampled call traces of all workers, newest last."""
+        try:
+            limit = page_limit(limit, TRACE_BUFFER_SIZE)
+            traces = [trace for worker_traces in await self._gather_workers("getTraces", limit, context=context)
+                      for trace in worker_traces]
+            return sorted(traces, key=lambda trace: trace["start"])[-limit:]
+        except Exception as e:
+            return {"error": str(e)}
+
+    def _generator_proxy(self, name):
+        async def generator_proxy(*args, context=None, **kwargs):
+            worker, args, kwargs = self.route(name, args, kwargs)
+            generator_id = await worker.request({"type": "call", "method": name, "args": args, "kwargs": kwargs,
+                                                 "context": context})
+            done = False
+            try:
+                while True:
+                    step = await worker.request({"type": "next", "generator": generator_id})
+                    if step.get("done"):
+                        done = True
+                        return
+                    yield step["value"]
+            finally:
+                if not done:
+                    with contextlib.suppress(Exception):
+                        await worker.request({"type": "aclose", "generator": generator_id})
+        generator_proxy.__name__ = name
+        return generator_proxy
+
+    def stats(self):
+        """Load and restart count of each worker."""
+        return [{"index": worker.index, "load": worker.load, "restarts": worker.restarts, "ready": worker.ready.is_set()}
+                for worker in self.workers]
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    if args.worker_fd is not None:
+        await serve_worker(args.worker_fd)
+        return
+
+    logging.basicConfig(level=getattr(logging, args.log_level))
+    logger.info("Starting AsyncFileService")
+
+    service = MultiProcessFileService(args) if args.workers > 1 else AsyncFileService(args)
+    await service.start()
+
+    server = await connect_to_server(
+        {"name": "anonymous client", "server_url": "https://hypha.aicell.io"}
+    )
+    logger.info(f"Connected to server: {server.config.workspace}")
+    svc = await service.register(server)
 
     print("AsyncFileService is ready: " + svc.id)
     print(f"Test the service at https://hypha.aicell.io/{server.config.workspace}/services/{svc.id.split('/')[1]}")
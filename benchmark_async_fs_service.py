@@ -0,0 +1,381 @@
+"""Benchmarks for async_fs_service, driven in-process through LocalServer.
+
+Each benchmark reports the number of operations, throughput and latency
+percentiles. Save a run with ``--json`` and compare a later one against it
+with ``--baseline``; the script then exits with status 1 if any benchmark
+lost more than ``--max-regression`` of its throughput.
+
+Examples:
+    python benchmark_async_fs_service.py
+    python benchmark_async_fs_service.py --only listing stat --listing-sizes 10000
+    python benchmark_async_fs_service.py --large-size 4G --json release.json
+    python benchmark_async_fs_service.py --baseline release.json
+    python benchmark_async_fs_service.py --workers 4 --only stat
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+
+from async_fs_service import AsyncFileService, MultiProcessFileService, LocalServer, SERVICE_ID
+
+MiB = 1024 * 1024
+SIZE_SUFFIXES = {"K": 1024, "M": MiB, "G": 1024 * MiB}
+
+
+def parse_size(text):
+    """Parse a byte size such as ``512M`` or ``2G``."""
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the async file service in-process')
+    parser.add_argument('--root',
+                       type=str,
+                       default=None,
+                       help='Directory to run in (default: a temporary directory, removed afterwards)')
+    parser.add_argument('--only',
+                       nargs='+',
+                       choices=list(BENCHMARKS),
+                       help='Run only these benchmarks')
+    parser.add_argument('--listing-sizes',
+                       type=lambda text: [int(n) for n in text.split(',')],
+                       default=[10000, 100000],
+                       help='Comma-separated entry counts of the listed directories (default: 10000,100000)')
+    parser.add_argument('--stat-calls',
+                       type=int,
+                       default=20000,
+                       help='Number of stat calls of the stat storm (default: 20000)')
+    parser.add_argument('--small-files',
+                       type=int,
+                       default=2000,
+                       help='Number of small files written and read (default: 2000)')
+    parser.add_argument('--small-size',
+                       type=parse_size,
+                       default=4096,
+                       help='Size of each small file (default: 4K)')
+    parser.add_argument('--large-size',
+                       type=parse_size,
+                       default=parse_size('1G'),
+                       help='Size of the large file written and read (default: 1G)')
+    parser.add_argument('--handle-ops',
+                       type=int,
+                       default=5000,
+                       help='Number of reads and of writes of the concurrent handle I/O benchmark (default: 5000)')
+    parser.add_argument('--concurrency',
+                       type=int,
+                       default=32,
+                       help='Calls in flight for concurrent benchmarks (default: 32)')
+    parser.add_argument('--no-serialize',
+                       action='store_true',
+                       help='Pass values by reference instead of round-tripping them through msgpack')
+    parser.add_argument('--workers',
+                       type=int,
+                       default=1,
+                       help='Serve from this many worker processes (default: 1, in-process)')
+    parser.add_argument('--index',
+                       action='store_true',
+                       help='Keep the search index enabled while benchmarking')
+    parser.add_argument('--json',
+                       type=str,
+                       default=None,
+                       help='Write the results to this JSON file')
+    parser.add_argument('--baseline',
+                       type=str,
+                       default=None,
+                       help='Compare throughput against the results of an earlier --json run')
+    parser.add_argument('--max-regression',
+                       type=float,
+                       default=0.2,
+                       help='Tolerated fraction of throughput lost against the baseline (default: 0.2)')
+    return parser.parse_args(argv)
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(name, latencies, elapsed, nbytes=0, **extra):
+    """Build the result of one benchmark from per-operation latencies in seconds."""
+    ordered = sorted(latencies)
+    result = {
+        "name": name,
+        "ops": len(ordered),
+        "seconds": elapsed,
+        "opsPerSec": len(ordered) / elapsed if elapsed else 0.0,
+        "mbPerSec": nbytes / MiB / elapsed if elapsed and nbytes else 0.0,
+        "p50Ms": percentile(ordered, 0.5) * 1000,
+        "p95Ms": percentile(ordered, 0.95) * 1000,
+        "p99Ms": percentile(ordered, 0.99) * 1000,
+        "maxMs": (ordered[-1] if ordered else 0.0) * 1000,
+    }
+    result.update(extra)
+    return result
+
+
+def check(result):
+    """Raise if a service call reported an error."""
+    if isinstance(result, dict) and "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+
+async def run_concurrently(calls, concurrency):
+    """Await zero-argument coroutine functions with bounded concurrency.
+
+    Returns:
+        tuple: ``(latencies, elapsed)`` in seconds
+    """
+    limit = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run(call):
+        async with limit:
+            start = time.perf_counter()
+            check(await call())
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run(call) for call in calls])
+    return latencies, time.perf_counter() - start
+
+
+def create_files(directory, count, size=0):
+    """Create ``count`` files of ``size`` bytes, unless the directory already has them."""
+    os.makedirs(directory, exist_ok=True)
+    if len(os.listdir(directory)) == count:
+        return
+    data = os.urandom(size)
+    for i in range(count):
+        with open(os.path.join(directory, f"file-{i:07d}.txt"), "wb") as f:
+            f.write(data)
+
+
+def create_large_file(path, size):
+    block = os.urandom(8 * MiB)
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            written += f.write(block[:size - written])
+
+
+async def bench_listing(fs, server, root, options):
+    results = []
+    loop = asyncio.get_running_loop()
+    for size in options.listing_sizes:
+        directory = f"listing-{size}"
+        await loop.run_in_executor(None, create_files, os.path.join(root, directory), size)
+
+        async def read_pages(method, *extra):
+            cursor = None
+            entries = 0
+            while True:
+                page = check(await getattr(fs, method)(f"/{directory}", *extra, cursor))
+                entries += len(page["entries"] if "entries" in page else page["names"])
+                cursor = page["cursor"]
+                if not cursor:
+                    return entries
+
+        variants = [
+            ("readdir", lambda: fs.readdir(f"/{directory}")),
+            ("readdirwithstats", lambda: fs.readdirwithstats(f"/{directory}")),
+            ("readdirpage", lambda: read_pages("readdirpage")),
+            ("readdircolumns", lambda: read_pages("readdircolumns", None)),
+        ]
+        for method, call in variants:
+            # The first listing is uncached; later ones may hit the metadata cache
+            for label, repeats in (("cold", 1), ("warm", 3)):
+                latencies = []
+                wire_before = server.wire_bytes
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    call_start = time.perf_counter()
+                    check(await call())
+                    latencies.append(time.perf_counter() - call_start)
+                elapsed = time.perf_counter() - start
+                results.append(summarize(
+                    f"listing-{size}/{method}/{label}", latencies, elapsed,
+                    entriesPerSec=size * repeats / elapsed,
+                    wireBytes=(server.wire_bytes - wire_before) // repeats,
+                ))
+    return results
+
+
+async def bench_stat(fs, server, root, options):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, create_files, os.path.join(root, "stat"), 1000)
+    paths = [f"/stat/file-{random.randrange(1000):07d}.txt" for _ in range(options.stat_calls)]
+    results = []
+    for label in ("cold", "warm"):
+        latencies, elapsed = await run_concurrently(
+            [lambda p=p: fs.stat(p) for p in paths], options.concurrency)
+        results.append(summarize(f"stat/{label}", latencies, elapsed))
+    ops = [{"op": "stat", "args": [p]} for p in paths]
+    batches = [ops[i:i + 500] for i in range(0, len(ops), 500)]
+    latencies, elapsed = await run_concurrently(
+        [lambda batch=batch: fs.batch(batch, True) for batch in batches], options.concurrency)
+    results.append(summarize("stat/batch500", latencies, elapsed, statsPerSec=len(ops) / elapsed))
+    return results
+
+
+async def bench_small_files(fs, server, root, options):
+    data = os.urandom(options.small_size)
+    paths = [f"/small/file-{i:07d}.bin" for i in range(options.small_files)]
+    total = len(data) * len(paths)
+    if not await fs.exists("/small"):
+        check(await fs.mkdir("/small", 0o755))
+    latencies, elapsed = await run_concurrently(
+        [lambda p=p: fs.writeFile(p, data, "binary", "w", None) for p in paths], options.concurrency)
+    results = [summarize("small-files/write", latencies, elapsed, total)]
+    latencies, elapsed = await run_concurrently(
+        [lambda p=p: fs.readFile(p, "binary", "r") for p in paths], options.concurrency)
+    results.append(summarize("small-files/read", latencies, elapsed, total))
+    return results
+
+
+async def bench_large_file(fs, server, root, options):
+    size = options.large_size
+    chunk = os.urandom(8 * MiB)
+    session = check(await fs.beginUpload("/large.bin", size))
+    offsets = list(range(0, size, len(chunk)))
+    latencies, elapsed = await run_concurrently(
+        [lambda offset=offset: fs.putChunk(session["sessionId"], offset, chunk[:size - offset])
+         for offset in offsets], 4)
+    start = time.perf_counter()
+    check(await fs.commitUpload(session["sessionId"]))
+    elapsed += time.perf_counter() - start
+    results = [summarize("large-file/upload", latencies, elapsed, size)]
+
+    latencies = []
+    received = 0
+    start = last = time.perf_counter()
+    async for data in fs.readFileChunks("/large.bin", 8 * MiB):
+        now = time.perf_counter()
+        latencies.append(now - last)
+        last = now
+        received += len(data)
+    elapsed = time.perf_counter() - start
+    if received != size:
+        raise RuntimeError(f"Read {received} bytes of a {size} byte file")
+    results.append(summarize("large-file/readFileChunks", latencies, elapsed, size))
+    check(await fs.unlink("/large.bin"))
+    return results
+
+
+async def bench_handle_io(fs, server, root, options):
+    size = 256 * MiB
+    block = 64 * 1024
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, create_large_file, os.path.join(root, "handle.bin"), size)
+    handle = await fs.openFile("/handle.bin", "r+")
+    data = os.urandom(block)
+    offsets = [random.randrange(size // block) * block for _ in range(options.handle_ops)]
+
+    def read_at(offset):
+        return handle["read"](bytearray(block), 0, block, offset)
+
+    def write_at(offset):
+        return handle["write"](data, 0, block, offset)
+
+    try:
+        latencies, elapsed = await run_concurrently(
+            [lambda offset=offset: read_at(offset) for offset in offsets], options.concurrency)
+        results = [summarize("handle-io/random-read-64K", latencies, elapsed, block * len(offsets))]
+        latencies, elapsed = await run_concurrently(
+            [lambda offset=offset: write_at(offset) for offset in offsets], options.concurrency)
+        results.append(summarize("handle-io/random-write-64K", latencies, elapsed, block * len(offsets)))
+        calls = [lambda offset=offset, i=i: (read_at if i % 2 else write_at)(offset)
+                 for i, offset in enumerate(offsets)]
+        latencies, elapsed = await run_concurrently(calls, options.concurrency)
+        results.append(summarize("handle-io/mixed-64K", latencies, elapsed, block * len(offsets)))
+    finally:
+        await handle["close"]()
+    return results
+
+
+BENCHMARKS = {
+    "listing": bench_listing,
+    "stat": bench_stat,
+    "small-files": bench_small_files,
+    "large-file": bench_large_file,
+    "handle-io": bench_handle_io,
+}
+
+
+def print_results(results):
+    header = f"{'benchmark':<42} {'ops':>7} {'ops/s':>10} {'MB/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['name']:<42} {r['ops']:>7} {r['opsPerSec']:>10.1f} {r['mbPerSec']:>9.1f} "
+              f"{r['p50Ms']:>9.3f} {r['p95Ms']:>9.3f} {r['p99Ms']:>9.3f} {r['maxMs']:>9.3f}")
+
+
+def compare(results, baseline, max_regression):
+    """Print throughput changes against a baseline; returns the names of regressed benchmarks."""
+    previous = {r["name"]: r for r in baseline["results"]}
+    regressed = []
+    print(f"\n{'benchmark':<42} {'baseline ops/s':>15} {'ops/s':>10} {'change':>8}")
+    for r in results:
+        before = previous.get(r["name"])
+        if before is None or not before["opsPerSec"]:
+            continue
+        change = r["opsPerSec"] / before["opsPerSec"] - 1
+        flag = ""
+        if change < -max_regression:
+            regressed.append(r["name"])
+            flag = "  REGRESSION"
+        print(f"{r['name']:<42} {before['opsPerSec']:>15.1f} {r['opsPerSec']:>10.1f} {change:>+8.1%}{flag}")
+    return regressed
+
+
+async def run(options):
+    root = options.root or tempfile.mkdtemp(prefix="async-fs-bench-")
+    os.makedirs(root, exist_ok=True)
+    results = []
+    try:
+        service_class = MultiProcessFileService if options.workers > 1 else AsyncFileService
+        async with service_class(root=root, no_index=not options.index, slow_op_threshold=0,
+                                 workers=options.workers) as service:
+            server = LocalServer(serialize=not options.no_serialize)
+            await service.register(server)
+            fs = await server.get_service(SERVICE_ID)
+            for name in options.only or BENCHMARKS:
+                print(f"Running {name}...", file=sys.stderr)
+                results.extend(await BENCHMARKS[name](fs, server, root, options))
+    finally:
+        if options.root is None:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(run(options))
+    print_results(results)
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump({"created": time.time(), "results": results}, f, indent=2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressed = compare(results, json.load(f), options.max_regression)
+        if regressed:
+            print(f"\n{len(regressed)} benchmark(s) regressed by more than {options.max_regression:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
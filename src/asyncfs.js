@@ -21,6 +21,181 @@ function convertError(err, message = err.toString()) {
     }
 }
 
+const COLUMN_ARRAY_TYPES = {
+    float64: Float64Array,
+    uint32: Uint32Array,
+    uint16: Uint16Array,
+    uint64: BigUint64Array
+}
+
+/**
+ * Merge the pages of a columnar listing (see readdircolumns) into one
+ * listing with a typed array per field. Mime ids are remapped onto a
+ * single mime table.
+ */
+function mergeColumnPages(pages) {
+    const count = pages.reduce((total, page) => total + page.count, 0)
+    const types = pages.length > 0 ? pages[0].types : {}
+    const listing = { names: [], count, mimes: [], columns: {} }
+    for (const field of Object.keys(types)) {
+        listing.columns[field] = new COLUMN_ARRAY_TYPES[types[field]](count)
+    }
+    const mimeIds = new Map()
+    let offset = 0
+    for (const page of pages) {
+        for (const name of page.names) {
+            listing.names.push(name)
+        }
+        for (const field of Object.keys(types)) {
+            const bytes = page.columns[field]
+            // Copy so the typed array is aligned to its element size
+            const buffer = bytes.buffer.slice(bytes.byteOffset, bytes.byteOffset + bytes.byteLength)
+            const values = new COLUMN_ARRAY_TYPES[types[field]](buffer)
+            if (field === 'mime') {
+                const ids = page.mimes.map((mime) => {
+                    if (!mimeIds.has(mime)) {
+                        mimeIds.set(mime, listing.mimes.length)
+                        listing.mimes.push(mime)
+                    }
+                    return mimeIds.get(mime)
+                })
+                for (let i = 0; i < values.length; i++) {
+                    listing.columns.mime[offset + i] = ids[values[i]]
+                }
+            } else {
+                listing.columns[field].set(values, offset)
+            }
+        }
+        offset += page.count
+    }
+    listing.index = new Map(listing.names.map((name, i) => [name, i]))
+    return listing
+}
+
+// Payloads smaller than this are sent uncompressed
+const COMPRESSION_MIN_SIZE = 64 * 1024
+// Bytes at the start of a payload compressed to probe whether it is worth compressing
+const COMPRESSION_PROBE_SIZE = 64 * 1024
+// A payload is compressed only if its probe shrinks to less than this fraction
+const COMPRESSION_MAX_RATIO = 0.9
+
+async function transformBytes(bytes, stream) {
+    return new Uint8Array(await new Response(new Blob([bytes]).stream().pipeThrough(stream)).arrayBuffer())
+}
+
+/**
+ * Compress bytes with zlib, the transfer codec browsers support natively
+ */
+export function deflate(bytes) {
+    return transformBytes(bytes, new CompressionStream('deflate'))
+}
+
+/**
+ * Whether bytes are large enough and compress well enough, judging from
+ * their first block, to be worth compressing for transfer
+ */
+export async function isCompressible(bytes) {
+    if (bytes.length < COMPRESSION_MIN_SIZE) {
+        return false
+    }
+    const probe = bytes.subarray(0, COMPRESSION_PROBE_SIZE)
+    return (await deflate(probe)).length < probe.length * COMPRESSION_MAX_RATIO
+}
+
+/**
+ * Unpack a payload ({codec, data, size}) returned by the server when
+ * compression was requested
+ */
+async function decodePayload(payload) {
+    if (payload.codec && payload.codec !== 'zlib') {
+        throw new Error(`Unsupported transfer compression: ${payload.codec}`)
+    }
+    const data = payload.codec ? await transformBytes(payload.data, new DecompressionStream('deflate')) : payload.data
+    return payload.encoding ? new TextDecoder(payload.encoding).decode(data) : data
+}
+
+// Files of at least this size are saved as a delta against their current version
+const DELTA_MIN_SIZE = 1024 * 1024
+// A delta sending more than this share of the file as literal bytes is not worth it
+const DELTA_MAX_LITERAL_RATIO = 0.5
+const ADLER_MOD = 65521
+
+/**
+ * Adler-32 checksum of data[start, end), as computed by zlib
+ */
+function adler32(data, start, end) {
+    let a = 1
+    let b = 0
+    for (let i = start; i < end; i++) {
+        a = (a + data[i]) % ADLER_MOD
+        b = (b + a) % ADLER_MOD
+    }
+    return ((b << 16) | a) >>> 0
+}
+
+/**
+ * Slide an Adler-32 checksum of a `length` byte window one byte forward
+ */
+function rollAdler32(checksum, removed, added, length) {
+    const a = ((checksum & 0xffff) - removed + added + ADLER_MOD) % ADLER_MOD
+    const b = (((checksum >>> 16) - (length * removed) % ADLER_MOD + a - 1) % ADLER_MOD + 2 * ADLER_MOD) % ADLER_MOD
+    return ((b << 16) | a) >>> 0
+}
+
+/**
+ * Express `data` as copies of blocks of the current file version, described
+ * by `sums` (see getBlockChecksums), and literal bytes, rsync style
+ */
+async function computeDelta(data, sums) {
+    const { blockSize, digestSize } = sums
+    const weakBytes = sums.weak.buffer.slice(sums.weak.byteOffset, sums.weak.byteOffset + sums.weak.byteLength)
+    const weak = new Uint32Array(weakBytes)
+    const digestName = sums.algorithm === 'sha256' ? 'SHA-256' : 'SHA-1'
+    // Only full blocks are matched; a short last block is sent as literal bytes
+    const blocks = new Map()
+    for (let index = 0; index < Math.floor(sums.size / blockSize); index++) {
+        if (!blocks.has(weak[index])) {
+            blocks.set(weak[index], [])
+        }
+        blocks.get(weak[index]).push(index)
+    }
+    const ops = []
+    let literal = 0
+    let literalStart = 0
+    const addLiteral = (end) => {
+        if (end > literalStart) {
+            ops.push({ data: data.subarray(literalStart, end) })
+            literal += end - literalStart
+        }
+    }
+    let position = 0
+    let checksum = data.length >= blockSize ? adler32(data, 0, blockSize) : 0
+    while (position + blockSize <= data.length) {
+        const candidates = blocks.get(checksum)
+        let match
+        if (candidates) {
+            const digest = new Uint8Array(await crypto.subtle.digest(digestName, data.subarray(position, position + blockSize)))
+            match = candidates.find((index) => digest.every((byte, i) => byte === sums.strong[index * digestSize + i]))
+        }
+        if (match !== undefined) {
+            addLiteral(position)
+            ops.push({ copy: match * blockSize, length: blockSize })
+            position += blockSize
+            literalStart = position
+            if (position + blockSize <= data.length) {
+                checksum = adler32(data, position, position + blockSize)
+            }
+        } else {
+            if (position + blockSize < data.length) {
+                checksum = rollAdler32(checksum, data[position], data[position + blockSize], blockSize)
+            }
+            position++
+        }
+    }
+    addLiteral(data.length)
+    return { ops, literal }
+}
+
 export class AsyncFile extends BaseFile {
     static _inMemoryStorage = new Map()
     constructor(asyncFile) {
@@ -427,9 +602,17 @@ export class AsyncFileSystem extends BaseFileSystem {
         this._statsCache = new Map();
         this._statsCacheExpiration = 5000; // 5 seconds expiration
         this._hasReaddirWithStats = typeof fsAPI.readdirwithstats === 'function';
+        this._hasReaddirPage = typeof fsAPI.readdirpage === 'function';
+        this._hasReaddirColumns = typeof fsAPI.readdircolumns === 'function';
+        this._hasDeltaWrites = typeof fsAPI.getBlockChecksums === 'function' && typeof fsAPI.applyDelta === 'function';
+        this._transferCompressionPromise = null;
+        // Columnar listings by directory; per-entry stats are built from them on demand
+        this._listingCache = new Map();
         
         console.debug('AsyncFileSystem.constructor - cache initialized', {
-            hasReaddirWithStats: this._hasReaddirWithStats
+            hasReaddirWithStats: this._hasReaddirWithStats,
+            hasReaddirPage: this._hasReaddirPage,
+            hasReaddirColumns: this._hasReaddirColumns
         });
     }
 
@@ -651,13 +834,111 @@ export class AsyncFileSystem extends BaseFileSystem {
         }
     }
 
+    /**
+     * List a directory with stats, page by page if the backend supports readdirpage
+     * @param {string} p Normalized directory path
+     * @param {Function} [onPage] Called with the stats of each page as soon as it arrives
+     * @returns {Promise<Array>} Stats of all entries in the directory
+     */
+    async _fetchDirectoryStats(p, onPage) {
+        if (!this._hasReaddirPage) {
+            const filesWithStats = await this.fsAPI.readdirwithstats(p);
+            if (filesWithStats && filesWithStats.error) {
+                throw new Error(filesWithStats.error);
+            }
+            if (onPage) onPage(filesWithStats);
+            return filesWithStats;
+        }
+
+        const filesWithStats = [];
+        let cursor = null;
+        do {
+            const page = await this.fsAPI.readdirpage(p, cursor);
+            if (page.error) {
+                throw new Error(page.error);
+            }
+            console.debug('AsyncFileSystem._fetchDirectoryStats - got page', {
+                path: p,
+                entries: page.entries.length,
+                total: page.total
+            });
+            if (onPage) onPage(page.entries);
+            filesWithStats.push(...page.entries);
+            cursor = page.cursor;
+        } while (cursor);
+        return filesWithStats;
+    }
+
+    /**
+     * List a directory in the compact columnar format, page by page
+     * @param {string} p Normalized directory path
+     * @returns {Promise<Object>} Merged listing: names, mimes and typed columns
+     */
+    async _fetchDirectoryColumns(p) {
+        const pages = [];
+        let cursor = null;
+        do {
+            const page = await this.fsAPI.readdircolumns(p, ['size', 'mtime', 'mode', 'mime'], cursor);
+            if (page.error) {
+                throw new Error(page.error);
+            }
+            pages.push(page);
+            cursor = page.cursor;
+        } while (cursor);
+        const listing = mergeColumnPages(pages);
+        const now = Date.now();
+        listing.expires = now + this._statsCacheExpiration;
+        this._listingCache.set(this._listingKey(p), listing);
+        return listing;
+    }
+
+    _listingKey(dir) {
+        return this._normalizePath(dir).replace(/\/+$/, '');
+    }
+
+    /**
+     * Build the stats of entry i of a columnar listing, in the same shape
+     * as the stat dicts returned by the server
+     */
+    _statsFromListing(listing, i) {
+        const mime = listing.mimes[listing.columns.mime[i]];
+        const mode = listing.columns.mode[i];
+        return {
+            name: listing.names[i],
+            size: listing.columns.size[i],
+            mtime: listing.columns.mtime[i],
+            mode,
+            mime,
+            isDirectory: mime === 'directory',
+            isFile: (mode & 0o170000) === 0o100000
+        };
+    }
+
     async _readdirwithstats(p, cb) {
         p = this._normalizePath(p);
         
         try {
+            if (this._hasReaddirColumns) {
+                const listing = await this._fetchDirectoryColumns(p);
+                const { size, mtime, mode, mime } = listing.columns;
+                const processedFiles = listing.names.map((name, i) => {
+                    const isDir = listing.mimes[mime[i]] === 'directory';
+                    const finalStats = new Stats(
+                        isDir ? FileType.DIRECTORY : FileType.FILE,
+                        size[i],
+                        mode[i] || 0o666,
+                        new Date(),
+                        new Date(mtime[i])
+                    );
+                    return {"name": name, "stats": finalStats, "isdir": isDir};
+                });
+                cb(null, processedFiles);
+                return;
+            }
+
             // If we have the readdirwithstats API available, use it
-            if (this._hasReaddirWithStats) {
-                const filesWithStats = await this.fsAPI.readdirwithstats(p);
+            if (this._hasReaddirWithStats || this._hasReaddirPage) {
+                const filesWithStats = await this._fetchDirectoryStats(p);
                 
                 // Process and cache the stats
                 const processedFiles = filesWithStats.map((fileInfo) => {
@@ -764,9 +1045,23 @@ export class AsyncFileSystem extends BaseFileSystem {
                 hasReaddirWithStats: this._hasReaddirWithStats
             });
             
+            // Columnar listings keep the stats in typed arrays until they are needed
+            if (this._hasReaddirColumns) {
+                const listing = await this._fetchDirectoryColumns(p);
+                cb(null, listing.names);
+                return;
+            }
+
             // If the backend supports readdirwithstats, use it and cache the results
-            if (this._hasReaddirWithStats) {
-                const filesWithStats = await this.fsAPI.readdirwithstats(p);
+            if (this._hasReaddirWithStats || this._hasReaddirPage) {
+                // Cache each page's stats as soon as it arrives
+                const filesWithStats = await this._fetchDirectoryStats(p, (entries) => {
+                    for (const fileInfo of entries) {
+                        // Join the directory path and filename properly to prevent duplicated paths
+                        const filePath = join(p, fileInfo.name);
+                        this._cacheStats(this._normalizePath(filePath), fileInfo);
+                    }
+                });
                 console.debug('AsyncFileSystem.readdir - got readdirwithstats response', { 
                     filesLength: filesWithStats.length, 
                     firstItem: filesWithStats.length > 0 ? filesWithStats[0] : null
@@ -775,20 +1070,6 @@ export class AsyncFileSystem extends BaseFileSystem {
                 // Extract the filenames for the callback
                 const fileNames = filesWithStats.map(item => item.name);
                 
-                // Cache each file's stats
-                for (const fileInfo of filesWithStats) {
-                    // Join the directory path and filename properly to prevent duplicated paths
-                    const filePath = join(p, fileInfo.name);
-                    const normalizedPath = this._normalizePath(filePath);
-                    console.debug('AsyncFileSystem.readdir - caching stats', {
-                        dirPath: p,
-                        fileName: fileInfo.name,
-                        joinedPath: filePath,
-                        normalizedPath: normalizedPath
-                    });
-                    this._cacheStats(normalizedPath, fileInfo);
-                }
-                
                 cb(null, fileNames);
                 return;
             }
@@ -837,7 +1118,16 @@ export class AsyncFileSystem extends BaseFileSystem {
         console.debug('AsyncFileSystem.readFile', { fname, encoding, flag });
         fname = this._normalizePath(fname)
         try {
-            const data = await this.fsAPI.readFile(fname, encoding, flag)
+            const compression = await this._transferCompression()
+            let data = compression
+                ? await this.fsAPI.readFile(fname, encoding, flag, compression)
+                : await this.fsAPI.readFile(fname, encoding, flag)
+            if (data && data.error) {
+                throw new Error(data.error)
+            }
+            if (compression) {
+                data = await decodePayload(data)
+            }
             console.debug('AsyncFileSystem.readFile - success', { dataLength: data.length });
             cb(null, data)
         } catch (err) {
@@ -875,7 +1165,9 @@ export class AsyncFileSystem extends BaseFileSystem {
 
             // Pass mode directly without conversion - let the fsAPI handle it
             console.debug('AsyncFileSystem.writeFile - calling fsAPI.writeFile');
-            const result = await this.fsAPI.writeFile(fname, data, encoding, flag, mode);
+            const result = await this._writeFileDelta(fname, data, flag)
+                ? null
+                : await this._writeFileFull(fname, data, encoding, flag, mode);
             
             console.debug('AsyncFileSystem.writeFile - fsAPI response', { 
                 result,
@@ -904,6 +1196,63 @@ export class AsyncFileSystem extends BaseFileSystem {
         }
     }
 
+    /**
+     * Resolve to the compression to request from the server ({zlib: null}),
+     * or null if the server or the browser cannot compress transfers
+     */
+    _transferCompression() {
+        if (!this._transferCompressionPromise) {
+            this._transferCompressionPromise = (async () => {
+                if (typeof this.fsAPI.getTransferCodecs !== 'function' || typeof CompressionStream !== 'function') {
+                    return null;
+                }
+                const { codecs } = await this.fsAPI.getTransferCodecs();
+                return codecs && codecs.includes('zlib') ? { zlib: null } : null;
+            })().catch(() => null);
+        }
+        return this._transferCompressionPromise;
+    }
+
+    async _writeFileFull(fname, data, encoding, flag, mode) {
+        if (data instanceof Uint8Array && await this._transferCompression() && await isCompressible(data)) {
+            return this.fsAPI.writeFile(fname, await deflate(data), encoding, flag, mode, 'zlib', data.length);
+        }
+        return this.fsAPI.writeFile(fname, data, encoding, flag, mode);
+    }
+
+    /**
+     * Save a new version of an existing large file by sending only what
+     * changed (see getBlockChecksums and applyDelta on the server).
+     * Resolves to false if the file has to be written in full instead.
+     */
+    async _writeFileDelta(fname, data, flag) {
+        const flagString = flag && typeof flag.getFlagString === 'function' ? flag.getFlagString() : String(flag);
+        if (!this._hasDeltaWrites || flagString !== 'w' || !(data instanceof Uint8Array)
+            || data.length < DELTA_MIN_SIZE || !(globalThis.crypto && crypto.subtle)) {
+            return false;
+        }
+        try {
+            const stats = await this.fsAPI.stat(fname);
+            if (!stats || stats.error || !stats.isFile || stats.size < DELTA_MIN_SIZE) {
+                return false;
+            }
+            const sums = await this.fsAPI.getBlockChecksums(fname, null, 'sha1');
+            if (sums.error) {
+                return false;
+            }
+            const { ops, literal } = await computeDelta(data, sums);
+            if (literal > data.length * DELTA_MAX_LITERAL_RATIO) {
+                return false;
+            }
+            const result = await this.fsAPI.applyDelta(fname, ops, sums.version);
+            console.debug('AsyncFileSystem._writeFileDelta', { fname, size: data.length, literal, result });
+            return !result.error;
+        } catch (err) {
+            console.debug('AsyncFileSystem._writeFileDelta - falling back to a full write', err);
+            return false;
+        }
+    }
+
     appendFile(fname, data, encoding, flag, mode, cb) {
         fname = this._normalizePath(fname);
         this.fsAPI.appendFile(fname, data, encoding, flag, mode)
@@ -967,6 +1316,53 @@ export class AsyncFileSystem extends BaseFileSystem {
             .catch(err => cb(convertError(err)))
     }
 
+    /**
+     * Subscribe to change events of a directory pushed by the server.
+     * Cached stats of the affected entries are invalidated before
+     * onChange(batch) is called; a resync batch drops the whole directory.
+     * @param {string} p Directory path
+     * @param {Function} onChange Optional callback receiving each batch
+     * @returns {Promise<string|null>} Watch id, or null if the server cannot watch
+     */
+    async watch(p, onChange) {
+        if (typeof this.fsAPI.watch !== 'function') {
+            return null;
+        }
+        const result = await this.fsAPI.watch(this._normalizePath(p), async (batch) => {
+            console.debug('AsyncFileSystem.watch - change batch', batch);
+            if (batch.resync) {
+                this._invalidateTree(batch.path);
+            }
+            for (const event of batch.events) {
+                this._invalidateCache(event.path);
+                if (event.oldPath) {
+                    this._invalidateCache(event.oldPath);
+                }
+                if (event.isDir && event.type !== 'create') {
+                    this._invalidateTree(event.oldPath || event.path);
+                }
+            }
+            if (onChange) {
+                await onChange(batch);
+            }
+        });
+        if (result && result.error) {
+            throw new Error(result.error);
+        }
+        return result.watchId;
+    }
+
+    /**
+     * Cancel a subscription created by watch()
+     * @param {string} watchId Id returned by watch()
+     */
+    async unwatch(watchId) {
+        const result = await this.fsAPI.unwatch(watchId);
+        if (result && result.error) {
+            throw new Error(result.error);
+        }
+    }
+
     // Add cache management methods
     
     /**
@@ -1000,6 +1396,23 @@ export class AsyncFileSystem extends BaseFileSystem {
             console.debug('AsyncFileSystem - cached stats expired', { path });
             this._statsCache.delete(path);
         }
+
+        // Fall back to the columnar listing of the parent directory
+        const slash = path.lastIndexOf('/');
+        const listingKey = slash >= 0 ? path.substring(0, slash) : '';
+        const listing = this._listingCache.get(listingKey);
+        if (listing) {
+            if (listing.expires <= Date.now()) {
+                this._listingCache.delete(listingKey);
+            } else {
+                const i = listing.index.get(path.substring(slash + 1));
+                if (i !== undefined) {
+                    const stats = this._statsFromListing(listing, i);
+                    this._statsCache.set(path, { stats, timestamp: Date.now(), expires: listing.expires });
+                    return stats;
+                }
+            }
+        }
         
         return null;
     }
@@ -1016,12 +1429,41 @@ export class AsyncFileSystem extends BaseFileSystem {
         
         // Remove the specific path
         this._statsCache.delete(path);
+        this._listingCache.delete(this._listingKey(path));
         
         // Also invalidate parent directory to reflect changes in listings
         const parentDir = path.substring(0, path.lastIndexOf('/'));
         if (parentDir) {
             this._statsCache.delete(parentDir);
         }
+        this._listingCache.delete(parentDir);
+    }
+
+    /**
+     * Invalidate stats cache for a path and everything below it
+     * @param {string} path Directory path to invalidate
+     */
+    _invalidateTree(path) {
+        path = this._normalizePath(path);
+        if (path === '/' || path === '') {
+            this._clearCache();
+            return;
+        }
+        for (const key of Array.from(this._statsCache.keys())) {
+            if (key === path || key.startsWith(path + '/')) {
+                this._statsCache.delete(key);
+            }
+        }
+        const listingKey = this._listingKey(path);
+        for (const key of Array.from(this._listingCache.keys())) {
+            if (key === listingKey || key.startsWith(listingKey + '/')) {
+                this._listingCache.delete(key);
+            }
+        }
+        const parentDir = path.substring(0, path.lastIndexOf('/'));
+        if (parentDir) {
+            this._statsCache.delete(parentDir);
+        }
     }
 
     /**
@@ -1030,5 +1472,6 @@ export class AsyncFileSystem extends BaseFileSystem {
     _clearCache() {
         console.debug('AsyncFileSystem - clearing entire cache');
         this._statsCache.clear();
+        this._listingCache.clear();
     }
 }
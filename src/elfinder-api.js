@@ -5,7 +5,7 @@ import Jimp from 'jimp';
 import JSZip from 'jszip';
 import contentDisposition from 'content-disposition';
 import S3FS from "./s3";
-import { AsyncFileSystem } from  './asyncfs';
+import { AsyncFileSystem, deflate, isCompressible } from  './asyncfs';
 import { ArtifactFileSystem } from "./artifactFs";
 import { handleHyphaArtifacts } from "./fs-handlers/hypha-artifacts-handler";
 import { handleHyphaFs } from "./fs-handlers/hypha-fs-handler";
@@ -144,6 +144,10 @@ const config = {
 	tmbroot: '/tmp/.tmb',
 	tmburl: `/tmp/.tmb/`,
 	disabled: ['chmod', 'size'],
+	// Deletes on a file service rename into trash and return at once; the server purges in the background
+	trashOnDelete: true,
+	// Most results a search on a file service returns
+	searchLimit: 1000,
 	volumeicons: ['elfinder-navbar-root-local', 'elfinder-navbar-root-local'],
 	async init() {
 		if (!(await fs.exists(config.tmbroot))) {
@@ -260,10 +264,81 @@ export function parseFile(file, chunk_callback) {
 	})
 }
 
+// Sessions of uploads that failed, by target and file, so uploading the same file again resumes them
+const pendingUploads = {};
+
+async function resumableUpload(remote, file, key) {
+	const sessionId = pendingUploads[key];
+	if (sessionId) {
+		const status = await remote.fsAPI.getUploadStatus(sessionId);
+		if (!status.error && status.size === file.size) return { sessionId, ranges: status.ranges, received: status.received };
+		delete pendingUploads[key];
+	}
+	const session = await remote.fsAPI.beginUpload(remote.path, file.size);
+	if (session.error) throw new Error(session.error);
+	return { sessionId: session.sessionId, ranges: [], received: 0 };
+}
+
+async function uploadToRemote(remote, file, progressCallback) {
+	const key = `${remote.mountPoint}${remote.path}:${file.size}:${file.lastModified}`;
+	const session = await resumableUpload(remote, file, key);
+	// Chunks are compressed if the server accepts it and the start of the file compresses well
+	const compress = !!(await remote.afs._transferCompression())
+		&& await isCompressible(new Uint8Array(await file.slice(0, config.chunkSize).arrayBuffer()));
+	const offsets = [];
+	for (let offset = 0; offset < file.size; offset += config.chunkSize) {
+		const end = Math.min(offset + config.chunkSize, file.size);
+		// Chunks the server already has from an earlier attempt are not sent again
+		if (!session.ranges.some(([start, stop]) => start <= offset && end <= stop)) offsets.push(offset);
+	}
+	let uploaded = file.size - offsets.reduce((total, offset) => total + Math.min(config.chunkSize, file.size - offset), 0);
+	if (progressCallback && uploaded) progressCallback(uploaded);
+	// Several chunks are in flight at once; each one lands at its own offset
+	const sendChunks = async () => {
+		while (offsets.length) {
+			const offset = offsets.shift();
+			const chunk = new Uint8Array(await file.slice(offset, offset + config.chunkSize).arrayBuffer());
+			for (let attempt = 1; ; attempt++) {
+				try {
+					const result = compress
+						? await remote.fsAPI.putChunk(session.sessionId, offset, await deflate(chunk), 'zlib')
+						: await remote.fsAPI.putChunk(session.sessionId, offset, chunk);
+					if (result.error) throw new Error(result.error);
+					break;
+				}
+				catch (e) {
+					// The session survives dropped connections, so just resend the chunk
+					if (attempt >= 3) throw e;
+				}
+			}
+			uploaded += chunk.byteLength;
+			if (progressCallback) progressCallback(uploaded);
+		}
+	};
+	try {
+		await Promise.all([sendChunks(), sendChunks(), sendChunks(), sendChunks()]);
+		const result = await remote.fsAPI.commitUpload(session.sessionId);
+		if (result.error) throw new Error(result.error);
+		delete pendingUploads[key];
+	}
+	catch (e) {
+		// Keep the session (the server expires it when idle) so a retry only sends the missing chunks
+		pendingUploads[key] = session.sessionId;
+		throw e
+	}
+	finally {
+		remote.afs._invalidateCache(remote.path);
+	}
+}
+
 export async function writeFile(path, file, writeOffset, mode, progressCallback) {
 	let handle
 	writeOffset = writeOffset || 0;
 	mode = mode || 'w';
+	const remote = writeOffset === 0 && mode === 'w' && getRemoteFs(path, 'beginUpload');
+	if (remote) {
+		return await uploadToRemote(remote, file, progressCallback);
+	}
 	try {
 		handle = await fs.open(path, mode);
 		await parseFile(file, (chunk, offset) => {
@@ -319,6 +394,24 @@ api.dim = function (opts, res) {
 }
 
 
+/**
+ * Find the AsyncFileSystem mount serving an absolute path, so that an
+ * operation can run on the remote file service when it supports it.
+ * Returns { mountPoint, afs, fsAPI, path } or null.
+ */
+function getRemoteFs(absolutePath, method) {
+	const rootFs = BrowserFS.BFSRequire("fs").getRootFS();
+	if (!rootFs || !rootFs.mntMap) return null;
+	for (const mountPoint of Object.keys(rootFs.mntMap)) {
+		if (absolutePath !== mountPoint && !absolutePath.startsWith(mountPoint + '/')) continue;
+		const afs = rootFs.mntMap[mountPoint];
+		if (afs instanceof AsyncFileSystem && typeof afs.fsAPI[method] === 'function') {
+			return { mountPoint, afs, fsAPI: afs.fsAPI, path: absolutePath.substring(mountPoint.length) || '/' };
+		}
+	}
+	return null;
+}
+
 async function copyFile(source, target) {
 	var targetFile = target;
 
@@ -363,7 +456,17 @@ api.copy = function (opts, res) {
 		if (await fs.exists(opts.dst)) {
 			return reject('Destination exists');
 		}
-		if ((await fs.lstat(opts.src)).isDirectory()) {
+		const remoteSrc = getRemoteFs(opts.src, 'copyTree');
+		const remoteDst = getRemoteFs(opts.dst, 'copyTree');
+		if (remoteSrc && remoteDst && remoteSrc.mountPoint === remoteDst.mountPoint) {
+			// Both ends live on the same file service: copy on the server
+			const result = await remoteSrc.fsAPI.copyTree(remoteSrc.path, remoteDst.path);
+			remoteDst.afs._invalidateCache(remoteDst.path);
+			if (result.error || !result.success) {
+				return reject(result.error || result.errors.map(e => `${e.path}: ${e.error}`).join('\n'));
+			}
+		}
+		else if ((await fs.lstat(opts.src)).isDirectory()) {
 			await copyFolderRecursive(opts.src, opts.dst)
 		}
 		else {
@@ -852,6 +955,31 @@ api.netmount = function (opts, res) {
 
 	})
 }
+// Change subscription on the current working directory of a remote mount
+let cwdWatch = null;
+
+/**
+ * Watch the current working directory when it lives on a remote mount
+ * that pushes change events, so its cached stats are invalidated as files
+ * change on the server instead of waiting for a reload.
+ */
+async function watchCwd(absolutePath) {
+	if (cwdWatch && cwdWatch.absolutePath === absolutePath) return;
+	if (cwdWatch) {
+		const previous = cwdWatch;
+		cwdWatch = null;
+		previous.afs.unwatch(previous.watchId).catch(e => console.warn('Failed to unwatch', previous.absolutePath, e));
+	}
+	const remote = getRemoteFs(absolutePath, 'watch');
+	if (!remote) return;
+	try {
+		const watchId = await remote.afs.watch(remote.path);
+		if (watchId) cwdWatch = { absolutePath, afs: remote.afs, watchId };
+	} catch (e) {
+		console.warn('Failed to watch', absolutePath, e);
+	}
+}
+
 api.open = async function (opts, res) {
 	const data = {
 		init: opts.init,
@@ -882,6 +1010,7 @@ api.open = async function (opts, res) {
 	if(!_target) {
 		_target = _private.decode("v0_Lw");
 	}
+	await watchCwd(_target.absolutePath);
 	const result = await _private.info(_target.absolutePath)
 	data.cwd = result;
 	data.files = []
@@ -939,9 +1068,28 @@ api.parents = function (opts, res) {
 	})
 }
 
+/**
+ * Move many paths on one file service with a single moveMany call
+ */
+async function moveManyRemote(remote, moves) {
+	const result = await remote.fsAPI.moveMany(moves.map(({ src, dst }) => [src.path, dst.path]));
+	moves.forEach(({ src, dst }) => {
+		remote.afs._invalidateTree(src.path);
+		remote.afs._invalidateTree(dst.path);
+	});
+	if (result.error || !result.success) {
+		throw new Error(result.error || result.errors.map(e => `${e.path}: ${e.error}`).join('\n'));
+	}
+	return Promise.all(moves.map(({ src, dst }) => _private.info(dst.absolutePath).then(info => ({
+		added: [info],
+		removed: [_private.encode(src.absolutePath)]
+	}))));
+}
+
 api.paste = function (opts, res) {
 	return new Promise(function (resolve, reject) {
 		var tasks = [];
+		var moves = [];
 		var dest = _private.decode(opts.dst);
 		each(opts.targets, function (target) {
 			var info = _private.decode(target);
@@ -952,10 +1100,10 @@ api.paste = function (opts, res) {
 				name = fil + opts.suffix + ext;
 			}
 			if (opts.cut == 1) {
-				tasks.push(_private.move({
+				moves.push({
 					src: info.absolutePath,
 					dst: path.join(dest.absolutePath, name)
-				}));
+				});
 			} else {
 				tasks.push(api.copy({
 					src: info.absolutePath,
@@ -963,8 +1111,23 @@ api.paste = function (opts, res) {
 				}));
 			}
 		})
+		const remoteDest = moves.length && getRemoteFs(dest.absolutePath, 'moveMany');
+		const remoteMoves = remoteDest && moves.map(({ src, dst }) => ({
+			src: { ...getRemoteFs(src, 'moveMany'), absolutePath: src },
+			dst: { ...getRemoteFs(dst, 'moveMany'), absolutePath: dst }
+		}));
+		if (remoteMoves && remoteMoves.every(({ src }) => src.mountPoint === remoteDest.mountPoint)) {
+			// Sources and destination live on the same file service: move on the server in one call
+			tasks.push(moveManyRemote(remoteDest, remoteMoves));
+		}
+		else {
+			each(moves, function (move) {
+				tasks.push(_private.move(move));
+			})
+		}
 		Promise.all(tasks)
 			.then(function (results) {
+				results = [].concat(...results.map(r => Array.isArray(r) ? r : [r]));
 				var rtn = {
 					added: [],
 					removed: [],
@@ -1042,16 +1205,49 @@ async function removeDir(filePath) {
 	}
 }
 
+/**
+ * Group paths living on file services supporting `method` by mount point;
+ * returns null unless every path does
+ */
+function groupRemotePaths(absolutePaths, method) {
+	const groups = new Map();
+	for (const absolutePath of absolutePaths) {
+		const remote = getRemoteFs(absolutePath, method);
+		if (!remote) return null;
+		if (!groups.has(remote.mountPoint)) groups.set(remote.mountPoint, { remote, paths: [] });
+		groups.get(remote.mountPoint).paths.push(remote.path);
+	}
+	return [...groups.values()];
+}
+
 api.rm = function (opts, res) {
 	return new Promise(async function (resolve, reject) {
 		var removed = [];
-		for (let hash of opts.targets) {
+		const targets = opts.targets.map(hash => ({ hash, target: _private.decode(hash) })).filter(({ hash, target }) => {
+			if (!target) console.log('Invalid target path or volume not mounted:', hash);
+			return !!target;
+		});
+		const groups = groupRemotePaths(targets.map(({ target }) => target.absolutePath), 'removeTree');
+		if (groups) {
+			// Everything lives on file services: remove the trees on the servers
 			try {
-				var target = _private.decode(hash);
-				if (!target) {
-					console.log('Invalid target path or volume not mounted:', hash);
-					continue; // Skip this target and continue with others
+				for (const { remote, paths } of groups) {
+					const result = await remote.fsAPI.removeTree(paths, { trash: config.trashOnDelete });
+					paths.forEach(p => remote.afs._invalidateTree(p));
+					if (result.error || !result.success) {
+						throw new Error(result.error || result.errors.map(e => `${e.path}: ${e.error}`).join('\n'));
+					}
 				}
+			} catch (err) {
+				console.log(err);
+				return reject(err);
+			}
+			return resolve({
+				removed: targets.map(({ hash }) => hash)
+			});
+		}
+		for (let { hash, target } of targets) {
+			try {
 				if ((await fs.lstat(target.absolutePath)).isDirectory())
 					await removeDir(target.absolutePath)
 				else
@@ -1097,6 +1293,24 @@ api.search = function (opts, res) {
 		var target = _private.decode(opts.target);
 		var files = [];
 		try {
+			const remote = getRemoteFs(target.absolutePath, 'search');
+			if (remote) {
+				// Query the file service's index instead of walking the tree; the rows carry the metadata
+				let cursor = null;
+				do {
+					const limit = Math.min(500, config.searchLimit - files.length);
+					const page = await remote.fsAPI.search(opts.q, remote.path, opts.mimes || null, limit, cursor);
+					if (page.error) throw new Error(page.error);
+					for (const entry of page.entries) {
+						remote.afs._cacheStats(remote.afs._normalizePath(entry.path), entry);
+						files.push(_private.searchInfo(path.join(remote.mountPoint, entry.path), entry));
+					}
+					cursor = page.cursor;
+				} while (cursor && files.length < config.searchLimit);
+				return resolve({
+					files: files
+				})
+			}
 			await walk(target.absolutePath, async (path) => {
 				files.push(await _private.info(path));
 			})
@@ -1146,6 +1360,27 @@ async function generateThumbnail(file) {
 	}
 }
 
+async function generateRemoteThumbnails(fsAPI, files) {
+	// files maps paths on the file service to absolute paths
+	const hashes = [];
+	try {
+		for await (const batch of await fsAPI.thumbnails(Object.keys(files), 48)) {
+			for (const result of batch) {
+				if (result.error) {
+					console.error(result.error);
+					continue;
+				}
+				const op = _private.encode(files[result.path]);
+				await writeFile(path.join(config.tmbroot, op + ".png"), new Blob([result.data], { type: 'image/png' }));
+				hashes.push(op);
+			}
+		}
+	}
+	catch (e) {
+		console.error(e)
+	}
+	return hashes;
+}
 api.tmb = function (opts, res) {
 	return new Promise(async function (resolve, reject) {
 		var files = [];
@@ -1166,15 +1401,27 @@ api.tmb = function (opts, res) {
 		}
 		//create.
 		var tasks = [];
+		var remoteFiles = {};
 		for (let file of files) {
 			if (!file.startsWith(config.tmbroot)) {
-				tasks.push(generateThumbnail(file));
+				// Let the file service render thumbnails of its own images
+				const remote = getRemoteFs(file, 'thumbnails');
+				if (remote) {
+					remoteFiles[remote.mountPoint] = remoteFiles[remote.mountPoint] || { fsAPI: remote.fsAPI, files: {} };
+					remoteFiles[remote.mountPoint].files[remote.path] = file;
+				}
+				else {
+					tasks.push(generateThumbnail(file));
+				}
 			}
 		}
+		each(remoteFiles, function (remote) {
+			tasks.push(generateRemoteThumbnails(remote.fsAPI, remote.files));
+		})
 		Promise.all(tasks)
 			.then(function (hashes) {
 				var rtn = {};
-				each(hashes, function (hash) {
+				each(hashes.flat(), function (hash) {
 					if (hash)
 						rtn[hash] = hash + '.png';
 				})
@@ -1360,6 +1607,17 @@ _private.move = function (opts, res) {
 
 //_private
 _private.compress = async function (files, dest) {
+	const remoteDest = getRemoteFs(dest, 'archive');
+	if (remoteDest) {
+		const remoteFiles = files.map(file => getRemoteFs(_private.decode(file).absolutePath, 'archive'));
+		if (remoteFiles.every(remote => remote && remote.mountPoint === remoteDest.mountPoint)) {
+			// Everything lives on the same file service: build the archive on the server
+			const result = await remoteDest.fsAPI.archive(remoteFiles.map(remote => remote.path), remoteDest.path, 'zip');
+			remoteDest.afs._invalidateCache(remoteDest.path);
+			if (result.error) throw new Error(result.error);
+			return true
+		}
+	}
 	var zip = new JSZip();
 	for (let file of files) {
 		var target = _private.decode(file);
@@ -1499,6 +1757,28 @@ _private.info = function (p) {
 	})
 }
 
+// File info of a search result from the metadata of its index row, without a stat per hit
+_private.searchInfo = function (p, entry) {
+	var info = _private.parse(p);
+	var acl = config.acl(p);
+	var r = {
+		name: entry.name,
+		size: entry.size,
+		hash: _private.encode(p),
+		phash: _private.encode(path.dirname(p)),
+		mime: entry.isDirectory ? 'directory' : entry.mime,
+		ts: Math.floor(entry.mtime / 1000),
+		volumeid: 'v' + info.volume + '_',
+		path: p,
+		read: acl.read,
+		write: acl.write,
+		locked: acl.locked,
+		isdir: entry.isDirectory,
+	}
+	if (r.mime.indexOf('image/') == 0) r.tmb = "1";
+	return r;
+}
+
 _private.init = function () {
 	var tasks = [];
 	each(config.volumes, function (volume) {
@@ -0,0 +1,1001 @@
+"""Tests of async_fs_service, calling the service through LocalServer as a client would."""
+import array
+import asyncio
+import contextlib
+import errno
+import hashlib
+import io
+import os
+import stat
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+
+import pytest
+
+import async_fs_service
+from async_fs_service import (
+    AsyncFileService, BlockingExecutor, DirectorySizeCache, LISTING_PAGE_MAX, LocalServer, MultiProcessFileService, SERVICE_ID,
+    ServiceMetrics, histogram_quantile, page_limit,
+)
+
+
+@contextlib.asynccontextmanager
+async def connect(root, service_class=AsyncFileService, **options):
+    """Start a service on ``root`` and yield ``(server, fs)``, ``fs`` being its client proxy."""
+    options.setdefault("no_index", True)
+    async with service_class(root=str(root), **options) as service:
+        server = LocalServer()
+        await service.register(server)
+        yield server, await server.get_service(SERVICE_ID)
+
+
+def collector():
+    """A watch callback that keeps the batches it receives."""
+    batches = []
+
+    async def callback(batch):
+        batches.append(batch)
+    return batches, callback
+
+
+async def wait_for_event(batches, name, timeout=5.0):
+    """Wait until a watch batch reports a change of ``name``; returns that batch."""
+    deadline = asyncio.get_running_loop().time() + timeout
+    while asyncio.get_running_loop().time() < deadline:
+        for batch in batches:
+            if any(event["path"].endswith("/" + name) for event in batch["events"]):
+                return batch
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"No watch event for {name}: {batches}")
+
+
+def test_batch_accepts_keyword_arguments(tmp_path):
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            results = await fs.batch([
+                {"op": "mkdir", "args": ["/a", 0o755]},
+                {"op": "stat", "args": ["/missing"]},
+                {"op": "mkdir", "args": ["/b", 0o755]},
+            ], stopOnError=True)
+            assert [("error" in r, r.get("skipped", False)) for r in results] == [
+                (False, False), (True, False), (False, True),
+            ]
+            assert (tmp_path / "a").is_dir() and not (tmp_path / "b").exists()
+
+            results = await fs.batch([{"op": "exists", "args": [f"/{name}"]} for name in "ab"], concurrent=True)
+            assert [r["result"] for r in results] == [True, False]
+
+    asyncio.run(main())
+
+
+def test_read_file_range(tmp_path):
+    data = bytes(range(256)) * 16
+    (tmp_path / "data.bin").write_bytes(data)
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            result = await fs.readFileRange("/data.bin", 100, 50)
+            assert (result["data"], result["offset"], result["size"]) == (data[100:150], 100, len(data))
+            result = await fs.readFileRange("/data.bin", -10)
+            assert result["data"] == data[-10:]
+            result = await fs.readFileRange("/data.bin", len(data) - 5, length=100)
+            assert result["data"] == data[-5:]
+
+    asyncio.run(main())
+
+
+def test_content_cache(tmp_path):
+    small = b"small file contents"
+    large = os.urandom(300000)
+    (tmp_path / "small.bin").write_bytes(small)
+    (tmp_path / "large.bin").write_bytes(large)
+
+    async def main():
+        async with connect(tmp_path, content_cache_max_file=1000) as (_, fs):
+            async def cache_stats():
+                return (await fs.getMetrics())["contentCache"]
+
+            assert (await fs.readFileRange("/small.bin", 6, 4))["data"] == b"file"
+            assert (await fs.readFileRange("/small.bin"))["data"] == small
+            assert await fs.readFile("/small.bin", "binary", "r") == small
+            stats = await cache_stats()
+            assert (stats["entries"], stats["bytes"], stats["misses"], stats["hits"]) == (1, len(small), 1, 2)
+
+            # Writes through the service and changes behind its back are both seen
+            await fs.writeFile("/small.bin", b"rewritten", "binary", "w", None)
+            assert (await fs.readFileRange("/small.bin"))["data"] == b"rewritten"
+            (tmp_path / "small.bin").write_bytes(b"changed on disk!")
+            assert (await fs.readFileRange("/small.bin", 8))["data"] == b"on disk!"
+
+            # Files above the size limit are read with pread and not cached
+            result = await fs.readFileRange("/large.bin", 1000, 200000)
+            assert result["data"] == large[1000:201000] and result["size"] == len(large)
+            assert (await fs.readFileRange("/large.bin", len(large) - 3, 10))["data"] == large[-3:]
+            assert (await fs.readFileRange("/large.bin", len(large) + 5))["data"] == b""
+            assert (await cache_stats())["entries"] == 1
+
+    asyncio.run(main())
+
+
+def test_read_file_range_retries_short_reads(tmp_path, monkeypatch):
+    data = bytes(range(256)) * 8
+    (tmp_path / "data.bin").write_bytes(data)
+    pread = os.pread
+    # Return at most 100 bytes per call, like a read interrupted by a signal
+    monkeypatch.setattr(os, "pread", lambda fd, length, offset: pread(fd, min(length, 100), offset))
+    assert async_fs_service.read_file_range(str(tmp_path / "data.bin"), 10, 1000) == data[10:1010]
+    assert async_fs_service.read_file_range(str(tmp_path / "data.bin"), len(data) - 50, 1000) == data[-50:]
+    assert async_fs_service.read_file_range(str(tmp_path / "data.bin"), len(data), 10) == b""
+
+
+def test_upload_resumes_after_reconnect(tmp_path):
+    data = b"0123456789" * 1000
+
+    async def main():
+        async with connect(tmp_path) as (server, fs):
+            assert "error" in await fs.beginUpload("/upload.bin", -1)
+            assert "error" in await fs.beginUpload("/upload.bin", "10")
+
+            session = await fs.beginUpload("/upload.bin", len(data))
+            assert (await fs.putChunk(session["sessionId"], 0, data[:4000]))["written"] == 4000
+            await server.disconnect()
+
+            # Sessions outlive the connection; only the missing bytes are sent again
+            fs = await server.get_service(SERVICE_ID, client="other-client")
+            status = await fs.getUploadStatus(session["sessionId"])
+            assert (status["received"], status["ranges"]) == (4000, [[0, 4000]])
+            assert "error" in await fs.putChunk(session["sessionId"], len(data) - 10, data[-10:] * 2)
+            await fs.putChunk(session["sessionId"], 4000, zlib.compress(data[4000:]), compression="zlib")
+            result = await fs.commitUpload(session["sessionId"], checksum=hashlib.sha256(data).hexdigest())
+            assert result.get("success"), result
+            assert (tmp_path / "upload.bin").read_bytes() == data
+            assert not [p.name for p in tmp_path.iterdir() if p.name.endswith(".upload")]
+
+    asyncio.run(main())
+
+
+def test_upload_sessions_are_bounded_and_hidden(tmp_path, monkeypatch):
+    monkeypatch.setattr(async_fs_service, "UPLOAD_SESSION_TTL", 0.2)
+    monkeypatch.setattr(async_fs_service, "UPLOAD_EXPIRY_INTERVAL", 0.05)
+    staging = tmp_path / async_fs_service.UPLOAD_DIRECTORY
+
+    async def main():
+        async with connect(tmp_path, max_upload_sessions=2, max_handles=3) as (_, fs):
+            batches, callback = collector()
+            await fs.watch("/", callback)
+            first = await fs.beginUpload("/dir/a.bin", 10)
+            second = await fs.beginUpload("/b.bin", 10)
+            assert "error" in await fs.beginUpload("/c.bin", 10)
+
+            # Staged files stay out of listings, the index and watch events
+            assert len(list(staging.iterdir())) == 2
+            assert sorted(await fs.readdir("/")) == ["dir"]
+            page = await fs.readdirpage("/")
+            assert [entry["name"] for entry in page["entries"]] == ["dir"]
+            assert await fs.readdir("/dir") == []
+
+            # Sessions hold file handles
+            assert (await fs.getMetrics())["handles"]["reserved"] == 2
+            handle = await fs.createFile("/x.txt", "w", None)
+            assert "error" in await fs.createFile("/y.txt", "w", None)
+            await handle["close"]()
+
+            await fs.putChunk(first["sessionId"], 0, b"0123456789")
+            assert (await fs.commitUpload(first["sessionId"])).get("success")
+            assert (tmp_path / "dir" / "a.bin").read_bytes() == b"0123456789"
+            await wait_for_event(batches, "x.txt")
+            await asyncio.sleep(0.3)
+            assert not any(async_fs_service.UPLOAD_DIRECTORY in event["path"]
+                           for batch in batches for event in batch["events"])
+
+            # Idle sessions expire without another upload starting
+            await fs.getUploadStatus(second["sessionId"])
+            await asyncio.sleep(0.5)
+            assert "error" in await fs.getUploadStatus(second["sessionId"])
+            assert list(staging.iterdir()) == []
+            assert (await fs.getMetrics())["handles"]["reserved"] == 0
+            assert "sessionId" in await fs.beginUpload("/c.bin", 10)
+
+    asyncio.run(main())
+
+
+def test_apply_delta(tmp_path):
+    original = b"a" * 4096 + b"b" * 4096
+    (tmp_path / "file.bin").write_bytes(original)
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            checksums = await fs.getBlockChecksums("/file.bin", blockSize=4096)
+            assert checksums["size"] == len(original)
+            expected = original[4096:] + b"new" + original[:4096]
+            result = await fs.applyDelta("/file.bin", [
+                {"copy": 4096, "length": 4096}, {"data": b"new"}, {"copy": 0, "length": 4096},
+            ], base=checksums["version"], checksum=hashlib.sha256(expected).hexdigest())
+            assert (result["copied"], result["literal"]) == (8192, 3)
+            assert (tmp_path / "file.bin").read_bytes() == expected
+
+            # The file changed since the checksums were taken
+            result = await fs.applyDelta("/file.bin", [{"data": b"x"}], base=checksums["version"])
+            assert "error" in result
+            assert "error" in await fs.applyDelta("/file.bin", [{"copy": 0, "length": 10 ** 6}])
+            assert (tmp_path / "file.bin").read_bytes() == expected
+            assert not [p.name for p in tmp_path.iterdir() if p.name.endswith(".delta")]
+
+    asyncio.run(main())
+
+
+def test_write_file_bounds_decompression(tmp_path):
+    data = b"\0" * 100000
+    payload = zlib.compress(data)
+
+    async def main():
+        async with connect(tmp_path, max_decompressed_size=50000) as (_, fs):
+            result = await fs.writeFile("/small.bin", zlib.compress(data[:1000]), "binary", "w", None, "zlib", 1000)
+            assert result.get("success"), result
+            assert (tmp_path / "small.bin").read_bytes() == data[:1000]
+            # Beyond --max-decompressed-size, or not the announced size
+            assert "error" in await fs.writeFile("/big.bin", payload, "binary", "w", None, "zlib")
+            assert "error" in await fs.writeFile("/big.bin", payload, "binary", "w", None, "zlib", 100)
+            assert not (tmp_path / "big.bin").exists()
+
+    asyncio.run(main())
+
+
+def test_handles_close_on_disconnect(tmp_path):
+    async def main():
+        async with connect(tmp_path) as (server, fs):
+            handle = await fs.createFile("/handle.bin", "w+", None)
+            assert await handle["write"](b"hello world", 0, 11, 0) == 11
+            buffer = bytearray(5)
+            assert await handle["read"](buffer, 0, 5, 6) == 5
+            assert bytes(buffer) == b"world"
+            assert await handle["readMany"]([[0, 5], [6, 5]]) == [b"hello", b"world"]
+            await handle["close"]()
+
+            handle = await fs.openFile("/handle.bin", "r")
+            await server.disconnect()
+            with pytest.raises(Exception):
+                await handle["read"](bytearray(5), 0, 5, 0)
+
+    asyncio.run(main())
+
+
+def test_watch_reports_changes(tmp_path):
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            batches, callback = collector()
+            watch = await fs.watch("/", callback)
+            await fs.writeFile("/watched.txt", "text", "utf8", "w", None)
+            batch = await wait_for_event(batches, "watched.txt")
+            assert batch["watchId"] == watch["watchId"]
+            assert (await fs.unwatch(watch["watchId"])).get("success")
+            assert "error" in await fs.unwatch(watch["watchId"])
+
+    asyncio.run(main())
+
+
+def test_worker_mode_routes_tokens(tmp_path):
+    data = b"worker" * 1000
+
+    async def main():
+        async with connect(tmp_path, MultiProcessFileService, workers=2) as (_, fs):
+            session = await fs.beginUpload("/worker.bin", len(data))
+            assert session["sessionId"].split(":", 1)[0] in ("0", "1")
+            await fs.putChunk(session["sessionId"], 0, data)
+            assert (await fs.getUploadStatus(session["sessionId"]))["received"] == len(data)
+            assert (await fs.commitUpload(session["sessionId"])).get("success")
+            assert (tmp_path / "worker.bin").read_bytes() == data
+
+            # Batches route every operation, rewriting the tokens it refers to
+            session = await fs.beginUpload("/batch.bin", 3)
+            results = await fs.batch([
+                {"op": "putChunk", "args": [session["sessionId"], 0, b"abc"]},
+                {"op": "commitUpload", "args": {"sessionId": session["sessionId"]}},
+                {"op": "readFileRange", "args": ["/batch.bin", 0, 3]},
+            ], stopOnError=True)
+            assert results[-1]["result"]["data"] == b"abc", results
+
+            batches, callback = collector()
+            watch = await fs.watch("/", callback)
+            assert watch["watchId"].split(":", 1)[0] in ("0", "1")
+            await fs.writeFile("/watched.txt", "text", "utf8", "w", None)
+            batch = await wait_for_event(batches, "watched.txt")
+            assert batch["watchId"] == watch["watchId"]
+            assert (await fs.unwatch(watch["watchId"])).get("success")
+
+    asyncio.run(main())
+
+
+def test_readdirpage_pages_through_a_snapshot(tmp_path):
+    for i in range(25):
+        (tmp_path / f"f{i:02}").write_bytes(b"x" * i)
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            names, cursor = [], None
+            while True:
+                page = await fs.readdirpage("/", cursor, 10, "name")
+                assert page["total"] == 25
+                names += [entry["name"] for entry in page["entries"]]
+                # Entries created after the first page are not in the snapshot
+                (tmp_path / "late").touch()
+                cursor = page["cursor"]
+                if cursor is None:
+                    break
+            assert names == [f"f{i:02}" for i in range(25)]
+            assert "error" in await fs.readdirpage("/", cursor="expired:10")
+
+            page = await fs.readdirpage("/", None, 100, "size", True)
+            assert page["entries"][0]["name"] == "f24"
+            for limit in (0, -1, 1.5, "10"):
+                assert "error" in await fs.readdirpage("/", None, limit)
+            assert "error" in await fs.readdirpage("/", None, 10, "color")
+            assert page_limit(10 ** 9) == LISTING_PAGE_MAX
+
+    asyncio.run(main())
+
+
+def test_metadata_cache_invalidation(tmp_path):
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "file.txt").write_text("one")
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            assert (await fs.stat("/dir/file.txt"))["size"] == 3
+            assert await fs.readdir("/dir") == ["file.txt"]
+            await fs.stat("/dir")
+            assert (await fs.getCacheStats())["entries"] == 3
+
+            # The service's own mutations are visible at once
+            await fs.writeFile("/dir/file.txt", "three", "utf8", "w", None)
+            assert (await fs.stat("/dir/file.txt"))["size"] == 5
+            await fs.rename("/dir/file.txt", "/dir/moved.txt")
+            assert await fs.exists("/dir/moved.txt") and not await fs.exists("/dir/file.txt")
+
+            # Changes made behind the service's back arrive through inotify
+            (tmp_path / "dir" / "external.txt").write_text("x")
+            for _ in range(50):
+                if "external.txt" in await fs.readdir("/dir"):
+                    break
+                await asyncio.sleep(0.02)
+            assert sorted(await fs.readdir("/dir")) == ["external.txt", "moved.txt"]
+            # Entries created inside a directory change its own stat
+            assert (await fs.stat("/dir"))["st_mtime"] == (tmp_path / "dir").stat().st_mtime
+            assert (await fs.getCacheStats())["mode"] == "inotify"
+
+    asyncio.run(main())
+
+
+def test_metadata_cache_reports_exhausted_watches(tmp_path):
+    for name in ("a", "b", "c"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "file").touch()
+
+    async def main():
+        # A budget of 4 watches leaves one to the metadata cache
+        async with connect(tmp_path, max_inotify_watches=4) as (_, fs):
+            for name in ("a", "b", "c"):
+                assert (await fs.stat(f"/{name}/file"))["isFile"]
+            stats = await fs.getCacheStats()
+            assert (stats["watches"], stats["watchFailures"]) == (1, 2)
+            # Uncached entries are still served, just not from the cache
+            assert (await fs.stat("/c/file"))["isFile"]
+            assert "asyncfs_metadata_cache_watch_failures_total 3" in await fs.getMetrics("prometheus")
+
+    asyncio.run(main())
+
+
+def test_copy_tree_conflict_policies(tmp_path):
+    (tmp_path / "src" / "sub").mkdir(parents=True)
+    (tmp_path / "src" / "a.txt").write_text("new a")
+    (tmp_path / "src" / "sub" / "b.txt").write_text("new b")
+    (tmp_path / "src" / "link").symlink_to("a.txt")
+    (tmp_path / "dst").mkdir()
+    (tmp_path / "dst" / "a.txt").write_text("old a")
+    (tmp_path / "dst" / "keep.txt").write_text("keep")
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            result = await fs.copyTree("/src", "/dst")
+            assert not result["success"] and [e["path"] for e in result["errors"]] == ["/src/a.txt"]
+            assert (tmp_path / "dst" / "a.txt").read_text() == "old a"
+            assert (tmp_path / "dst" / "sub" / "b.txt").read_text() == "new b"
+
+            result = await fs.copyTree("/src", "/dst", {"overwrite": "skip"})
+            assert result["success"] and result["skipped"] == 3
+            assert (tmp_path / "dst" / "a.txt").read_text() == "old a"
+
+            result = await fs.copyTree("/src", "/dst", {"overwrite": "overwrite"})
+            assert result["success"] and result["files"] == 3
+            assert (tmp_path / "dst" / "a.txt").read_text() == "new a"
+            assert os.readlink(tmp_path / "dst" / "link") == "a.txt"
+            # Directories are merged
+            assert (tmp_path / "dst" / "keep.txt").read_text() == "keep"
+
+    asyncio.run(main())
+
+
+def test_overwriting_a_hard_link_keeps_the_data(tmp_path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "dst").mkdir()
+    (tmp_path / "src" / "file").write_text("precious")
+    os.link(tmp_path / "src" / "file", tmp_path / "dst" / "file")
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            for call in (fs.copyTree, fs.moveTree):
+                result = await call("/src", "/dst", {"overwrite": "overwrite"})
+                assert not result["success"] and "same file" in result["errors"][0]["error"]
+                assert (tmp_path / "src" / "file").read_text() == "precious"
+                assert (tmp_path / "dst" / "file").read_text() == "precious"
+
+    asyncio.run(main())
+
+
+def test_move_tree(tmp_path):
+    (tmp_path / "src" / "sub").mkdir(parents=True)
+    (tmp_path / "src" / "sub" / "file").write_text("data")
+    (tmp_path / "dst" / "src").mkdir(parents=True)
+    (tmp_path / "dst" / "src" / "other").write_text("other")
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            assert (await fs.stat("/src/sub/file"))["size"] == 4
+            result = await fs.moveTree("/src", "/renamed")
+            assert result.get("success"), result
+            assert not await fs.exists("/src/sub/file")
+            assert (await fs.stat("/renamed/sub/file"))["size"] == 4
+
+            # Into an existing directory the tree is moved file by file and merged
+            result = await fs.moveTree("/renamed", "/dst/src")
+            assert result.get("success"), result
+            assert sorted(os.listdir(tmp_path / "dst" / "src")) == ["other", "sub"]
+            assert not (tmp_path / "renamed").exists()
+
+    asyncio.run(main())
+
+
+def test_archives(tmp_path):
+    (tmp_path / "docs" / "sub").mkdir(parents=True)
+    (tmp_path / "docs" / "a.txt").write_text("a" * 1000)
+    (tmp_path / "docs" / "sub" / "b.bin").write_bytes(os.urandom(300000))
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            chunks = [chunk async for chunk in fs.archiveChunks(["/docs"], "zip", 65536)]
+            assert len(chunks) > 1 and all(len(chunk) <= 65536 for chunk in chunks)
+            with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+                assert archive.read("docs/a.txt") == b"a" * 1000
+                assert archive.read("docs/sub/b.bin") == (tmp_path / "docs" / "sub" / "b.bin").read_bytes()
+
+            result = await fs.archive(["/docs/a.txt", "/docs/sub"], "/out.tar.gz", "tar.gz")
+            assert result.get("success"), result
+            with tarfile.open(tmp_path / "out.tar.gz") as archive:
+                assert sorted(archive.getnames()) == ["a.txt", "sub", "sub/b.bin"]
+            assert "error" in await fs.archive(["/"], "/root.zip")
+            assert "error" in await fs.archive(["/missing"], "/missing.zip")
+            assert not [p for p in os.listdir(tmp_path) if p.endswith(".tmp")]
+
+    asyncio.run(main())
+
+
+def test_abandoned_archive_stream_stops_its_thread(tmp_path, monkeypatch):
+    monkeypatch.setattr(async_fs_service, "ARCHIVE_STALL_TIMEOUT", 0.2)
+    monkeypatch.setattr(async_fs_service, "ARCHIVE_POLL_INTERVAL", 0.05)
+    (tmp_path / "big.bin").write_bytes(os.urandom(2 * 1024 * 1024))
+
+    def producers():
+        return [thread for thread in threading.enumerate() if thread.name == "archive-stream"]
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            stream = fs.archiveChunks(["/big.bin"], "zip", 4096)
+            assert await stream.__anext__()
+            # The client stops reading without closing the stream
+            for _ in range(100):
+                if not producers():
+                    break
+                await asyncio.sleep(0.05)
+            assert not producers()
+            await stream.aclose()
+
+    asyncio.run(main())
+
+
+def test_thumbnails(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    cache_dir = tmp_path / "cache"
+    root = tmp_path / "root"
+    root.mkdir()
+    for name, color in (("red.png", "red"), ("blue.jpg", "blue")):
+        Image.new("RGB", (400, 200), color).save(root / name)
+    (root / "notes.txt").write_text("not an image")
+    cache_dir.mkdir()
+    stale = cache_dir / "0-0-0-48.png"
+    stale.write_bytes(b"stale")
+    os.utime(stale, (0, 0))
+
+    async def thumbnails(fs, paths, size=48):
+        results = {}
+        async for batch in fs.thumbnails(paths, size):
+            for result in batch:
+                results[result["path"]] = result
+        return results
+
+    async def main():
+        async with connect(root, thumbnail_cache_dir=str(cache_dir), thumbnail_workers=1) as (_, fs):
+            results = await thumbnails(fs, ["/red.png", "/blue.jpg", "/notes.txt", "/missing.png"])
+            with Image.open(io.BytesIO(results["/red.png"]["data"])) as thumbnail:
+                assert thumbnail.size == (48, 24)
+            assert "error" in results["/notes.txt"] and "error" in results["/missing.png"]
+            # Cached thumbnails come back in the first batch
+            first = await fs.thumbnails(["/red.png", "/blue.jpg"]).__anext__()
+            assert [result["path"] for result in first] == ["/red.png", "/blue.jpg"]
+
+            # Unused thumbnails are pruned in the background
+            for _ in range(50):
+                if not stale.exists():
+                    break
+                await asyncio.sleep(0.02)
+            assert not stale.exists()
+
+    asyncio.run(main())
+
+
+def test_prune_thumbnail_cache(tmp_path):
+    now = time.time()
+    for i in range(5):
+        (tmp_path / f"{i}.png").write_bytes(b"x" * 100)
+        os.utime(tmp_path / f"{i}.png", (now - 100 * i, now - 100 * i))
+    (tmp_path / "render.png.1.tmp").write_bytes(b"x" * 100)
+
+    # The least recently used go first, running renders are kept
+    assert async_fs_service.prune_thumbnail_cache(tmp_path, 250, 3600) == (3, 200)
+    assert sorted(os.listdir(tmp_path)) == ["0.png", "1.png", "render.png.1.tmp"]
+    assert async_fs_service.prune_thumbnail_cache(tmp_path, 1000, 50) == (1, 100)
+    assert async_fs_service.prune_thumbnail_cache(tmp_path / "missing", 0, 0) == (0, 0)
+
+
+async def wait_for_index(fs, entries):
+    """Wait until the index crawl finished with ``entries`` entries."""
+    for _ in range(200):
+        status = await fs.getIndexStatus()
+        if not status["crawling"] and status["entries"] == entries:
+            return status
+        await asyncio.sleep(0.02)
+    raise AssertionError(f"Index did not settle: {status}")
+
+
+def test_index_search(tmp_path):
+    root = tmp_path / "root"
+    (root / "photos").mkdir(parents=True)
+    (root / "photos" / "Holiday.JPG").write_bytes(b"")
+    (root / "photos" / "holiday-notes.txt").write_text("notes")
+    (root / "Änderung.txt").write_text("ä")
+    (root / "readme.md").write_text("readme")
+
+    async def search(fs, *args):
+        result = await fs.search(*args)
+        return sorted(entry["path"] for entry in result["entries"])
+
+    async def main():
+        async with connect(root, no_index=False, index_db=str(tmp_path / "index.sqlite3")) as (_, fs):
+            await wait_for_index(fs, 5)
+            assert await search(fs, "HOLIDAY") == ["/photos/Holiday.JPG", "/photos/holiday-notes.txt"]
+            assert await search(fs, "*.jpg") == ["/photos/Holiday.JPG"]
+            assert await search(fs, "holiday", "/", ["image"]) == ["/photos/Holiday.JPG"]
+            assert await search(fs, "o", "/photos") == ["/photos/Holiday.JPG", "/photos/holiday-notes.txt"]
+            # Case folding beyond ASCII
+            assert await search(fs, "änd") == ["/Änderung.txt"]
+            assert await search(fs, "ÄNDERUNG") == ["/Änderung.txt"]
+
+            page = await fs.search("e", "/", None, 2)
+            rest = await fs.search("e", "/", None, 10, page["cursor"])
+            assert len(page["entries"]) == 2 and rest["cursor"] is None
+            assert [e["path"] for e in page["entries"] + rest["entries"]] == [
+                "/photos/holiday-notes.txt", "/readme.md", "/Änderung.txt"]
+            assert "error" in await fs.search("e", "/", None, 0)
+
+            # The service's own changes are indexed
+            await fs.writeFile("/photos/new holiday.png", b"", "binary", "w", None)
+            await fs.removeTree(["/readme.md"])
+            for _ in range(100):
+                if len(await search(fs, "holiday")) == 3 and not await search(fs, "readme"):
+                    break
+                await asyncio.sleep(0.02)
+            assert "/photos/new holiday.png" in await search(fs, "holiday")
+            assert await search(fs, "readme") == []
+
+    asyncio.run(main())
+
+
+def test_hash_files_and_find_duplicates(tmp_path, monkeypatch):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "one.txt").write_bytes(b"same content")
+    (tmp_path / "two.txt").write_bytes(b"same content")
+    (tmp_path / "other.txt").write_bytes(b"same length!")
+    (tmp_path / "big.bin").write_bytes(b"x" * 100)
+    (tmp_path / "a" / "big copy.bin").write_bytes(b"x" * 100)
+    os.link(tmp_path / "big.bin", tmp_path / "big link.bin")
+    (tmp_path / "empty1").write_bytes(b"")
+    (tmp_path / "empty2").write_bytes(b"")
+    hashed = []
+    hash_file = async_fs_service.hash_file
+    monkeypatch.setattr(async_fs_service, "hash_file", lambda path, algorithm: (
+        hashed.append(path), hash_file(path, algorithm))[1])
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            results = await fs.hash(["/two.txt", "/missing", "/a"], "md5")
+            assert results[0] == {"path": "/two.txt", "hash": hashlib.md5(b"same content").hexdigest()}
+            assert "error" in results[1] and "error" in results[2]
+            assert "error" in await fs.hash(["/two.txt"], "crc32")
+
+            # Unchanged files come from the cache, changed ones are hashed again
+            hashed.clear()
+            await fs.hash(["/two.txt"], "md5")
+            assert hashed == []
+            results = await fs.hash(["/two.txt"], "sha256")
+            assert results[0]["hash"] == hashlib.sha256(b"same content").hexdigest()
+            (tmp_path / "two.txt").write_bytes(b"same content, changed")
+            results = await fs.hash(["/two.txt"], "md5")
+            assert results[0]["hash"] == hashlib.md5(b"same content, changed").hexdigest()
+            assert len(hashed) == 2
+            (tmp_path / "two.txt").write_bytes(b"same content")
+
+            # Hard links count once, files of a unique size and empty files are not hashed
+            hashed.clear()
+            duplicates = await fs.findDuplicates("/")
+            assert [group["size"] for group in duplicates] == [100, 12]
+            # Either name of the hard linked file may stand for it
+            assert duplicates[0]["paths"] in (["/a/big copy.bin", "/big.bin"], ["/a/big copy.bin", "/big link.bin"])
+            assert duplicates[1]["paths"] == ["/a/one.txt", "/two.txt"]
+            assert duplicates[1]["hash"] == hashlib.sha256(b"same content").hexdigest()
+            names = {os.path.basename(path) for path in hashed}
+            assert {"big copy.bin", "one.txt", "other.txt"} <= names
+            assert len(names & {"big.bin", "big link.bin"}) == 1 and not names & {"empty1", "empty2"}
+            assert await fs.findDuplicates("/a") == []
+            assert len(await fs.findDuplicates("/", "sha256", 0)) == 3
+            assert [group["size"] for group in await fs.findDuplicates("/", "sha256", 50)] == [100]
+
+    asyncio.run(main())
+
+
+def test_dir_size(tmp_path):
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "a" / "one.bin").write_bytes(b"x" * 100)
+    (tmp_path / "a" / "b" / "two.bin").write_bytes(b"x" * 50)
+    os.link(tmp_path / "a" / "one.bin", tmp_path / "a" / "b" / "link.bin")
+    (tmp_path / "c").mkdir()
+    (tmp_path / "c" / "three.bin").write_bytes(b"x" * 7)
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            # An unfinished upload and a trashed tree do not count
+            await fs.beginUpload("/pending.bin", 1000)
+            (tmp_path / "trashed").mkdir()
+            (tmp_path / "trashed" / "old.bin").write_bytes(b"x" * 1000)
+            assert (await fs.removeTree(["/trashed"], {"trash": True}))["trashed"] == ["/trashed"]
+
+            result = await fs.dirSize(["/a", "/", "/missing"])
+            assert result["continuation"] is None
+            a, root, missing = result["results"]
+            assert (a["bytes"], a["files"], a["dirs"], a["complete"]) == (150, 2, 1, True)
+            assert (root["bytes"], root["files"], root["dirs"]) == (157, 3, 3)
+            assert missing["errors"] and missing["errors"][0]["path"] == "/missing"
+
+            # Past the deadline the call returns partial results and a token to carry on with
+            partial = await fs.dirSize(["/a"], deadline=0)
+            assert partial["continuation"] and not partial["results"][0]["complete"]
+            result = await fs.dirSize(continuation=partial["continuation"])
+            assert result["results"][0]["bytes"] == 150 and result["results"][0]["complete"]
+            assert "error" in await fs.dirSize(continuation=partial["continuation"])
+
+            (tmp_path / "a" / "b" / "new.bin").write_bytes(b"x" * 5)
+            assert (await fs.dirSize(["/a"]))["results"][0]["bytes"] == 155
+
+    asyncio.run(main())
+
+
+def test_directory_size_cache(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "file.bin").write_bytes(b"x" * 10)
+    cache = DirectorySizeCache(maxsize=1)
+    record = cache.scan(str(tmp_path))
+    assert (record["bytes"], record["files"], record["subdirs"]) == (10, 1, [str(tmp_path / "sub")])
+    assert cache.scan(str(tmp_path)) is record and (cache.hits, cache.misses) == (1, 1)
+
+    # Entries are revalidated by directory mtime and evicted beyond maxsize
+    os.utime(tmp_path, ns=(0, 0))
+    assert cache.scan(str(tmp_path)) is not record
+    cache.scan(str(tmp_path / "sub"))
+    cache.scan(str(tmp_path))
+    assert (cache.hits, cache.misses) == (1, 4)
+
+
+def test_readdircolumns(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a.txt").write_bytes(b"x" * 3)
+    (tmp_path / "b.png").write_bytes(b"x" * 70000)
+    (tmp_path / "c.txt").write_bytes(b"")
+    os.symlink(tmp_path / "missing", tmp_path / "broken")
+    os.utime(tmp_path / "a.txt", ns=(1_500_000_000_250_000_000, 1_500_000_000_250_000_000))
+
+    def column(page, field, typecode):
+        values = array.array(typecode, page["columns"][field])
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values.tolist()
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            page = await fs.readdircolumns("/", sortBy="name")
+            assert page["format"] == "columns" and page["cursor"] is None
+            assert page["types"] == {"size": "float64", "mtime": "float64", "mode": "uint32", "mime": "uint16"}
+            # The broken symlink cannot be stat'ed and is left out
+            assert page["names"] == ["a.txt", "b.png", "c.txt", "sub"] and page["count"] == 4
+            assert column(page, "size", "d")[:3] == [3, 70000, 0]
+            assert column(page, "mtime", "d")[0] == pytest.approx(1_500_000_000_250)
+            assert [stat.S_ISDIR(mode) for mode in column(page, "mode", "I")] == [False, False, False, True]
+            assert [page["mimes"][i] for i in column(page, "mime", "H")] == [
+                "text/plain", "image/png", "text/plain", "directory"]
+            assert len(page["mimes"]) == 3
+
+            page = await fs.readdircolumns("/", ["ino", "nlink"], None, 2, "size", True)
+            assert page["names"] == ["b.png", "sub"] and set(page["columns"]) == {"ino", "nlink"}
+            assert column(page, "ino", "Q")[0] == os.stat(tmp_path / "b.png").st_ino
+            rest = await fs.readdircolumns("/", ["ino"], page["cursor"], 10)
+            assert rest["names"] == ["a.txt", "c.txt"] and rest["cursor"] is None
+
+            assert "error" in await fs.readdircolumns("/", ["size", "owner"])
+            assert "error" in await fs.readdircolumns("/", None, None, 0)
+            assert "error" in await fs.readdircolumns("/missing")
+
+    asyncio.run(main())
+
+
+def test_metrics_and_traces(tmp_path):
+    (tmp_path / "file.txt").write_text("hello")
+
+    async def main():
+        async with connect(tmp_path, trace_sample_rate=1.0) as (_, fs):
+            await fs.stat("/file.txt")
+            with pytest.raises(Exception):
+                await fs.stat("/missing")
+            assert await fs.readFile("/file.txt", "utf8", "r") == "hello"
+            await fs.writeFile("/payload.bin", b"x" * 1000, "binary", "w", None)
+
+            metrics = await fs.getMetrics()
+            stat_calls = metrics["methods"]["stat"]
+            assert (stat_calls["calls"], stat_calls["errors"], stat_calls["inFlight"]) == (2, 1, 0)
+            assert 0 < stat_calls["p50Ms"] <= stat_calls["p99Ms"] and stat_calls["maxMs"] >= stat_calls["meanMs"]
+            assert metrics["methods"]["getMetrics"]["inFlight"] == 1
+            assert metrics["bytes"]["read"] >= 5 and metrics["bytes"]["written"] >= 1000
+            assert {"metadataCache", "contentCache", "executors", "handles"} <= set(metrics)
+
+            text = await fs.getMetrics("prometheus")
+            assert 'asyncfs_calls_total{method="stat"} 2' in text
+            assert 'asyncfs_errors_total{method="stat"} 1' in text
+            assert 'asyncfs_call_duration_seconds_bucket{method="stat",le="+Inf"} 2' in text
+            assert "# TYPE asyncfs_call_duration_seconds histogram" in text
+            assert "error" in await fs.getMetrics("json")
+
+            traces = await fs.getTraces()
+            assert [trace["method"] for trace in traces[:4]] == ["stat", "stat", "readFile", "writeFile"]
+            assert traces[1]["error"] and traces[0]["error"] is None
+            # Payloads are elided from the recorded arguments
+            assert traces[3]["args"].startswith("'/payload.bin', <1000 bytes>")
+            assert [trace["method"] for trace in await fs.getTraces(1)] == ["getTraces"]
+            assert "error" in await fs.getTraces(0)
+
+    asyncio.run(main())
+
+
+def test_merged_metrics():
+    first, second = ServiceMetrics(slow_threshold=0), ServiceMetrics(slow_threshold=0)
+    for metrics, durations in ((first, [0.0001, 0.003]), (second, [0.2])):
+        for duration in durations:
+            call = metrics._begin("stat", (), {})
+            metrics._end((*call[:2], call[2] - duration, *call[3:]), None)
+        metrics.add_bytes("read", 10)
+    merged = ServiceMetrics.merged([first.state(), second.state()])
+    snapshot = merged.snapshot()
+    assert snapshot["bytes"]["read"] == 20
+    stat_calls = snapshot["methods"]["stat"]
+    assert stat_calls["calls"] == 3
+    # Quantiles are the upper bounds of the buckets they fall in, capped at the slowest call
+    assert stat_calls["p50Ms"] == pytest.approx(5.0)
+    assert stat_calls["p99Ms"] == stat_calls["maxMs"] == pytest.approx(200.0, rel=0.01)
+    assert histogram_quantile([0] * (len(async_fs_service.LATENCY_BUCKETS) + 1), 0, 0.0, 0.5) == 0.0
+
+
+def test_blocking_executor_lanes():
+    async def main():
+        executor = BlockingExecutor(interactive_workers=1, bulk_workers=1, max_queue=2, client_concurrency=1)
+        release = threading.Event()
+        try:
+            async def call(lane, client, func, *args):
+                async_fs_service.CURRENT_CLIENT.set(client)
+                return await executor.run(lane, func, *args)
+
+            # A busy bulk lane does not delay interactive calls
+            bulk = asyncio.ensure_future(call("bulk", "a", release.wait))
+            await asyncio.sleep(0.05)
+            thread_name = await call("interactive", "a", lambda: threading.current_thread().name)
+            assert thread_name.startswith("interactive")
+
+            # Calls beyond a client's concurrency or the lane's threads wait in the queue
+            same_client = asyncio.ensure_future(call("bulk", "a", time.monotonic))
+            other_client = asyncio.ensure_future(call("bulk", "b", time.monotonic))
+            await asyncio.sleep(0.05)
+            stats = executor.stats()["bulk"]
+            assert (stats["running"], stats["queued"], stats["clients"]) == (1, 2, 2)
+
+            # A full queue rejects calls as busy, and cancelling a queued call frees its place
+            with pytest.raises(OSError) as raised:
+                await call("bulk", "c", time.monotonic)
+            assert raised.value.errno == errno.EBUSY
+            other_client.cancel()
+            await asyncio.sleep(0)
+            assert executor.stats()["bulk"]["queued"] == 1
+
+            release.set()
+            assert await bulk is True
+            await same_client
+            stats = executor.stats()
+            assert (stats["bulk"]["completed"], stats["bulk"]["rejected"], stats["bulk"]["clients"]) == (2, 1, 0)
+            assert stats["interactive"]["completed"] == 1 and stats["bulk"]["waitMaxMs"] >= 40
+            text = executor.prometheus()
+            assert 'asyncfs_executor_rejected_total{lane="bulk"} 1' in text
+            assert 'asyncfs_executor_queue_wait_seconds_count{lane="bulk"} 2' in text
+        finally:
+            release.set()
+            executor.shutdown()
+
+    asyncio.run(main())
+
+
+def test_remove_tree(tmp_path):
+    for directory in ("tree/a/b", "tree/c", "other"):
+        (tmp_path / directory).mkdir(parents=True)
+    for i in range(30):
+        (tmp_path / "tree" / "a" / "b" / f"{i}.txt").write_text(str(i))
+    (tmp_path / "tree" / "c" / "file").write_text("c")
+    (tmp_path / "other" / "file").write_text("other")
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            for root in ("/", "/.", "/tree/.."):
+                assert "error" in await fs.removeTree([root])
+            assert (tmp_path / "tree").exists()
+
+            progress = []
+
+            async def on_progress(state):
+                progress.append(state)
+            result = await fs.removeTree(["/tree", "/missing"], {"onProgress": on_progress})
+            assert (result["files"], result["directories"], result["success"]) == (31, 4, False)
+            assert [error["path"] for error in result["errors"]] == ["/missing"]
+            assert progress[-1]["files"] == 31 and progress[-1]["totalDirectories"] == 4
+            assert not (tmp_path / "tree").exists()
+
+            # Trashed trees disappear at once and are purged in the background
+            result = await fs.removeTree(["/other"], {"trash": True})
+            assert (result["success"], result["trashed"]) == (True, ["/other"])
+            assert await fs.readdir("/") == []
+            trash = tmp_path / async_fs_service.TRASH_DIRECTORY
+            for _ in range(100):
+                if not any(trash.iterdir()):
+                    break
+                await asyncio.sleep(0.02)
+            assert list(trash.iterdir()) == []
+            assert (await fs.removeTree(["/other"], {"trash": True}))["errors"][0]["path"] == "/other"
+
+    asyncio.run(main())
+
+
+def test_trashed_trees_are_purged_at_start(tmp_path):
+    leftover = tmp_path / async_fs_service.TRASH_DIRECTORY / "0123abcd"
+    (leftover / "sub").mkdir(parents=True)
+    (leftover / "sub" / "file").write_text("left over by a crash")
+
+    async def main():
+        async with connect(tmp_path) as (_, fs):
+            for _ in range(100):
+                if not leftover.exists():
+                    break
+                await asyncio.sleep(0.02)
+            assert not leftover.exists()
+            assert await fs.readdir("/") == []
+
+    asyncio.run(main())
+
+
+def test_move_many(tmp_path):
+    for name in ("a", "b", "c"):
+        (tmp_path / name).write_text(name)
+    (tmp_path / "dir" / "sub").mkdir(parents=True)
+    (tmp_path / "dir" / "sub" / "file").write_text("file")
+    (tmp_path / "dest").mkdir()
+    (tmp_path / "dest" / "c").write_text("existing")
+
+    async def main():
+        async with connect(tmp_path, copy_workers=2) as (_, fs):
+            progress = []
+
+            async def on_progress(state):
+                progress.append(state)
+            result = await fs.moveMany([
+                ["/a", "/dest/a"], ["/b", "/dest/b"], ["/c", "/dest/c"], ["/dir", "/dest/dir"],
+                ["/missing", "/dest/missing"], ["/dest", "/dest/dir/inside"],
+            ], {"onProgress": on_progress})
+            assert (result["paths"], result["success"]) == (3, False)
+            assert sorted(error["path"] for error in result["errors"]) == ["/c", "/dest", "/missing"]
+            assert progress[-1]["paths"] == 3 and progress[-1]["totalPaths"] == 6
+            assert sorted(await fs.readdir("/")) == ["c", "dest"]
+            assert (tmp_path / "dest" / "dir" / "sub" / "file").read_text() == "file"
+            assert (tmp_path / "dest" / "c").read_text() == "existing"
+
+            result = await fs.moveMany([["/c", "/dest/c"]], {"overwrite": "overwrite"})
+            assert result["success"], result
+            assert (tmp_path / "dest" / "c").read_text() == "c" and not (tmp_path / "c").exists()
+            assert (await fs.moveMany([]))["success"]
+
+    asyncio.run(main())
+
+
+def test_worker_mode_sees_changes_across_workers(tmp_path, monkeypatch):
+    broadcasts = []
+    broadcast_changes = MultiProcessFileService._broadcast_changes
+
+    async def record_broadcast(self, source, changes):
+        broadcasts.append((source.index, changes))
+        await broadcast_changes(self, source, changes)
+    monkeypatch.setattr(MultiProcessFileService, "_broadcast_changes", record_broadcast)
+
+    def on_worker(index, prefix):
+        return next(f"/{prefix}{i}.txt" for i in range(100) if zlib.crc32(f"/{prefix}{i}.txt".encode()) % 2 == index)
+    old, new = on_worker(0, "old"), on_worker(1, "new")
+    leftover = tmp_path / async_fs_service.TRASH_DIRECTORY / "left-over"
+    leftover.mkdir(parents=True)
+    (leftover / "file").write_text("trashed by an earlier run")
+
+    async def main():
+        async with connect(tmp_path, MultiProcessFileService, workers=2, max_handles=100,
+                           content_cache_size=1 << 20, max_inotify_watches=1000) as (_, fs):
+            # The second worker caches that the new path does not exist
+            assert not await fs.exists(new)
+            await fs.writeFile(old, "contents", "utf8", "w", None)
+            assert await fs.readFile(old, "utf8", "r") == "contents"
+
+            broadcasts.clear()
+            await fs.rename(old, new)
+            # The other worker is told about both paths before rename returns
+            assert [index for index, _ in broadcasts] == [0]
+            assert {os.path.basename(path) for path, _ in broadcasts[0][1]} == {old[1:], new[1:]}
+            assert await fs.exists(new) and not await fs.exists(old)
+            assert (await fs.stat(new))["size"] == len("contents")
+            assert await fs.readFile(new, "utf8", "r") == "contents"
+
+            await fs.writeFile(old, "again", "utf8", "w", None)
+            await fs.rename(old, new)
+            assert await fs.readFile(new, "utf8", "r") == "again"
+            assert sorted(await fs.readdir("/")) == [new[1:]]
+
+            # Limits are shared out between the workers
+            workers = (await fs.getMetrics())["workers"]
+            assert [worker["handles"]["maxHandles"] for worker in workers] == [50, 50]
+            assert [worker["contentCache"]["maxBytes"] for worker in workers] == [1 << 19, 1 << 19]
+
+            # The front process purges the trash once, the workers leave it alone
+            for _ in range(100):
+                if not leftover.exists():
+                    break
+                await asyncio.sleep(0.02)
+            assert not leftover.exists()
+
+    asyncio.run(main())